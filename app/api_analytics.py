@@ -1,12 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlmodel import Session, select, func
+from fastapi import APIRouter, Depends, HTTPException, Header
+from sqlmodel import Session, select
 from pydantic import BaseModel
 from typing import List, Optional
-from datetime import datetime, timedelta
 
 # Import DB & Models
 from app.database import get_session
-from app.models import PageHealth, PostMeta, PostMetric
+from app.ingest_service import (
+    upsert_page_health, upsert_post_meta, ingest_post_metrics, parse_record_date, existing_page_ids,
+    foreign_post_ids,
+    get_idempotent_response, reserve_idempotency_key, remember_idempotency_key, ingest_bundle,
+)
+from app.ingest_buffer import get_ingest_buffer
+from app.ingest_codec import batch_body, object_body
+from app.gap_service import check_gaps_for_pages, get_active_posts_for_pages, build_scan_plan, finalize_old_posts
 
 # Khởi tạo Router (thay vì app = FastAPI)
 router = APIRouter()
@@ -46,191 +52,232 @@ class PostMetricInput(BaseModel):
 class CheckSyncInput(BaseModel):
     page_id: str
 
+class BatchPagesInput(BaseModel):
+    page_ids: List[str]
+
+class BundleInput(BaseModel):
+    page_id: str
+    page_health: List[PageHealthInput] = []
+    posts: List[PostMetaInput] = []
+    post_metrics: List[PostMetricInput] = []
+
+class ScanPlanInput(BaseModel):
+    page_ids: List[str]
+    limit_per_page: Optional[int] = None
+
 # --- 2. API Endpoints (Thay @app.post bằng @router.post) ---
 
 @router.post("/sync/page-health")
 def sync_page_health(data: PageHealthInput, session: Session = Depends(get_session)):
-    try:
-        r_date = datetime.fromisoformat(data.record_date).date()
-    except:
-        r_date = datetime.utcnow().date()
-
-    existing = session.exec(
-        select(PageHealth)
-        .where(PageHealth.page_id == data.page_id)
-        .where(func.date(PageHealth.record_date) == r_date)
-    ).first()
-
-    if existing:
-        existing.followers_total = data.followers_total
-        existing.followers_new = data.followers_new
-        existing.unfollows = data.unfollows
-        existing.net_follows = data.net_follows
-        existing.total_reach = data.total_reach
-        existing.total_interaction = data.total_interaction
-        existing.link_clicks = data.link_clicks
-        session.add(existing)
-    else:
-        new_record = PageHealth(
-            page_id=data.page_id,
-            record_date=r_date,
-            followers_total=data.followers_total,
-            followers_new=data.followers_new,
-            unfollows=data.unfollows,
-            net_follows=data.net_follows,
-            total_reach=data.total_reach,
-            total_interaction=data.total_interaction,
-            link_clicks=data.link_clicks
-        )
-        session.add(new_record)
-    
-    # --- THÊM LOGIC CẬP NHẬT WATERMARK ---
-    # Sau khi lưu xong Health của ngày X, ta cập nhật mốc last_synced_date lên ngày X
-    try:
-        from app.models import PageConfig
-        current_date = datetime.fromisoformat(data.record_date)
-        
-        config = session.get(PageConfig, data.page_id)
-        if config:
-            # Chỉ cập nhật nếu ngày mới > ngày cũ (Tịnh tiến)
-            if not config.last_synced_date or current_date > config.last_synced_date:
-                config.last_synced_date = current_date
-                session.add(config)
-    except Exception as e:
-        print(f"Lỗi update watermark: {e}")
+    # Ngày sai format -> từ chối (không ghi bừa vào hôm nay và không làm lệch watermark)
+    if not parse_record_date(data.record_date):
+        raise HTTPException(status_code=400, detail="Invalid record_date. Use YYYY-MM-DD")
+    # Page chưa có trong DB -> báo lỗi thay vì bỏ qua im lặng (kể cả khi đi qua buffer)
+    if not existing_page_ids(session, [data.page_id]):
+        raise HTTPException(status_code=404, detail=f"Unknown page_id: {data.page_id}")
+
+    # Bật INGEST_BUFFER_ENABLED -> ghi spool rồi trả về, flusher ghi DB theo lô
+    buffer = get_ingest_buffer()
+    if buffer:
+        buffer.append("page_health", [data.dict()])
+        return {"success": True, "queued": 1, "msg": f"Đã nhận mốc ngày {data.record_date}"}
 
+    # Dùng chung đường ghi với batch: upsert theo (page_id, record_date) + tịnh tiến watermark
+    upsert_page_health(session, [data.dict()])
     session.commit()
     return {"success": True, "msg": f"Đã sync & update mốc ngày {data.record_date}"}
 
+# Các endpoint theo lô nhận body gzip / msgpack / dạng cột (xem app/ingest_codec.py)
+# Idempotency-Key (tùy chọn) cho các request theo lô: retry cùng key -> trả lại kết quả cũ, không ghi lại.
+# Ghi trực tiếp: key được giữ ngay lúc nhận request, cùng transaction với dữ liệu.
+# Qua buffer: key chỉ vào DB cùng transaction flush, trong lúc chờ flush buffer tự chặn request trùng key
+def _replayed_response(session: Session, endpoint: str, key: Optional[str], response: Optional[dict] = None):
+    cached = reserve_idempotency_key(session, endpoint, key, response)
+    if cached is None:
+        return None
+    session.rollback()
+    return {**cached, "duplicate": True}
+
+def _append_to_buffer(session: Session, buffer, kind: str, records: List[dict],
+                      endpoint: str, key: Optional[str], response: dict):
+    """
+    Key không bao giờ bền vững trước dữ liệu: spool + fsync trước, key ghi DB cùng lúc flush.
+    Kiểm key đang chờ flush trước rồi mới tới DB -> key flush xong giữa 2 bước vẫn thấy ở DB
+    """
+    cached = buffer.pending_response(endpoint, key)
+    if cached is None:
+        cached = get_idempotent_response(session, endpoint, key)
+    if cached is not None:
+        return {**cached, "duplicate": True}
+    buffer.append(kind, records, idempotency={"endpoint": endpoint, "key": key, "response": response})
+    return response
+
+@router.post("/sync/page-health/batch")
+def sync_page_health_batch(
+    records: List[PageHealthInput] = Depends(batch_body(PageHealthInput)),
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key"),
+    session: Session = Depends(get_session),
+):
+    """Nhiều (page_id, ngày) trong 1 request: 1 câu upsert / 1000 row + 1 câu update watermark, 1 commit"""
+    buffer = get_ingest_buffer()
+    if buffer:
+        # Lọc page chưa có trong DB ngay lúc nhận -> trả về unknown_pages như khi ghi trực tiếp
+        known = existing_page_ids(session, [r.page_id for r in records])
+        accepted = [r.dict() for r in records if r.page_id in known]
+        unknown_pages = sorted({r.page_id for r in records} - known)
+        response = {"success": True, "queued": len(accepted), "unknown_pages": unknown_pages}
+        return _append_to_buffer(session, buffer, "page_health", accepted,
+                                 "page-health-batch", idempotency_key, response)
+
+    replayed = _replayed_response(session, "page-health-batch", idempotency_key)
+    if replayed:
+        return replayed
+
+    res = upsert_page_health(session, [r.dict() for r in records])
+    response = {"success": True, **res}
+    remember_idempotency_key(session, "page-health-batch", idempotency_key, response)
+    session.commit()
+    return response
+
 @router.post("/sync/posts")
-def sync_posts_metadata(posts: List[PostMetaInput], session: Session = Depends(get_session)):
-    count_new = 0
-    for p in posts:
-        exists = session.get(PostMeta, p.post_id)
-        if not exists:
-            try:
-                c_time = datetime.fromisoformat(p.created_time.replace("Z", "+00:00"))
-            except:
-                c_time = datetime.utcnow()
-
-            new_meta = PostMeta(
-                post_id=p.post_id,
-                page_id=p.page_id,
-                created_time=c_time,
-                post_type=p.post_type,
-                permalink=p.permalink,
-                caption_snippet=p.caption_snippet,
-                folder_id=p.folder_id
-            )
-            session.add(new_meta)
-            count_new += 1
-            
+def sync_posts_metadata(
+    posts: List[PostMetaInput] = Depends(batch_body(PostMetaInput)),
+    update_existing: bool = True,
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key"),
+    session: Session = Depends(get_session),
+):
+    """Set-based: INSERT ... ON CONFLICT (post_id), không lookup từng bài"""
+    buffer = get_ingest_buffer()
+    # Buffer luôn ghi ở chế độ update_existing (upsert) -> request DO NOTHING vẫn ghi trực tiếp
+    if buffer and update_existing:
+        return _append_to_buffer(session, buffer, "posts", [p.dict() for p in posts],
+                                 "posts", idempotency_key, {"success": True, "queued": len(posts)})
+
+    replayed = _replayed_response(session, "posts", idempotency_key)
+    if replayed:
+        return replayed
+
+    res = upsert_post_meta(session, [p.dict() for p in posts], update_existing=update_existing)
+    response = {"success": True, **res}
+    remember_idempotency_key(session, "posts", idempotency_key, response)
     session.commit()
-    return {"success": True, "new_posts": count_new}
+    return response
 
 @router.post("/sync/post-metrics")
-def sync_post_metrics(metrics: List[PostMetricInput], session: Session = Depends(get_session)):
-    count = 0
-    for m in metrics:
-        if not session.get(PostMeta, m.post_id):
-            continue 
-
-        new_metric = PostMetric(
-            post_id=m.post_id,
-            updated_at=datetime.utcnow(),
-            reach=m.reach,
-            impressions=m.impressions,
-            reactions=m.reactions,
-            comments=m.comments,
-            shares=m.shares,
-            clicks=m.clicks,
-            other_clicks=m.other_clicks,
-            is_final=m.is_final
+def sync_post_metrics(
+    metrics: List[PostMetricInput] = Depends(batch_body(PostMetricInput)),
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key"),
+    session: Session = Depends(get_session),
+):
+    buffer = get_ingest_buffer()
+    if buffer:
+        response = {"success": True, "msg": f"Đã nhận {len(metrics)} metrics", "queued": len(metrics)}
+        return _append_to_buffer(session, buffer, "post_metrics", [m.dict() for m in metrics],
+                                 "post-metrics", idempotency_key, response)
+
+    replayed = _replayed_response(session, "post-metrics", idempotency_key)
+    if replayed:
+        return replayed
+
+    # Upsert snapshot mới nhất theo (post_id, ngày) + log thô tùy chọn, 1 commit.
+    # Chỉ số không đổi so với lần lưu trước (values_hash) -> bỏ qua, không ghi row mới
+    res = ingest_post_metrics(session, [m.dict() for m in metrics])
+    response = {"success": True, "msg": f"Đã lưu {res['saved']} metrics", **res}
+    remember_idempotency_key(session, "post-metrics", idempotency_key, response)
+    session.commit()
+    return response
+
+@router.post("/sync/bundle")
+def sync_bundle(
+    data: BundleInput = Depends(object_body(BundleInput)),
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key"),
+    session: Session = Depends(get_session),
+):
+    """
+    1 request / page thay cho page-health + posts + post-metrics + check-gaps:
+    ghi tất cả trong 1 transaction (bài -> chỉ số -> health/watermark), trả luôn các ngày còn thiếu.
+    """
+    foreign = {r.page_id for r in data.page_health} | {p.page_id for p in data.posts}
+    foreign.discard(data.page_id)
+    if foreign:
+        raise HTTPException(status_code=400, detail=f"Bundle chỉ chứa dữ liệu của page {data.page_id}")
+    # Chỉ số bài gắn page theo PostMeta đã lưu -> bài (kể cả trong posts[]) đã thuộc page khác thì từ chối
+    moved = foreign_post_ids(
+        session, [p.post_id for p in data.posts] + [m.post_id for m in data.post_metrics], data.page_id
+    )
+    if moved:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Bundle chứa bài của page khác (không phải {data.page_id}): {', '.join(moved[:20])}",
         )
-        session.add(new_metric)
-        count += 1
-        
+    if any(not parse_record_date(r.record_date) for r in data.page_health):
+        raise HTTPException(status_code=400, detail="Invalid record_date. Use YYYY-MM-DD")
+
+    replayed = _replayed_response(session, "bundle", idempotency_key)
+    if replayed:
+        return replayed
+
+    res = ingest_bundle(
+        session,
+        health=[r.dict() for r in data.page_health],
+        posts=[p.dict() for p in data.posts],
+        metrics=[m.dict() for m in data.post_metrics],
+    )
+    # Dò lỗ trên chính transaction này -> đã thấy dữ liệu vừa ghi
+    gaps = check_gaps_for_pages(session, [data.page_id])[data.page_id]
+    response = {"success": True, **res, "gaps": gaps}
+    remember_idempotency_key(session, "bundle", idempotency_key, response)
     session.commit()
-    return {"success": True, "msg": f"Đã lưu {count} metrics"}
+    return response
 
 @router.post("/sync/check-gaps")
 def check_sync_gaps(data: CheckSyncInput, session: Session = Depends(get_session)):
-    from app.models import PageConfig, Folder # Import lười để tránh vòng lặp
-    
-    # A. Kiểm tra Điều kiện Folder (Post + Story)
-    config = session.get(PageConfig, data.page_id)
-    # Nếu chưa config hoặc không có folder -> Loại
-    if not config or not config.folder_ids:
-        return {"eligible": False, "reason": "No config"}
-    
-    # Parse JSON folder_ids
-    import json
-    try:
-        f_ids = json.loads(config.folder_ids) if isinstance(config.folder_ids, str) else config.folder_ids
-    except:
-        f_ids = []
-        
-    if not f_ids:
-        return {"eligible": False, "reason": "No folders"}
+    # Cùng logic với bản batch (điều kiện folder POST + STORY, ngày thiếu sau watermark)
+    return check_gaps_for_pages(session, [data.page_id])[data.page_id]
 
-    # Query DB để xem tên các folder này có đúng chuẩn không
-    folders = session.exec(select(Folder).where(Folder.id.in_(f_ids))).all()
-    
-    has_post = any(f.name.upper().endswith("_POST") for f in folders)
-    has_story = any(f.name.upper().endswith("_STORY") for f in folders)
-    
-    # Điều kiện bắt buộc: Phải có cả POST và STORY
-    if not (has_post and has_story):
-        return {"eligible": False, "reason": "Missing POST or STORY folder"}
+@router.post("/sync/check-gaps/batch")
+def check_sync_gaps_batch(data: BatchPagesInput, session: Session = Depends(get_session)):
+    """Nhiều page trong 1 request: 1 query PageConfig + 1 query Folder cho cả lô"""
+    return {"pages": check_gaps_for_pages(session, data.page_ids)}
 
-    # 2. LOGIC WATERMARK MỚI
-    today = datetime.utcnow().date()
-    yesterday = today - timedelta(days=1)
-    
-    # Xác định mốc bắt đầu
-    start_date = None
-    if config.last_synced_date:
-        # Bắt đầu từ ngày tiếp theo của mốc
-        start_date = config.last_synced_date.date() + timedelta(days=1)
-    else:
-        # Nếu chưa có mốc, lấy 14 ngày trước
-        start_date = today - timedelta(days=14)
-
-    missing_dates = []
-    
-    # Nếu mốc đã là hôm qua -> Không cần làm gì
-    if start_date > yesterday:
-        return {"eligible": True, "missing_dates": []}
-
-    # Tạo danh sách các ngày cần bù (từ start_date đến yesterday)
-    delta = yesterday - start_date
-    for i in range(delta.days + 1):
-        day = start_date + timedelta(days=i)
-        missing_dates.append(day.strftime("%Y-%m-%d"))
-            
+@router.get("/sync/active-posts")
+def get_active_posts(page_id: str, session: Session = Depends(get_session)):
+    # Các bài (không phải story) đăng trong 7 ngày gần nhất
+    posts = get_active_posts_for_pages(session, [page_id])[page_id]
+    return {"count": len(posts), "posts": posts}
+
+@router.post("/sync/active-posts/batch")
+def get_active_posts_batch(data: BatchPagesInput, session: Session = Depends(get_session)):
+    """Bài cần quét của nhiều page trong 1 query (dùng partial index page_id, created_time)"""
+    pages = get_active_posts_for_pages(session, data.page_ids)
     return {
-        "eligible": True,
-        "missing_dates": missing_dates
+        "count": sum(len(posts) for posts in pages.values()),
+        "pages": {pid: {"count": len(posts), "posts": posts} for pid, posts in pages.items()},
     }
 
-@router.get("/sync/active-posts")
-def get_active_posts(page_id: str, session: Session = Depends(get_session)):
-    # Lấy các bài đăng trong 7 ngày gần nhất
-    seven_days_ago = datetime.utcnow() - timedelta(days=7)
-    
-    posts = session.exec(
-        select(PostMeta.post_id, PostMeta.created_time)
-        .where(PostMeta.page_id == page_id)
-        .where(PostMeta.created_time >= seven_days_ago)
-        .where(PostMeta.post_type != "STORY") # <--- DÒNG NÀY QUAN TRỌNG NHẤT
-    ).all()
-    
-    # Trả về danh sách object
+@router.post("/sync/scan-plan")
+def get_scan_plan(data: ScanPlanInput, session: Session = Depends(get_session)):
+    """
+    Thay cho active-posts khi quét chỉ số: chỉ trả bài thật sự cần quét lại
+    (bài mới quét dày, bài cũ thưa, bài final bỏ qua), sắp theo độ ưu tiên.
+    """
+    finalized = finalize_old_posts(session, data.page_ids)
+    session.commit()
+    pages = build_scan_plan(session, data.page_ids, data.limit_per_page)
     return {
-        "count": len(posts),
-        "posts": [{"post_id": p[0], "created_time": p[1].isoformat()} for p in posts]
+        "count": sum(len(posts) for posts in pages.values()),
+        "finalized": finalized,
+        "pages": {pid: {"count": len(posts), "posts": posts} for pid, posts in pages.items()},
     }
 
+@router.get("/sync/buffer")
+def get_ingest_buffer_stats():
+    """Thống kê buffer ghi của process này (dead_letters > 0 -> có entry lỗi dữ liệu trong spool-*.dead)"""
+    buffer = get_ingest_buffer()
+    if not buffer:
+        return {"active": False}
+    return {"active": True, **buffer.stats}
+
 class FolderPerformance(BaseModel):
     folder_id: str
     folder_name: str
@@ -6,6 +6,7 @@ from typing import List, Optional
 from app.database import get_session
 from app.models import Folder
 from app.content_service import save_page_config, get_all_configs, test_content_generation
+from app.stats_cache import invalidate_all
 
 router = APIRouter()
 
@@ -24,7 +25,9 @@ def api_get_configs(session: Session = Depends(get_session)):
 
 @router.post("/")
 def api_save_config(data: PageConfigInput, session: Session = Depends(get_session)):
-    return save_page_config(session, data.dict())
+    result = save_page_config(session, data.dict())
+    invalidate_all()  # Tên page / folder đổi -> kết quả /stats đã cache không còn đúng
+    return result
 
 @router.get("/folders/simple")
 def api_get_folders_simple(session: Session = Depends(get_session)):
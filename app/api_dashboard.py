@@ -1,16 +1,18 @@
 # app/api_dashboard.py
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException
 from fastapi.responses import StreamingResponse  # Proxy ảnh Drive
 from sqlmodel import Session, select, func
 from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime
 
-from app.database import get_session, engine
+from app.database import get_session
 # [QUAN TRỌNG] Thêm FolderCaption vào dòng import này
-from app.models import Folder, Image, FolderCaption
-from app.sync_service import sync_folder_structure, sync_images_in_folder, sync_all_folders
-from app.drive_service import download_image_from_drive
+from app.models import Folder, Image, FolderCaption, SyncJob
+from app.sync_service import sync_folder_structure, sync_images_in_folder
+from app.sync_jobs import enqueue_full_sync, job_to_dict
+from app.rendition_service import request_rendition_backfill
+from app.drive_service import download_image_from_drive, open_image_stream
 
 router = APIRouter()
 
@@ -75,20 +77,53 @@ def trigger_sync_folder(folder_id: str, session: Session = Depends(get_session))
     return {"status": "success", "data": sync_images_in_folder(session, folder_id)}
 
 @router.post("/sync/all")
-def trigger_sync_all(background_tasks: BackgroundTasks):
-    def _bg():
-        with Session(engine) as s: sync_all_folders(s)
-    background_tasks.add_task(_bg)
-    return {"status": "started", "message": "Sync All đang chạy ngầm..."}
+def trigger_sync_all(session: Session = Depends(get_session)):
+    """Đưa job Sync All vào hàng đợi. Nếu đang có job chạy -> trả về job đó, không tạo trùng"""
+    job, created = enqueue_full_sync(session)
+    return {
+        "status": "started" if created else "already_running",
+        "job_id": job.id,
+        "message": "Sync All đã vào hàng đợi" if created else f"Job #{job.id} đang chạy, không tạo thêm",
+        "job": job_to_dict(job),
+    }
+
+@router.post("/sync/renditions/backfill")
+def trigger_rendition_backfill(session: Session = Depends(get_session)):
+    """Render sẵn cả ảnh cũ (trước mốc bật rendition). Sync worker chạy dần từng lô"""
+    request_rendition_backfill(session)
+    return {"status": "started", "message": "Đã yêu cầu render toàn bộ thư viện ảnh"}
+
+@router.get("/sync/jobs")
+def list_sync_jobs(limit: int = 20, session: Session = Depends(get_session)):
+    jobs = session.exec(select(SyncJob).order_by(SyncJob.id.desc()).limit(min(limit, 100))).all()
+    return [job_to_dict(j) for j in jobs]
+
+@router.get("/sync/jobs/{job_id}")
+def get_sync_job(job_id: int, session: Session = Depends(get_session)):
+    """Dashboard poll 1 row này để biết tiến độ sync"""
+    job = session.get(SyncJob, job_id)
+    if not job: raise HTTPException(404, "Job not found")
+    return job_to_dict(job)
 
 
 # --- API MỚI: PROXY ẢNH DRIVE ---
 @router.get("/proxy-image/{file_id}")
-def proxy_drive_image(file_id: str):
+def proxy_drive_image(file_id: str, session: Session = Depends(get_session)):
     """
     Backend lấy ảnh từ Drive và stream thẳng về trình duyệt.
     Không lưu file vào ổ cứng.
     """
+    # Ảnh đã sync -> stream từng chunk, Content-Length theo Drive trả về (size_bytes lúc sync có thể đã cũ)
+    image = session.get(Image, file_id)
+    opened = open_image_stream(file_id) if image else None
+    if opened:
+        chunks, total_size = opened
+        return StreamingResponse(
+            chunks,
+            media_type=image.mime_type or "image/jpeg",
+            headers={"Content-Length": str(total_size)} if total_size else None,
+        )
+
     image_stream = download_image_from_drive(file_id)
 
     if not image_stream:
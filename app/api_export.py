@@ -0,0 +1,287 @@
+"""
+Export API: xuất dữ liệu analytics ra file cho Analyst (CSV / NDJSON / Parquet)
+- Stream từng lô từ server-side cursor (stream_results + yield_per) -> RAM cố định dù bao nhiêu row
+- CSV / NDJSON ghi dần theo lô, Parquet ghi mỗi lô thành 1 row group
+- Tôn trọng phạm vi page của user (ANALYST chỉ thấy page được cấp quyền)
+Parquet cần pyarrow (tùy chọn), không có -> 501
+"""
+import io
+import os
+import csv
+import json
+from datetime import date
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sqlmodel import Session, text
+
+from app.database import engine
+from app.api_auth import get_optional_user
+from app.api_stats import get_default_date_range, followers_days, get_active_pages_cte
+from app.models_auth import User
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+router = APIRouter()
+
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "5000"))
+
+MEDIA_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+# (tên cột, kiểu) theo đúng thứ tự SELECT. Kiểu dùng cho schema Parquet
+Columns = Sequence[Tuple[str, str]]
+
+RANKING_COLUMNS: Columns = (
+    ("page_id", "str"), ("page_name", "str"), ("reco_status", "str"),
+    ("reach", "int"), ("impressions", "int"), ("clicks", "int"), ("engagement", "int"),
+    ("ctr", "float"), ("followers_total", "int"), ("followers_delta", "int"),
+)
+POST_COLUMNS: Columns = (
+    ("post_id", "str"), ("page_id", "str"), ("local_day", "date"), ("updated_at", "datetime"),
+    ("post_type", "str"), ("created_time", "datetime"), ("permalink", "str"), ("caption_snippet", "str"),
+    ("reach", "int"), ("impressions", "int"), ("reactions", "int"), ("comments", "int"),
+    ("shares", "int"), ("clicks", "int"), ("other_clicks", "int"), ("is_final", "bool"),
+)
+HEALTH_COLUMNS: Columns = (
+    ("page_id", "str"), ("record_date", "date"),
+    ("followers_total", "int"), ("followers_new", "int"), ("unfollows", "int"), ("net_follows", "int"),
+    ("total_reach", "int"), ("total_interaction", "int"), ("link_clicks", "int"),
+)
+
+# ============================================================================
+# HELPERS
+# ============================================================================
+
+def parse_range(start: Optional[str], end: Optional[str]) -> Tuple[Optional[date], Optional[date]]:
+    try:
+        return (date.fromisoformat(start) if start else None, date.fromisoformat(end) if end else None)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
+
+
+def resolve_scope(current_user: Optional[User], page_id: Optional[str]) -> Optional[List[str]]:
+    """Danh sách page được xuất (None = mọi page). ANALYST: chỉ page được cấp quyền"""
+    if current_user and current_user.role != "ADMIN":
+        allowed = list(current_user.accessible_page_ids)
+        if page_id:
+            if page_id not in allowed:
+                raise HTTPException(status_code=403, detail="You don't have access to this page")
+            return [page_id]
+        return allowed
+    return [page_id] if page_id else None
+
+
+def check_format(fmt: str):
+    if fmt not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Invalid format. Use: {set(MEDIA_TYPES)}")
+    if fmt == "parquet" and pa is None:
+        raise HTTPException(status_code=501, detail="Parquet export requires pyarrow on the server")
+
+
+def stream_batches(sql: str, params: Dict[str, Any]) -> Iterator[List[tuple]]:
+    """Session riêng (session của request đã đóng khi response bắt đầu stream), đọc bằng server-side cursor"""
+    with Session(engine) as session:
+        conn = session.connection(execution_options={"stream_results": True, "yield_per": EXPORT_BATCH_ROWS})
+        result = conn.execute(text(sql), params)
+        for partition in result.partitions():
+            yield [tuple(row) for row in partition]
+
+
+def _csv_chunks(columns: Columns, batches: Iterator[List[tuple]]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM để Excel đọc đúng tiếng Việt
+    buffer.write("\ufeff")
+    writer.writerow([name for name, _ in columns])
+    for batch in batches:
+        writer.writerows(batch)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def _ndjson_chunks(columns: Columns, batches: Iterator[List[tuple]]) -> Iterator[bytes]:
+    names = [name for name, _ in columns]
+    for batch in batches:
+        lines = [json.dumps(dict(zip(names, row)), ensure_ascii=False, default=str) for row in batch]
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+class _DrainSink(io.RawIOBase):
+    """File-like chỉ giữ phần bytes chưa gửi đi: ParquetWriter ghi vào, generator lấy ra sau mỗi row group"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _arrow_schema(columns: Columns):
+    types = {
+        "str": pa.string(), "int": pa.int64(), "float": pa.float64(),
+        "date": pa.date32(), "datetime": pa.timestamp("us"), "bool": pa.bool_(),
+    }
+    return pa.schema([(name, types[kind]) for name, kind in columns])
+
+
+def _parquet_chunks(columns: Columns, batches: Iterator[List[tuple]]) -> Iterator[bytes]:
+    schema = _arrow_schema(columns)
+    sink = _DrainSink()
+    writer = pq.ParquetWriter(sink, schema, compression="snappy")
+    try:
+        for batch in batches:
+            arrays = [pa.array([row[i] for row in batch], type=field.type) for i, field in enumerate(schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def export_response(name: str, fmt: str, columns: Columns, sql: str, params: Dict[str, Any]) -> StreamingResponse:
+    encoders = {"csv": _csv_chunks, "ndjson": _ndjson_chunks, "parquet": _parquet_chunks}
+    body = encoders[fmt](columns, stream_batches(sql, params))
+    return StreamingResponse(
+        body,
+        media_type=MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{fmt}"'},
+    )
+
+# ============================================================================
+# ENDPOINTS
+# ============================================================================
+
+@router.get("/pages")
+def export_page_ranking(
+    start: Optional[str] = Query(None, description="YYYY-MM-DD, mặc định 7 ngày gần nhất"),
+    end: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    fmt: str = Query("csv", alias="format", description="csv|ndjson|parquet"),
+    current_user: Optional[User] = Depends(get_optional_user)
+):
+    """Tổng chỉ số từng page active trong khoảng ngày (cùng nguồn rollup + lọc active page với /stats/pages, không phân trang)"""
+    check_format(fmt)
+    start_date, end_date = parse_range(start, end)
+    if not (start_date and end_date):
+        start_date, end_date = get_default_date_range()
+    scope = resolve_scope(current_user, None)
+
+    sql = f"""
+        WITH {get_active_pages_cte()}
+        SELECT
+            p.page_id,
+            p.page_name,
+            COALESCE(pc.current_reco_status, 'UNKNOWN') AS reco_status,
+            COALESCE(t.reach, 0)::bigint AS reach,
+            COALESCE(t.impressions, 0)::bigint AS impressions,
+            COALESCE(t.clicks, 0)::bigint AS clicks,
+            COALESCE(t.engagement, 0)::bigint AS engagement,
+            CASE WHEN t.reach > 0 THEN round(t.clicks::numeric / t.reach * 100, 2)::float ELSE 0 END AS ctr,
+            COALESCE(fe.followers_asof, 0) AS followers_total,
+            COALESCE(fe.followers_asof, 0) - COALESCE(fs.followers_asof, 0) AS followers_delta
+        FROM active_pages p
+        JOIN page_configs pc ON pc.page_id = p.page_id
+        LEFT JOIN (
+            SELECT page_id, SUM(reach) AS reach, SUM(impressions) AS impressions,
+                   SUM(clicks) AS clicks, SUM(engagement) AS engagement
+            FROM page_daily_stats
+            WHERE day BETWEEN :start_date AND :end_date
+            GROUP BY page_id
+        ) t ON t.page_id = p.page_id
+        LEFT JOIN page_daily_stats fs ON fs.page_id = p.page_id AND fs.day = :followers_start_day
+        LEFT JOIN page_daily_stats fe ON fe.page_id = p.page_id AND fe.day = :followers_end_day
+        {"WHERE p.page_id = ANY(:page_ids)" if scope is not None else ""}
+        ORDER BY reach DESC, p.page_id
+    """
+    params = {"start_date": start_date, "end_date": end_date, **followers_days(start_date, end_date)}
+    if scope is not None:
+        params["page_ids"] = scope
+    return export_response(f"page_ranking_{start_date}_{end_date}", fmt, RANKING_COLUMNS, sql, params)
+
+
+@router.get("/posts")
+def export_post_snapshots(
+    page_id: Optional[str] = Query(None),
+    start: Optional[str] = Query(None, description="YYYY-MM-DD, bỏ trống = toàn bộ lịch sử"),
+    end: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    fmt: str = Query("csv", alias="format", description="csv|ndjson|parquet"),
+    current_user: Optional[User] = Depends(get_optional_user)
+):
+    """Snapshot chỉ số bài theo ngày (analytics_post_daily) kèm metadata bài"""
+    check_format(fmt)
+    start_date, end_date = parse_range(start, end)
+    scope = resolve_scope(current_user, page_id)
+
+    sql = f"""
+        SELECT
+            pd.post_id, pd.page_id, pd.local_day, pd.updated_at,
+            am.post_type, am.created_time, am.permalink, am.caption_snippet,
+            pd.reach, pd.impressions, pd.reactions, pd.comments,
+            pd.shares, pd.clicks, pd.other_clicks, pd.is_final
+        FROM analytics_post_daily pd
+        JOIN analytics_post_meta am ON am.post_id = pd.post_id
+        WHERE pd.local_day BETWEEN :start_date AND :end_date
+          {"AND pd.page_id = ANY(:page_ids)" if scope is not None else ""}
+        ORDER BY pd.page_id, pd.local_day, pd.post_id
+    """
+    params = {"start_date": start_date or date.min, "end_date": end_date or date.max}
+    if scope is not None:
+        params["page_ids"] = scope
+    return export_response(f"post_snapshots_{start_date or 'all'}_{end_date or 'all'}", fmt, POST_COLUMNS, sql, params)
+
+
+@router.get("/page-health")
+def export_page_health(
+    page_id: Optional[str] = Query(None),
+    start: Optional[str] = Query(None, description="YYYY-MM-DD, bỏ trống = toàn bộ lịch sử"),
+    end: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    fmt: str = Query("csv", alias="format", description="csv|ndjson|parquet"),
+    current_user: Optional[User] = Depends(get_optional_user)
+):
+    """Lịch sử page health theo ngày (analytics_page_health)"""
+    check_format(fmt)
+    start_date, end_date = parse_range(start, end)
+    scope = resolve_scope(current_user, page_id)
+
+    sql = f"""
+        SELECT
+            page_id, CAST(record_date AS DATE) AS record_date,
+            followers_total, followers_new, unfollows, net_follows,
+            total_reach, total_interaction, link_clicks
+        FROM analytics_page_health
+        WHERE record_date BETWEEN CAST(:start_date AS TIMESTAMP) AND CAST(:end_date AS TIMESTAMP)
+          {"AND page_id = ANY(:page_ids)" if scope is not None else ""}
+        ORDER BY page_id, record_date
+    """
+    params = {"start_date": start_date or date.min, "end_date": end_date or date.max}
+    if scope is not None:
+        params["page_ids"] = scope
+    return export_response(f"page_health_{start_date or 'all'}_{end_date or 'all'}", fmt, HEALTH_COLUMNS, sql, params)
@@ -1,14 +1,39 @@
 # app/api_extension.py
 from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi.responses import StreamingResponse, FileResponse
 from sqlmodel import Session
 from app.database import get_session
-from app.drive_service import download_image_from_drive
+from app.models import Image
+from app.drive_service import download_image_from_drive, open_image_stream
 from app.content_service import generate_regular_post, generate_story_post
+from app.rendition_service import get_rendition_for_image
 
 router = APIRouter()
 
 @router.get("/image/{file_id}")
-def get_image_proxy(file_id: str):
+def get_image_proxy(file_id: str, original: bool = False, session: Session = Depends(get_session)):
+    # Mặc định trả bản render sẵn (POST ~1080px / STORY 1080x1920) -> nhẹ hơn nhiều so với ảnh gốc
+    if not original:
+        rendition = get_rendition_for_image(session, file_id)
+        if rendition:
+            return FileResponse(
+                rendition.path,
+                media_type="image/jpeg",
+                headers={"ETag": f'"{rendition.content_hash}"', "Cache-Control": "public, max-age=86400"},
+            )
+
+    # Đã biết mime từ lúc sync -> stream từng chunk từ Drive
+    # Content-Length lấy theo Drive trả về (size_bytes lúc sync có thể đã cũ)
+    image = session.get(Image, file_id)
+    opened = open_image_stream(file_id) if image and image.mime_type else None
+    if opened:
+        chunks, total_size = opened
+        return StreamingResponse(
+            chunks,
+            media_type=image.mime_type,
+            headers={"Content-Length": str(total_size)} if total_size else None,
+        )
+
     image_stream = download_image_from_drive(file_id)
     if not image_stream:
         # Trả về 404 nếu không tìm thấy ảnh
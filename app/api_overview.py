@@ -1,11 +1,11 @@
 from fastapi import APIRouter, Depends
-from sqlmodel import Session, select, func
+from sqlmodel import Session, select, func, text
 from datetime import datetime, timedelta
 from typing import List, Optional
 from pydantic import BaseModel
 
 from app.database import get_session
-from app.models import Page, PageHealth, PostMeta
+from app.models import Page, PageDailyStats, PostMeta
 
 router = APIRouter()
 
@@ -71,19 +71,19 @@ def get_dashboard_overview(session: Session = Depends(get_session)):
         "followers": 0, "reach": 0, "interactions": 0
     }
 
-    # Lấy record của 24h qua
-    yesterday = datetime.utcnow() - timedelta(days=1)
+    # Lấy record của 24h qua (ngày có record_date >= now - 24h)
+    since_day = (datetime.utcnow() - timedelta(days=1)).date() + timedelta(days=1)
 
-    # Query tổng 24h từ PageHealth - WRAP TRY-EXCEPT
+    # Query tổng 24h từ rollup page_daily_stats - WRAP TRY-EXCEPT
     try:
         sum_24h = session.exec(
             select(
-                func.sum(PageHealth.link_clicks),
-                func.sum(PageHealth.total_reach),
-                func.sum(PageHealth.followers_total),
-                func.sum(PageHealth.total_interaction)
+                func.sum(PageDailyStats.clicks),
+                func.sum(PageDailyStats.reach),
+                func.sum(PageDailyStats.followers_total),
+                func.sum(PageDailyStats.engagement)
             )
-            .where(PageHealth.record_date >= yesterday)
+            .where(PageDailyStats.day >= since_day)
         ).first()
 
         if sum_24h:
@@ -92,9 +92,35 @@ def get_dashboard_overview(session: Session = Depends(get_session)):
             metrics_24h["followers"] = sum_24h[2] or 0
             metrics_24h["interactions"] = sum_24h[3] or 0
     except Exception as e:
-        print(f"Error querying PageHealth: {e}")
+        print(f"Error querying page_daily_stats: {e}")
         # Keep defaults (all 0)
 
+    # Số bài gần đây + health mới nhất của TẤT CẢ page: 2 query thay vì 2 query / page
+    recent_posts = {}
+    try:
+        recent_posts = dict(session.exec(
+            select(PostMeta.page_id, func.count(PostMeta.post_id))
+            .where(PostMeta.created_time >= critical_threshold)
+            .group_by(PostMeta.page_id)
+        ).all())
+    except Exception as e:
+        # Bảng PostMeta có thể chưa có data hoặc lỗi query
+        print(f"Warning: PostMeta query failed: {e}")
+        recent_posts = None
+
+    latest_health = {}
+    try:
+        # Ngày gần nhất có page health (followers_total NULL = ngày chỉ có snapshot bài)
+        rows = session.exec(text("""
+            SELECT DISTINCT ON (page_id) page_id, followers_total, reach, engagement
+            FROM page_daily_stats
+            WHERE followers_total IS NOT NULL
+            ORDER BY page_id, day DESC
+        """)).fetchall()
+        latest_health = {r.page_id: r for r in rows}
+    except Exception as e:
+        print(f"Error fetching latest page_daily_stats: {e}")
+
     # 2. Xử lý từng Page
     active_count = 0
     critical_count = 0
@@ -116,46 +142,24 @@ def get_dashboard_overview(session: Session = Depends(get_session)):
             # Nếu parse lỗi, skip
             pass
 
-        # Check Critical từ PostMeta - WRAP TRY-EXCEPT
-        try:
-            has_post_recent = session.exec(
-                select(func.count(PostMeta.post_id))
-                .where(PostMeta.page_id == page.page_id)
-                .where(PostMeta.created_time >= critical_threshold)
-            ).one()
-            
-            if has_post_recent == 0:
-                is_critical = True
-        except Exception as e:
-            # Bảng PostMeta có thể chưa có data hoặc lỗi query
-            print(f"Warning: PostMeta query failed for {page.page_id}: {e}")
-            pass
+        # Check Critical từ PostMeta (không có bài nào trong 3 ngày)
+        if recent_posts is not None and not recent_posts.get(page.page_id):
+            is_critical = True
         
         if is_critical:
             critical_count += 1
 
-        # Lấy health mới nhất của từng page - WRAP TRY-EXCEPT
-        followers_curr = 0
-        reach_curr = 0
-        interact_curr = 0
-        
-        try:
-            latest_health = session.exec(
-                select(PageHealth)
-                .where(PageHealth.page_id == page.page_id)
-                .order_by(PageHealth.record_date.desc())
-            ).first()
-
-            if latest_health:
-                followers_curr = latest_health.followers_total or 0
-                reach_curr = latest_health.total_reach or 0
-                interact_curr = latest_health.total_interaction or 0
-            else:
-                # Fallback to page.followers if exists
-                followers_curr = getattr(page, 'followers', 0) or 0
-        except Exception as e:
-            print(f"Error fetching PageHealth for {page.page_id}: {e}")
+        # Health mới nhất của page
+        health = latest_health.get(page.page_id)
+        if health:
+            followers_curr = health.followers_total or 0
+            reach_curr = health.reach or 0
+            interact_curr = health.engagement or 0
+        else:
+            # Fallback to page.followers if exists
             followers_curr = getattr(page, 'followers', 0) or 0
+            reach_curr = 0
+            interact_curr = 0
 
         # Cộng dồn chỉ số hiện tại (Latest Metrics)
         metrics_latest["followers"] += followers_curr
@@ -9,6 +9,7 @@ import os
 from app.database import get_session
 from app.models import Page, PageConfig, Folder, PageHealth  # Import thêm PageHealth
 from app.telegram_service import send_telegram_alert
+from app.stats_cache import invalidate_all
 from app.api_auth import get_optional_user
 from app.models_auth import User
 
@@ -143,6 +144,8 @@ def update_page_config(page_id: str, data: ConfigUpdate, session: Session = Depe
         config.note = data.note
     session.add(config)
     session.commit()
+    # Config folder đổi -> danh sách active page của /stats đổi
+    invalidate_all()
     return {"status": "success"}
 
 # ... (Giữ nguyên phần PageInput và create_pages_bulk ở dưới)
@@ -179,6 +182,7 @@ def create_pages_bulk(pages: List[PageInput], session: Session = Depends(get_ses
             count_new += 1
             
     session.commit()
+    invalidate_all()
     return {
         "status": "success",
         "message": f"Synced {len(pages)} pages",
@@ -241,5 +245,6 @@ def update_page_status_api(data: PageStatusInput, session: Session = Depends(get
     
     session.add(config)
     session.commit()
+    invalidate_all()
     
     return {"status": "success", "alert": bool(alert_msg)}
\ No newline at end of file
@@ -2,6 +2,8 @@
 Stats API for Facebook Page Analytics Dashboard
 Provides page ranking, detail views, and top posts analysis
 """
+import json
+import base64
 from datetime import date, datetime, timedelta
 from typing import Optional, List, Dict, Any
 from fastapi import APIRouter, Depends, HTTPException, Query
@@ -11,6 +13,10 @@ from pydantic import BaseModel
 from app.database import get_session
 from app.api_auth import get_optional_user
 from app.models_auth import User
+from app.ingest_service import local_today
+from app.stats_cache import (
+    make_cache_key, get_cached_response, cache_response, cached_value, current_data_version, stats_cache,
+)
 
 router = APIRouter()
 
@@ -18,6 +24,12 @@ router = APIRouter()
 # RESPONSE MODELS
 # ============================================================================
 
+class MetricComparison(BaseModel):
+    current: int = 0
+    previous: int = 0
+    delta: int = 0
+    delta_pct: Optional[float] = None  # None khi kỳ trước = 0
+
 class PageRankingItem(BaseModel):
     page_id: str
     page_name: str
@@ -33,6 +45,7 @@ class PageRankingItem(BaseModel):
     clicks_percentile: float = 0.0
     impressions_percentile: float = 0.0
     engagement_percentile: float = 0.0
+    comparison: Optional[Dict[str, MetricComparison]] = None
 
 class PageRankingResponse(BaseModel):
     meta: Dict[str, Any]
@@ -65,6 +78,7 @@ class PageDetailResponse(BaseModel):
     timeseries: List[TimeseriesPoint] = []
     top_posts: List[TopPost] = []
     summary: Dict[str, int] = {}
+    comparison: Optional[Dict[str, MetricComparison]] = None
 
 class TopPostsResponse(BaseModel):
     meta: Dict[str, Any]
@@ -75,11 +89,71 @@ class TopPostsResponse(BaseModel):
 # ============================================================================
 
 def get_default_date_range() -> tuple:
-    """Get default Last 7 days range"""
-    end = date.today()
+    """Get default Last 7 days range (ngày local theo STATS_UTC_OFFSET_HOURS, cùng cách tính local_day lúc ingest)"""
+    end = local_today()
     start = end - timedelta(days=6)  # 7 days inclusive
     return start, end
 
+# Cột được phép sort (tên cột nội suy thẳng vào SQL -> bắt buộc whitelist)
+RANKING_SORT_COLUMNS = {
+    "reach", "impressions", "clicks", "engagement", "ctr", "followers_total", "followers_delta",
+    "reach_percentile", "impressions_percentile", "clicks_percentile", "engagement_percentile", "page_name",
+}
+
+# So sánh kỳ này / kỳ trước: các metric cộng dồn được từ page_daily_stats
+COMPARE_METRICS = ("reach", "impressions", "clicks", "engagement")
+RANKING_DELTA_SORT_COLUMNS = {f"{m}_delta" for m in COMPARE_METRICS}
+
+def parse_compare_range(compare_start: Optional[str], compare_end: Optional[str]) -> tuple:
+    """(compare_start, compare_end) dạng date, (None, None) nếu không so sánh"""
+    if not compare_start and not compare_end:
+        return None, None
+    if not (compare_start and compare_end):
+        raise HTTPException(status_code=400, detail="compare_start and compare_end must be given together")
+    try:
+        cs, ce = date.fromisoformat(compare_start), date.fromisoformat(compare_end)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid compare date format. Use YYYY-MM-DD")
+    if cs > ce:
+        raise HTTPException(status_code=400, detail="compare_start must be <= compare_end")
+    return cs, ce
+
+def build_comparison(current: Dict[str, int], previous: Dict[str, int]) -> Dict[str, MetricComparison]:
+    result = {}
+    for m in COMPARE_METRICS:
+        cur, prev = int(current.get(m) or 0), int(previous.get(m) or 0)
+        result[m] = MetricComparison(
+            current=cur,
+            previous=prev,
+            delta=cur - prev,
+            delta_pct=round((cur - prev) * 100 / prev, 2) if prev else None,
+        )
+    return result
+
+def followers_days(start_date: date, end_date: date) -> Dict[str, date]:
+    """Ngày tra followers_asof: chuỗi carry-forward chỉ kéo tới ngày mai -> ngày tương lai kẹp về hôm nay"""
+    today = local_today()
+    return {"followers_start_day": min(start_date, today), "followers_end_day": min(end_date, today)}
+
+def encode_cursor(value: Any, key: str) -> str:
+    """Cursor keyset mờ: (giá trị cột sort, id tie-break) -> base64. Giá trị giữ dạng chuỗi để so sánh chính xác"""
+    raw = json.dumps({"v": None if value is None else str(value), "k": key}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Dict[str, Any]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return {"v": data["v"], "k": str(data["k"])}
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def keyset_clause(column: str, direction: str, id_column: str, value_cast: str) -> str:
+    """Điều kiện "sau cursor" cho ORDER BY column {direction}, id_column ASC"""
+    op = "<" if direction == "DESC" else ">"
+    value = f"CAST(:cursor_value AS {value_cast})"
+    return f"({column} {op} {value} OR ({column} = {value} AND {id_column} > :cursor_key))"
+
 def get_active_pages_cte() -> str:
     """Returns SQL CTE for active pages logic - pages with both _POST and _STORY folders"""
     return """
@@ -116,10 +190,14 @@ def get_page_ranking(
     sort: str = Query("reach.desc", description="Sort format: metric.asc|desc"),
     page: int = Query(1, ge=1),
     per: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = Query(None, description="Keyset cursor (meta.next_cursor của trang trước), thay cho page"),
+    include_total: bool = Query(True, description="False -> bỏ qua đếm tổng"),
     # --- CÁC THAM SỐ MỚI CHO FILTER ---
     search: Optional[str] = Query(None, description="Search by name or ID"),
     reco: Optional[str] = Query("ALL", description="Filter by reco: RECOMMENDED, NOT_RECOMMENDED, UNKNOWN"),
     size: Optional[str] = Query("ALL", description="Filter by size: SMALL, MEDIUM, LARGE"),
+    compare_start: Optional[str] = Query(None, description="Kỳ so sánh YYYY-MM-DD (vd: tuần trước)"),
+    compare_end: Optional[str] = Query(None, description="Kỳ so sánh YYYY-MM-DD"),
     session: Session = Depends(get_session),
     current_user: Optional[User] = Depends(get_optional_user)
 ):
@@ -137,17 +215,24 @@ def get_page_ranking(
             raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
     else:
         start_date, end_date = get_default_date_range()
+    compare_start_date, compare_end_date = parse_compare_range(compare_start, compare_end)
+    comparing = compare_start_date is not None
     
-    # 2. Xử lý Sort
+    # 2. Xử lý Sort (sort theo <metric>_delta chỉ có nghĩa khi có kỳ so sánh)
     sort_parts = sort.split(".")
-    if len(sort_parts) != 2:
+    if len(sort_parts) == 2 and sort_parts[0] in RANKING_DELTA_SORT_COLUMNS and not comparing:
+        raise HTTPException(status_code=400, detail="Sorting by delta requires compare_start and compare_end")
+    sortable = RANKING_SORT_COLUMNS | (RANKING_DELTA_SORT_COLUMNS if comparing else set())
+    if len(sort_parts) != 2 or sort_parts[0] not in sortable:
         sort_metric = "reach"
         sort_direction = "DESC"
     else:
         sort_metric, sort_dir = sort_parts
         sort_direction = "DESC" if sort_dir.lower() == "desc" else "ASC"
     
-    offset = (page - 1) * per
+    # Có cursor -> keyset (trang sâu tốn như trang đầu), không thì OFFSET theo page như cũ
+    after = decode_cursor(cursor) if cursor else None
+    offset = 0 if after else (page - 1) * per
     
     # 2.5 Map reco filter values from frontend to database values
     # Frontend: RECOMMENDED, NOT_RECOMMENDED, UNKNOWN
@@ -175,6 +260,21 @@ def get_page_ranking(
             # ANALYST with no pages assigned -> return empty
             return PageRankingResponse(meta={"page": page, "per": per, "total": 0}, data=[])
     
+    # Cache theo tham số đã chuẩn hóa + phạm vi page của user
+    scope = user_page_ids if filter_by_user_pages else None
+    cache_key = make_cache_key(
+        "pages", scope,
+        start=start_date, end=end_date, sort=f"{sort_metric}.{sort_direction}", page=page, per=per,
+        search=search, reco=reco_db_value, size=size or "ALL", cursor=cursor, include_total=include_total,
+        compare_start=compare_start_date, compare_end=compare_end_date,
+    )
+    # Entry phụ thuộc cả kỳ so sánh -> invalidate theo ngày lớn nhất của 2 kỳ
+    cache_end_day = max(end_date, compare_end_date) if comparing else end_date
+    cached = get_cached_response(cache_key)
+    if cached:
+        return cached
+    data_version = current_data_version()
+
     # Build page filter clause
     page_filter_clause = ""
     if filter_by_user_pages:
@@ -215,29 +315,33 @@ def get_page_ranking(
     )
     """
     
+    # Có kỳ so sánh -> 1 lần quét rollup cho cả 2 kỳ, tách bằng SUM(...) FILTER
+    if comparing:
+        totals_where = "day BETWEEN :start_date AND :end_date OR day BETWEEN :compare_start AND :compare_end"
+        totals_select = ",\n            ".join(
+            [f"SUM({m}) FILTER (WHERE day BETWEEN :start_date AND :end_date) AS {m}" for m in COMPARE_METRICS]
+            + [f"SUM({m}) FILTER (WHERE day BETWEEN :compare_start AND :compare_end) AS prev_{m}" for m in COMPARE_METRICS]
+        )
+        compare_columns = "".join(
+            f",\n            COALESCE(pt.prev_{m}, 0)::bigint AS prev_{m}"
+            f",\n            (COALESCE(pt.{m}, 0) - COALESCE(pt.prev_{m}, 0))::bigint AS {m}_delta"
+            for m in COMPARE_METRICS
+        )
+    else:
+        totals_where = "day BETWEEN :start_date AND :end_date"
+        totals_select = ",\n            ".join(f"SUM({m}) AS {m}" for m in COMPARE_METRICS)
+        compare_columns = ""
+
     # 4. QUERY CHÍNH (Đã update active_pages để lọc sớm search/status)
-    query_str = f"""
+    ctes = f"""
     WITH {active_pages_cte},
-    post_snapshots AS (
-        SELECT DISTINCT ON (am.page_id, pm.post_id, ((pm.updated_at AT TIME ZONE 'UTC') + INTERVAL '7 hours')::date)
-            pm.post_id,
-            am.page_id,
-            ((pm.updated_at AT TIME ZONE 'UTC') + INTERVAL '7 hours')::date AS day_local,
-            pm.reach, pm.impressions, pm.clicks,
-            COALESCE(pm.reactions, 0) + COALESCE(pm.comments, 0) + COALESCE(pm.shares, 0) AS engagement_value
-        FROM analytics_post_metric pm
-        JOIN analytics_post_meta am ON am.post_id = pm.post_id
-        WHERE ((pm.updated_at AT TIME ZONE 'UTC') + INTERVAL '7 hours')::date BETWEEN :start_date AND :end_date
-        ORDER BY am.page_id, pm.post_id, day_local, pm.updated_at DESC
-    ),
-    page_health_agg AS (
+    page_totals AS (
+        -- Rollup page_daily_stats: 1 row / page / ngày -> 30 ngày x 500 page ~ 15k row
         SELECT
             page_id,
-            SUM(total_reach) AS total_reach,
-            SUM(total_interaction) AS total_interaction,
-            SUM(link_clicks) AS total_link_clicks
-        FROM analytics_page_health
-        WHERE record_date BETWEEN :start_date AND :end_date
+            {totals_select}
+        FROM page_daily_stats
+        WHERE {totals_where}
         GROUP BY page_id
     ),
     page_metrics AS (
@@ -245,14 +349,12 @@ def get_page_ranking(
             ap.page_id,
             ap.page_name,
             ap.reco_status,
-            COALESCE(pha.total_reach, 0)::bigint AS reach,
-            COALESCE(SUM(ps.impressions), 0)::bigint AS impressions,
-            COALESCE(pha.total_link_clicks, 0)::bigint AS clicks,
-            COALESCE(pha.total_interaction, 0)::bigint AS engagement
+            COALESCE(pt.reach, 0)::bigint AS reach,
+            COALESCE(pt.impressions, 0)::bigint AS impressions,
+            COALESCE(pt.clicks, 0)::bigint AS clicks,
+            COALESCE(pt.engagement, 0)::bigint AS engagement{compare_columns}
         FROM active_pages ap
-        LEFT JOIN post_snapshots ps ON ps.page_id = ap.page_id
-        LEFT JOIN page_health_agg pha ON pha.page_id = ap.page_id
-        GROUP BY ap.page_id, ap.page_name, ap.reco_status, pha.total_reach, pha.total_interaction, pha.total_link_clicks
+        LEFT JOIN page_totals pt ON pt.page_id = ap.page_id
     ),
     with_percentiles AS (
         SELECT
@@ -268,27 +370,16 @@ def get_page_ranking(
         FROM page_metrics pm
     ),
     with_followers AS (
+        -- followers_asof đã carry-forward sẵn theo ngày -> join thẳng theo PK (page_id, day)
         SELECT
             wp.*,
-            COALESCE(end_snap.followers_total, 0) AS followers_total,
-            COALESCE(end_snap.followers_total, 0) - COALESCE(start_snap.followers_total, 0) AS followers_delta
+            COALESCE(end_snap.followers_asof, 0) AS followers_total,
+            COALESCE(end_snap.followers_asof, 0) - COALESCE(start_snap.followers_asof, 0) AS followers_delta
         FROM with_percentiles wp
-        LEFT JOIN LATERAL (
-            SELECT followers_total
-            FROM analytics_page_health
-            WHERE page_id = wp.page_id
-                AND record_date <= :start_date
-            ORDER BY record_date DESC
-            LIMIT 1
-        ) start_snap ON true
-        LEFT JOIN LATERAL (
-            SELECT followers_total
-            FROM analytics_page_health
-            WHERE page_id = wp.page_id
-                AND record_date <= :end_date
-            ORDER BY record_date DESC
-            LIMIT 1
-        ) end_snap ON true
+        LEFT JOIN page_daily_stats start_snap
+            ON start_snap.page_id = wp.page_id AND start_snap.day = :followers_start_day
+        LEFT JOIN page_daily_stats end_snap
+            ON end_snap.page_id = wp.page_id AND end_snap.day = :followers_end_day
     ),
     final_filtered AS (
         SELECT * FROM with_followers
@@ -298,37 +389,75 @@ def get_page_ranking(
             (:size_filter = 'MEDIUM' AND followers_total >= 10000 AND followers_total < 100000) OR
             (:size_filter = 'LARGE' AND followers_total >= 100000)
     )
-    SELECT 
-        *,
-        COUNT(*) OVER() AS total_count
-    FROM final_filtered
-    ORDER BY {sort_metric} {sort_direction}
-    LIMIT :per OFFSET :offset
+    """
+    # page_name có thể NULL: NULL không so sánh được với cursor -> sort + keyset trên COALESCE(page_name, '')
+    sort_expr = "COALESCE(page_name, '')" if sort_metric == "page_name" else sort_metric
+    keyset = ""
+    if after:
+        value_cast = "TEXT" if sort_metric == "page_name" else "NUMERIC"
+        keyset = "WHERE " + keyset_clause(sort_expr, sort_direction, "page_id", value_cast)
+    # Lấy dư 1 row để biết còn trang sau. Tie-break page_id -> thứ tự ổn định cho cursor
+    query_str = f"""
+    {ctes}
+    SELECT * FROM final_filtered
+    {keyset}
+    ORDER BY {sort_expr} {sort_direction}, page_id ASC
+    LIMIT :per_plus_one OFFSET :offset
     """
 
     # Thực thi Query
-    query_params = {
+    filter_params = {
         "start_date": start_date,
         "end_date": end_date,
-        "per": per,
-        "offset": offset,
         "search": search,
         "reco_filter": reco_db_value,
-        "size_filter": size or "ALL"
+        "size_filter": size or "ALL",
+        **followers_days(start_date, end_date),
     }
+    if comparing:
+        filter_params.update({"compare_start": compare_start_date, "compare_end": compare_end_date})
     
     # Add user_page_ids if filtering by user
     if filter_by_user_pages:
-        query_params["user_page_ids"] = user_page_ids
+        filter_params["user_page_ids"] = user_page_ids
+
+    query_params = {**filter_params, "per_plus_one": per + 1, "offset": offset}
+    if after:
+        query_params.update({"cursor_value": after["v"], "cursor_key": after["k"]})
     
     result = session.exec(text(query_str), params=query_params)
     
     rows = result.fetchall()
+    has_more = len(rows) > per
+    rows = rows[:per]
+
+    # Tổng: query riêng, cache riêng (không phụ thuộc trang / cursor), bỏ qua nếu include_total=false
+    total = None
+    if include_total:
+        total_key = make_cache_key(
+            "pages_total", scope, start=start_date, end=end_date, search=search,
+            reco=reco_db_value, size=size or "ALL",
+            compare_start=compare_start_date, compare_end=compare_end_date,
+        )
+        total = cached_value(
+            total_key,
+            lambda: session.exec(text(f"{ctes} SELECT COUNT(*) FROM final_filtered"), params=filter_params).scalar(),
+            page_ids=scope, end_day=cache_end_day,
+        )
+
+    next_cursor = None
+    if has_more and rows:
+        last_value = getattr(rows[-1], sort_metric)
+        if sort_metric == "page_name":
+            last_value = last_value or ""
+        next_cursor = encode_cursor(last_value, rows[-1].page_id)
+    meta = {"page": page, "per": per, "total": total, "next_cursor": next_cursor}
     
     if not rows:
-        return PageRankingResponse(meta={"page": page, "per": per, "total": 0}, data=[])
-    
-    total = rows[0].total_count if rows else 0
+        return cache_response(
+            cache_key, PageRankingResponse(meta=meta, data=[]),
+            page_ids=scope, end_day=cache_end_day, version=data_version,
+        )
     
     data = [
         PageRankingItem(
@@ -345,12 +474,19 @@ def get_page_ranking(
             reach_percentile=float(row.reach_percentile or 0),
             clicks_percentile=float(row.clicks_percentile or 0),
             impressions_percentile=float(row.impressions_percentile or 0),
-            engagement_percentile=float(row.engagement_percentile or 0)
+            engagement_percentile=float(row.engagement_percentile or 0),
+            comparison=build_comparison(
+                {m: getattr(row, m) for m in COMPARE_METRICS},
+                {m: getattr(row, f"prev_{m}") for m in COMPARE_METRICS},
+            ) if comparing else None,
         )
         for row in rows
     ]
     
-    return PageRankingResponse(meta={"page": page, "per": per, "total": total}, data=data)
+    return cache_response(
+        cache_key, PageRankingResponse(meta=meta, data=data),
+        page_ids=scope, end_day=cache_end_day, version=data_version,
+    )
 
 # ============================================================================
 # ENDPOINT 2: PAGE DETAIL
@@ -361,6 +497,8 @@ def get_page_detail(
     page_id: str,
     start: Optional[str] = Query(None),
     end: Optional[str] = Query(None),
+    compare_start: Optional[str] = Query(None, description="Kỳ so sánh YYYY-MM-DD"),
+    compare_end: Optional[str] = Query(None, description="Kỳ so sánh YYYY-MM-DD"),
     session: Session = Depends(get_session),
     current_user: Optional[User] = Depends(get_optional_user)
 ):
@@ -382,6 +520,19 @@ def get_page_detail(
             raise HTTPException(status_code=400, detail="Invalid date format")
     else:
         start_date, end_date = get_default_date_range()
+
+    compare_start_date, compare_end_date = parse_compare_range(compare_start, compare_end)
+    comparing = compare_start_date is not None
+    cache_end_day = max(end_date, compare_end_date) if comparing else end_date
+
+    cache_key = make_cache_key(
+        "page_detail", [page_id], start=start_date, end=end_date,
+        compare_start=compare_start_date, compare_end=compare_end_date,
+    )
+    cached = get_cached_response(cache_key)
+    if cached:
+        return cached
+    data_version = current_data_version()
     
     # Get page info
     page_query = text("""
@@ -396,64 +547,34 @@ def get_page_detail(
     if not page_row:
         raise HTTPException(status_code=404, detail="Page not found")
     
-    # Get timeseries from page_health (reach, clicks, engagement)
-    page_health_query = text("""
-        SELECT 
-            record_date AS date,
-            COALESCE(total_reach, 0) AS reach,
-            COALESCE(link_clicks, 0) AS clicks,
-            COALESCE(total_interaction, 0) AS engagement
-        FROM analytics_page_health
+    # Timeseries từ rollup page_daily_stats (reach/clicks/engagement từ page health, impressions từ snapshot bài)
+    # Có kỳ so sánh -> cùng 1 query lấy luôn các ngày của kỳ trước, tách theo cờ in_current
+    compare_filter = "OR day BETWEEN :compare_start AND :compare_end" if comparing else ""
+    timeseries_query = text(f"""
+        SELECT day AS date, reach, impressions, clicks, engagement,
+               day BETWEEN :start_date AND :end_date AS in_current
+        FROM page_daily_stats
         WHERE page_id = :page_id
-          AND record_date BETWEEN :start_date AND :end_date
-        ORDER BY record_date ASC
-    """)
-    
-    page_health_result = session.exec(page_health_query, params={
-        "page_id": page_id, 
-        "start_date": start_date, 
-        "end_date": end_date
-    })
-    page_health_data = {str(row.date)[:10]: row for row in page_health_result.fetchall()}
-    
-    # Get impressions per day from post_metric
-    impressions_query = text("""
-        WITH daily_snapshots AS (
-            SELECT DISTINCT ON (pm.post_id, ((pm.updated_at AT TIME ZONE 'UTC') + INTERVAL '7 hours')::date)
-                ((pm.updated_at AT TIME ZONE 'UTC') + INTERVAL '7 hours')::date AS day_local,
-                pm.impressions
-            FROM analytics_post_metric pm
-            JOIN analytics_post_meta am ON am.post_id = pm.post_id
-            WHERE am.page_id = :page_id
-                AND ((pm.updated_at AT TIME ZONE 'UTC') + INTERVAL '7 hours')::date BETWEEN :start_date AND :end_date
-            ORDER BY pm.post_id, ((pm.updated_at AT TIME ZONE 'UTC') + INTERVAL '7 hours')::date, pm.updated_at DESC
-        )
-        SELECT 
-            day_local AS date,
-            COALESCE(SUM(impressions), 0) AS impressions
-        FROM daily_snapshots
-        GROUP BY day_local
-        ORDER BY day_local ASC
+          AND (day BETWEEN :start_date AND :end_date {compare_filter})
+          -- Bỏ row chỉ để carry-forward followers (không có health, không có số liệu)
+          AND (followers_total IS NOT NULL OR reach + impressions + clicks + engagement > 0)
+        ORDER BY day ASC
     """)
-    
-    impressions_result = session.exec(impressions_query, params={
-        "page_id": page_id, 
-        "start_date": start_date, 
-        "end_date": end_date
-    })
-    impressions_data = {str(row.date)[:10]: row.impressions for row in impressions_result.fetchall()}
-    
-    # Merge page_health + impressions into timeseries
-    all_dates = sorted(set(page_health_data.keys()) | set(impressions_data.keys()))
+
+    timeseries_params = {"page_id": page_id, "start_date": start_date, "end_date": end_date}
+    if comparing:
+        timeseries_params.update({"compare_start": compare_start_date, "compare_end": compare_end_date})
+    timeseries_rows = session.exec(timeseries_query, params=timeseries_params).fetchall()
     timeseries = [
         TimeseriesPoint(
-            date=d,
-            reach=page_health_data[d].reach if d in page_health_data else 0,
-            impressions=impressions_data.get(d, 0),
-            clicks=page_health_data[d].clicks if d in page_health_data else 0,
-            engagement=page_health_data[d].engagement if d in page_health_data else 0
+            date=str(row.date),
+            reach=row.reach or 0,
+            impressions=row.impressions or 0,
+            clicks=row.clicks or 0,
+            engagement=row.engagement or 0
         )
-        for d in all_dates
+        for row in timeseries_rows
+        if row.in_current
     ]
     
     # Summary
@@ -463,23 +584,32 @@ def get_page_detail(
         "clicks": sum(t.clicks for t in timeseries),
         "engagement": sum(t.engagement for t in timeseries)
     }
+
+    comparison = None
+    if comparing:
+        # Hai kỳ có thể chồng nhau -> 1 ngày có thể thuộc cả 2
+        previous = {
+            m: sum(getattr(row, m) or 0 for row in timeseries_rows
+                   if compare_start_date <= row.date <= compare_end_date)
+            for m in COMPARE_METRICS
+        }
+        comparison = build_comparison(summary, previous)
     
     # Top 10 posts - SUM over 7-day window (not just latest snapshot)
     top_posts_query = text("""
         WITH post_daily_snapshots AS (
-            SELECT DISTINCT ON (pm.post_id, ((pm.updated_at AT TIME ZONE 'UTC') + INTERVAL '7 hours')::date)
-                pm.post_id,
-                ((pm.updated_at AT TIME ZONE 'UTC') + INTERVAL '7 hours')::date AS day_local,
-                pm.reach, pm.impressions, pm.clicks,
-                COALESCE(pm.reactions, 0) + COALESCE(pm.comments, 0) + COALESCE(pm.shares, 0) AS engagement_value,
+            SELECT
+                pd.post_id,
+                pd.local_day AS day_local,
+                pd.reach, pd.impressions, pd.clicks,
+                pd.reactions + pd.comments + pd.shares AS engagement_value,
                 am.caption_snippet,
                 am.created_time,
                 am.permalink
-            FROM analytics_post_metric pm
-            JOIN analytics_post_meta am ON am.post_id = pm.post_id
-            WHERE am.page_id = :page_id
-                AND ((pm.updated_at AT TIME ZONE 'UTC') + INTERVAL '7 hours')::date BETWEEN :start_date AND :end_date
-            ORDER BY pm.post_id, day_local, pm.updated_at DESC
+            FROM analytics_post_daily pd
+            JOIN analytics_post_meta am ON am.post_id = pd.post_id
+            WHERE pd.page_id = :page_id
+                AND pd.local_day BETWEEN :start_date AND :end_date
         ),
         post_aggregated AS (
             SELECT
@@ -520,28 +650,25 @@ def get_page_detail(
         for row in top_posts_result.fetchall()
     ]
     
-    # Followers
+    # Followers: 2 lần tra PK trên chuỗi carry-forward followers_asof
     followers_query = text("""
         SELECT
-            COALESCE((SELECT followers_total FROM analytics_page_health 
-                      WHERE page_id = :page_id AND record_date <= :end_date 
-                      ORDER BY record_date DESC LIMIT 1), 0) AS followers_end,
-            COALESCE((SELECT followers_total FROM analytics_page_health 
-                      WHERE page_id = :page_id AND record_date <= :start_date 
-                      ORDER BY record_date DESC LIMIT 1), 0) AS followers_start
+            COALESCE((SELECT followers_asof FROM page_daily_stats
+                      WHERE page_id = :page_id AND day = :followers_end_day), 0) AS followers_end,
+            COALESCE((SELECT followers_asof FROM page_daily_stats
+                      WHERE page_id = :page_id AND day = :followers_start_day), 0) AS followers_start
     """)
     
     followers_result = session.exec(followers_query, params={
-        "page_id": page_id, 
-        "start_date": start_date, 
-        "end_date": end_date
+        "page_id": page_id,
+        **followers_days(start_date, end_date),
     })
     followers_row = followers_result.fetchone()
     
     followers_total = followers_row.followers_end if followers_row else 0
     followers_delta = (followers_row.followers_end - followers_row.followers_start) if followers_row else 0
     
-    return PageDetailResponse(
+    return cache_response(cache_key, PageDetailResponse(
         page_id=page_row.page_id,
         page_name=page_row.page_name or "Unknown",
         reco_status=page_row.reco_status,
@@ -549,8 +676,9 @@ def get_page_detail(
         followers_delta=followers_delta,
         timeseries=timeseries,
         top_posts=top_posts,
-        summary=summary
-    )
+        summary=summary,
+        comparison=comparison,
+    ), page_ids=[page_id], end_day=cache_end_day, version=data_version)
 
 # ============================================================================
 # ENDPOINT 3: TOP POSTS (Paginated)
@@ -564,6 +692,8 @@ def get_top_posts(
     end: Optional[str] = Query(None),
     limit: int = Query(50, ge=1, le=200),
     offset: int = Query(0, ge=0),
+    cursor: Optional[str] = Query(None, description="Keyset cursor (meta.next_cursor của trang trước), thay cho offset"),
+    include_total: bool = Query(True, description="False -> bỏ qua đếm tổng"),
     session: Session = Depends(get_session),
     current_user: Optional[User] = Depends(get_optional_user)
 ):
@@ -590,30 +720,35 @@ def get_top_posts(
             raise HTTPException(status_code=400, detail="Invalid date format")
     else:
         start_date, end_date = get_default_date_range()
+
+    after = decode_cursor(cursor) if cursor else None
+    if after:
+        offset = 0
+
+    cache_key = make_cache_key(
+        "top_posts", [page_id], metric=metric, start=start_date, end=end_date, limit=limit, offset=offset,
+        cursor=cursor, include_total=include_total,
+    )
+    cached = get_cached_response(cache_key)
+    if cached:
+        return cached
+    data_version = current_data_version()
     
     # SUM over 7-day window (not just latest snapshot)
-    query = text(f"""
+    ctes = """
         WITH post_daily_snapshots AS (
-            SELECT DISTINCT ON (pm.post_id, ((pm.updated_at AT TIME ZONE 'UTC') + INTERVAL '7 hours')::date)
-                pm.post_id,
-                ((pm.updated_at AT TIME ZONE 'UTC') + INTERVAL '7 hours')::date AS day_local,
-                pm.reach, pm.impressions, pm.clicks,
-                COALESCE(pm.reactions, 0) + COALESCE(pm.comments, 0) + COALESCE(pm.shares, 0) AS engagement_value,
-                am.caption_snippet,
-                am.created_time,
-                am.permalink
-            FROM analytics_post_metric pm
-            JOIN analytics_post_meta am ON am.post_id = pm.post_id
-            WHERE am.page_id = :page_id
-                AND ((pm.updated_at AT TIME ZONE 'UTC') + INTERVAL '7 hours')::date BETWEEN :start_date AND :end_date
-            ORDER BY pm.post_id, day_local, pm.updated_at DESC
+            SELECT
+                pd.post_id,
+                pd.local_day AS day_local,
+                pd.reach, pd.impressions, pd.clicks,
+                pd.reactions + pd.comments + pd.shares AS engagement_value
+            FROM analytics_post_daily pd
+            WHERE pd.page_id = :page_id
+                AND pd.local_day BETWEEN :start_date AND :end_date
         ),
         post_aggregated AS (
             SELECT
                 post_id,
-                MAX(caption_snippet) AS caption_snippet,
-                MAX(created_time) AS created_time,
-                MAX(permalink) AS permalink,
                 SUM(COALESCE(reach, 0)) AS reach,
                 SUM(COALESCE(impressions, 0)) AS impressions,
                 SUM(COALESCE(clicks, 0)) AS clicks,
@@ -621,28 +756,54 @@ def get_top_posts(
             FROM post_daily_snapshots
             GROUP BY post_id
         )
-        SELECT 
-            *,
-            COUNT(*) OVER() AS total_count
-        FROM post_aggregated
-        ORDER BY {metric} DESC NULLS LAST
-        LIMIT :limit OFFSET :offset
+    """
+    keyset = "WHERE " + keyset_clause(f"pa.{metric}", "DESC", "pa.post_id", "NUMERIC") if after else ""
+    # Metadata bài chỉ join cho đúng các row của trang (không phải cả cửa sổ)
+    query = text(f"""
+        {ctes}
+        SELECT pa.*, am.caption_snippet, am.created_time, am.permalink
+        FROM (
+            SELECT * FROM post_aggregated pa
+            {keyset}
+            ORDER BY pa.{metric} DESC, pa.post_id ASC
+            LIMIT :limit_plus_one OFFSET :offset
+        ) pa
+        JOIN analytics_post_meta am ON am.post_id = pa.post_id
+        ORDER BY pa.{metric} DESC, pa.post_id ASC
     """)
-    
-    result = session.exec(query, params={
-        "page_id": page_id,
-        "start_date": start_date,
-        "end_date": end_date,
-        "limit": limit,
-        "offset": offset
-    })
-    
-    rows = result.fetchall()
-    
+
+    filter_params = {"page_id": page_id, "start_date": start_date, "end_date": end_date}
+    query_params = {**filter_params, "limit_plus_one": limit + 1, "offset": offset}
+    if after:
+        query_params.update({"cursor_value": after["v"], "cursor_key": after["k"]})
+
+    rows = session.exec(query, params=query_params).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    # Tổng số bài trong cửa sổ: query riêng, cache riêng, tùy chọn
+    total = None
+    if include_total:
+        total = cached_value(
+            make_cache_key("top_posts_total", [page_id], start=start_date, end=end_date),
+            lambda: session.exec(
+                text("""
+                    SELECT COUNT(DISTINCT post_id) FROM analytics_post_daily
+                    WHERE page_id = :page_id AND local_day BETWEEN :start_date AND :end_date
+                """),
+                params=filter_params,
+            ).scalar(),
+            page_ids=[page_id], end_day=end_date,
+        )
+
+    next_cursor = encode_cursor(getattr(rows[-1], metric), rows[-1].post_id) if has_more and rows else None
+    meta = {"limit": limit, "offset": offset, "total": total, "next_cursor": next_cursor}
+
     if not rows:
-        return TopPostsResponse(meta={"limit": limit, "offset": offset, "total": 0}, data=[])
-    
-    total = rows[0].total_count if rows else 0
+        return cache_response(
+            cache_key, TopPostsResponse(meta=meta, data=[]),
+            page_ids=[page_id], end_day=end_date, version=data_version,
+        )
     
     data = [
         TopPost(
@@ -659,4 +820,135 @@ def get_top_posts(
         for row in rows
     ]
     
-    return TopPostsResponse(meta={"limit": limit, "offset": offset, "total": total}, data=data)
+    return cache_response(
+        cache_key, TopPostsResponse(meta=meta, data=data),
+        page_ids=[page_id], end_day=end_date, version=data_version,
+    )
+
+# ============================================================================
+# ENDPOINT 4: MULTI-PAGE TIMESERIES (so sánh nhiều page)
+# ============================================================================
+
+TIMESERIES_METRICS = {
+    "reach": "COALESCE(SUM(s.reach), 0)",
+    "impressions": "COALESCE(SUM(s.impressions), 0)",
+    "clicks": "COALESCE(SUM(s.clicks), 0)",
+    "engagement": "COALESCE(SUM(s.engagement), 0)",
+    # Followers cuối bucket (chuỗi carry-forward followers_asof)
+    "followers": "(array_agg(s.followers_asof ORDER BY s.day DESC) FILTER (WHERE s.followers_asof IS NOT NULL))[1]",
+}
+TIMESERIES_MAX_PAGES = 100
+
+@router.get("/timeseries")
+def get_timeseries(
+    page_ids: str = Query(..., description="Danh sách page_id, phân tách bằng dấu phẩy"),
+    metrics: str = Query("reach,impressions,clicks,engagement", description="reach,impressions,clicks,engagement,followers"),
+    start: Optional[str] = Query(None),
+    end: Optional[str] = Query(None),
+    granularity: str = Query("day", description="day|week"),
+    session: Session = Depends(get_session),
+    current_user: Optional[User] = Depends(get_optional_user)
+):
+    """Series đã căn theo cùng trục ngày cho nhiều page, 1 query trên page_daily_stats.
+
+    Layout dạng cột: {"buckets": [...], "series": {page_id: {metric: [...]}}}, bucket không có dữ liệu = 0
+    (followers = null).
+    """
+    ids = list(dict.fromkeys(pid.strip() for pid in page_ids.split(",") if pid.strip()))
+    if not ids:
+        raise HTTPException(status_code=400, detail="page_ids is required")
+    if len(ids) > TIMESERIES_MAX_PAGES:
+        raise HTTPException(status_code=400, detail=f"Tối đa {TIMESERIES_MAX_PAGES} page / request")
+
+    metric_list = list(dict.fromkeys(m.strip() for m in metrics.split(",") if m.strip()))
+    invalid = [m for m in metric_list if m not in TIMESERIES_METRICS]
+    if not metric_list or invalid:
+        raise HTTPException(status_code=400, detail=f"Invalid metrics. Use: {set(TIMESERIES_METRICS)}")
+    if granularity not in ("day", "week"):
+        raise HTTPException(status_code=400, detail="granularity must be day or week")
+
+    if current_user and current_user.role != "ADMIN":
+        denied = set(ids) - set(current_user.accessible_page_ids)
+        if denied:
+            raise HTTPException(status_code=403, detail="You don't have access to some of these pages")
+
+    if start and end:
+        try:
+            start_date = date.fromisoformat(start)
+            end_date = date.fromisoformat(end)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid date format")
+    else:
+        start_date, end_date = get_default_date_range()
+
+    cache_key = make_cache_key(
+        "timeseries", ids, metrics=",".join(metric_list), start=start_date, end=end_date, granularity=granularity,
+    )
+    cached = get_cached_response(cache_key)
+    if cached:
+        return cached
+    data_version = current_data_version()
+
+    # Bucket tuần bắt đầu thứ 2 (date_trunc('week')), bucket đầu / cuối bị cắt theo start / end
+    first_bucket = start_date if granularity == "day" else start_date - timedelta(days=start_date.weekday())
+    step_days = 1 if granularity == "day" else 7
+    select_metrics = ",\n            ".join(f"{TIMESERIES_METRICS[m]} AS {m}" for m in metric_list)
+
+    rows = session.exec(text(f"""
+        WITH req_pages AS (
+            SELECT unnest(CAST(:page_ids AS VARCHAR[])) AS page_id
+        ),
+        buckets AS (
+            SELECT CAST(b AS DATE) AS bucket
+            FROM generate_series(CAST(:first_bucket AS TIMESTAMP), CAST(:end_date AS TIMESTAMP),
+                                 make_interval(days => CAST(:step_days AS INTEGER))) AS b
+        )
+        SELECT
+            p.page_id,
+            b.bucket,
+            {select_metrics}
+        FROM req_pages p
+        CROSS JOIN buckets b
+        LEFT JOIN page_daily_stats s
+            ON s.page_id = p.page_id
+           AND s.day >= b.bucket
+           AND s.day < b.bucket + CAST(:step_days AS INTEGER)
+           AND s.day BETWEEN :start_date AND :end_date
+        GROUP BY p.page_id, b.bucket
+        ORDER BY p.page_id, b.bucket
+    """), params={
+        "page_ids": ids,
+        "first_bucket": first_bucket,
+        "start_date": start_date,
+        "end_date": end_date,
+        "step_days": step_days,
+    }).fetchall()
+
+    buckets: List[str] = []
+    series: Dict[str, Dict[str, List]] = {pid: {m: [] for m in metric_list} for pid in ids}
+    for row in rows:
+        if row.page_id == ids[0]:
+            buckets.append(str(max(row.bucket, start_date)))
+        for m in metric_list:
+            value = getattr(row, m)
+            series[row.page_id][m].append(int(value) if value is not None else None)
+
+    return cache_response(cache_key, {
+        "meta": {
+            "start": str(start_date),
+            "end": str(end_date),
+            "granularity": granularity,
+            "metrics": metric_list,
+        },
+        "buckets": buckets,
+        "series": series,
+    }, page_ids=ids, end_day=end_date, version=data_version)
+
+# ============================================================================
+# CACHE METRICS
+# ============================================================================
+
+@router.get("/cache")
+def get_stats_cache_metrics():
+    """Hit/miss, số entry, version dữ liệu của cache /stats (process hiện tại)"""
+    return stats_cache.snapshot()
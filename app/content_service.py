@@ -46,10 +46,34 @@ def _get_random_image_for_page(session: Session, page_id: str, content_type: str
 
     target_folder_id = random.choice([f.id for f in available_folders])
     
-    image = session.exec(select(Image).where(Image.folder_id == target_folder_id).order_by(func.random()).limit(1)).first()
+    # Lấy (id, width, height) của cả folder rồi lọc tỉ lệ khung hình trong RAM
+    candidates = session.exec(
+        select(Image.id, Image.width, Image.height).where(Image.folder_id == target_folder_id)
+    ).all()
+    
+    if not candidates: return None, f"Folder {target_folder_id} không có ảnh"
+    
+    image_id = _pick_image_by_aspect(candidates, content_type)
+    return session.get(Image, image_id), None
+
+# Story 9:16 (h/w ≈ 1.78), Post thường vuông/ngang/4:5 -> ngưỡng 1.5 tách 2 loại
+STORY_MIN_RATIO = 1.5
+
+def _pick_image_by_aspect(candidates, content_type: str) -> str:
+    """
+    Ưu tiên ảnh đúng tỉ lệ: STORY -> dọc (h/w >= 1.5), POST -> còn lại.
+    Không có ảnh khớp -> ảnh chưa rõ kích thước -> cuối cùng mới random tất cả.
+    """
+    want_story = content_type.upper() == "STORY"
+    matched, unknown = [], []
+    for image_id, width, height in candidates:
+        if not width or not height:
+            unknown.append(image_id)
+        elif (height / width >= STORY_MIN_RATIO) == want_story:
+            matched.append(image_id)
     
-    if not image: return None, f"Folder {target_folder_id} không có ảnh"
-    return image, None
+    pool = matched or unknown or [c[0] for c in candidates]
+    return random.choice(pool)
 
 # --- LOGIC MỚI CHO POST VÀ STORY ---
 
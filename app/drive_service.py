@@ -1,7 +1,9 @@
 import io
 import os
+import itertools
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.http import MediaIoBaseDownload
 
 def get_drive_service():
     # Đường dẫn đến file JSON bạn vừa tạo
@@ -30,4 +32,45 @@ def download_image_from_drive(file_id: str):
         
     except Exception as e:
         print(f"Lỗi tải ảnh từ Drive (ID: {file_id}): {e}")
-        return None
\ No newline at end of file
+        return None
+
+def fetch_image_header(file_id: str, num_bytes: int = 65536, service=None):
+    """
+    Đọc N byte đầu của file (HTTP Range) - đủ để đọc kích thước ảnh mà không tải cả file.
+    Truyền service riêng khi gọi từ nhiều thread (client Drive không thread-safe).
+    """
+    try:
+        service = service or get_drive_service()
+        request = service.files().get_media(fileId=file_id)
+        request.headers["Range"] = f"bytes=0-{num_bytes - 1}"
+        return request.execute()
+    except Exception as e:
+        print(f"Lỗi đọc header ảnh từ Drive (ID: {file_id}): {e}")
+        return None
+
+def _drain_download(downloader, buffer, done: bool = False):
+    while not done:
+        _, done = downloader.next_chunk()
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+
+def open_image_stream(file_id: str, chunk_size: int = 1024 * 1024):
+    """
+    Tải trước chunk đầu để lỗi (file mất / hết quyền) trả về None -> API còn kịp trả 404,
+    phần còn lại stream dần. Trả về (iterator, tổng số byte Drive báo - None nếu không rõ) hoặc None.
+    """
+    try:
+        service = get_drive_service()
+        request = service.files().get_media(fileId=file_id)
+        buffer = io.BytesIO()
+        downloader = MediaIoBaseDownload(buffer, request, chunksize=chunk_size)
+        status, done = downloader.next_chunk()
+    except Exception as e:
+        print(f"Lỗi tải ảnh từ Drive (ID: {file_id}): {e}")
+        return None
+    first = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate(0)
+    total_size = status.total_size if status else None
+    return itertools.chain([first], _drain_download(downloader, buffer, done)), total_size
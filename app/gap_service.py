@@ -0,0 +1,263 @@
+# app/gap_service.py
+"""
+Logic kiểm tra thiếu dữ liệu / bài cần quét cho Extension, chạy cho NHIỀU page cùng lúc
+- Số query cố định, không phụ thuộc số page (1 query config, 1 query folder, 1 query dò lỗ / bài viết)
+- Endpoint 1 page cũng gọi qua đây với list 1 phần tử
+"""
+import os
+import json
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlmodel import Session, select, update, text
+
+from app.models import Folder, PageConfig, PostMeta
+from app.ingest_service import local_today
+
+ACTIVE_POST_DAYS = 7
+# Dò lỗ dữ liệu trong N ngày gần nhất, mỗi page trả tối đa M ngày (ngày gần nhất trước)
+GAP_LOOKBACK_DAYS = int(os.getenv("GAP_LOOKBACK_DAYS", "30"))
+GAP_MAX_DATES_PER_PAGE = int(os.getenv("GAP_MAX_DATES_PER_PAGE", "14"))
+
+# Scan planner: bài quá tuổi này -> is_final, không quét nữa
+SCAN_FINAL_AFTER_DAYS = int(os.getenv("SCAN_FINAL_AFTER_DAYS", str(ACTIVE_POST_DAYS)))
+# (tuổi bài tối đa tính bằng giờ, chu kỳ quét lại tính bằng giờ): bài càng mới quét càng dày
+SCAN_POLICY = (
+    (24, 1),
+    (72, 6),
+    (SCAN_FINAL_AFTER_DAYS * 24, 24),
+)
+
+
+def parse_folder_ids(raw) -> List[str]:
+    try:
+        f_ids = json.loads(raw) if isinstance(raw, str) else raw
+    except (ValueError, TypeError):
+        f_ids = []
+    return list(f_ids or [])
+
+
+def find_data_holes(session: Session, page_ids: List[str], end_day: date,
+                    lookback_days: int = GAP_LOOKBACK_DAYS,
+                    max_per_page: int = GAP_MAX_DATES_PER_PAGE) -> Dict[str, Dict[str, List[str]]]:
+    """
+    Lỗ dữ liệu thật (không dựa vào watermark) cho nhiều page trong 1 query:
+    lưới page x generate_series(ngày) anti-join
+    - analytics_page_health theo (page_id, record_date) -> index uq_page_health_page_date
+    - analytics_post_daily theo (page_id, local_day) -> index ix_post_daily_page_day
+      (chỉ tính là lỗ nếu hôm đó page có bài không phải story trong cửa sổ quét 7 ngày)
+    Mỗi page giữ tối đa max_per_page ngày thiếu gần nhất cho TỪNG loại (xếp hạng riêng -> nhiều ngày thiếu
+    health không che mất lỗ chỉ số bài).
+    Trả về {page_id: {"health": [...], "post_metrics": [...]}} (ngày tăng dần như trước đây)
+    """
+    holes = {pid: {"health": [], "post_metrics": []} for pid in page_ids}
+    if not page_ids or lookback_days <= 0:
+        return holes
+
+    start_day = end_day - timedelta(days=lookback_days - 1)
+    rows = session.exec(text("""
+        WITH grid AS (
+            SELECT p.page_id, d.day
+            FROM unnest(CAST(:page_ids AS VARCHAR[])) AS p(page_id)
+            CROSS JOIN generate_series(CAST(:start_day AS TIMESTAMP), CAST(:end_day AS TIMESTAMP), INTERVAL '1 day') AS d(day)
+        ),
+        holes AS (
+            SELECT
+                g.page_id,
+                g.day,
+                NOT EXISTS (
+                    SELECT 1 FROM analytics_page_health h
+                    WHERE h.page_id = g.page_id AND h.record_date = g.day
+                ) AS missing_health,
+                NOT EXISTS (
+                    SELECT 1 FROM analytics_post_daily pd
+                    WHERE pd.page_id = g.page_id AND pd.local_day = CAST(g.day AS DATE)
+                ) AND EXISTS (
+                    SELECT 1 FROM analytics_post_meta m
+                    WHERE m.page_id = g.page_id
+                      AND m.post_type <> 'STORY'
+                      AND m.created_time >= g.day - INTERVAL '7 days'
+                      AND m.created_time < g.day + INTERVAL '1 day'
+                ) AS missing_post_metrics
+            FROM grid g
+        ),
+        ranked AS (
+            SELECT *,
+                   ROW_NUMBER() OVER (PARTITION BY page_id, missing_health ORDER BY day DESC) AS health_rn,
+                   ROW_NUMBER() OVER (PARTITION BY page_id, missing_post_metrics ORDER BY day DESC) AS post_rn
+            FROM holes
+            WHERE missing_health OR missing_post_metrics
+        ),
+        capped AS (
+            SELECT page_id, day,
+                   missing_health AND health_rn <= :max_per_page AS missing_health,
+                   missing_post_metrics AND post_rn <= :max_per_page AS missing_post_metrics
+            FROM ranked
+        )
+        SELECT page_id, CAST(day AS DATE) AS day, missing_health, missing_post_metrics
+        FROM capped
+        WHERE missing_health OR missing_post_metrics
+        ORDER BY page_id, day ASC
+    """), params={
+        "page_ids": list(page_ids),
+        "start_day": start_day,
+        "end_day": end_day,
+        "max_per_page": max_per_page,
+    }).fetchall()
+
+    for r in rows:
+        day = r.day.strftime("%Y-%m-%d")
+        if r.missing_health:
+            holes[r.page_id]["health"].append(day)
+        if r.missing_post_metrics:
+            holes[r.page_id]["post_metrics"].append(day)
+    return holes
+
+
+def check_gaps_for_pages(session: Session, page_ids: List[str]) -> Dict[str, Dict]:
+    """
+    {page_id: {"eligible": bool, "reason"?: str, "missing_dates"?: [...], "post_metric_gaps"?: [...]}}
+    missing_dates: ngày thiếu page health cần Extension bù (tăng dần, tối đa GAP_MAX_DATES_PER_PAGE ngày gần nhất)
+    """
+    page_ids = list(dict.fromkeys(page_ids))
+    if not page_ids:
+        return {}
+
+    configs = {c.page_id: c for c in session.exec(select(PageConfig).where(PageConfig.page_id.in_(page_ids))).all()}
+    page_folders = {pid: parse_folder_ids(c.folder_ids) for pid, c in configs.items()}
+
+    all_folder_ids = {fid for f_ids in page_folders.values() for fid in f_ids}
+    folder_names: Dict[str, str] = {}
+    if all_folder_ids:
+        folder_names = dict(session.exec(
+            select(Folder.id, Folder.name).where(Folder.id.in_(all_folder_ids))
+        ).all())
+
+    results: Dict[str, Dict] = {}
+    for page_id in page_ids:
+        config = configs.get(page_id)
+        # Chưa config hoặc không có folder -> Loại
+        if not config or not config.folder_ids:
+            results[page_id] = {"eligible": False, "reason": "No config"}
+            continue
+        f_ids = page_folders[page_id]
+        if not f_ids:
+            results[page_id] = {"eligible": False, "reason": "No folders"}
+            continue
+
+        # Điều kiện bắt buộc: Phải có cả POST và STORY
+        names = [(folder_names.get(fid) or "").upper() for fid in f_ids if fid in folder_names]
+        if not (any(n.endswith("_POST") for n in names) and any(n.endswith("_STORY") for n in names)):
+            results[page_id] = {"eligible": False, "reason": "Missing POST or STORY folder"}
+            continue
+
+        results[page_id] = {"eligible": True}
+
+    # Ngày thiếu: dò lỗ thật cho tất cả page đủ điều kiện trong 1 query (tới hôm qua)
+    eligible = [pid for pid, r in results.items() if r["eligible"]]
+    yesterday = local_today() - timedelta(days=1)
+    for page_id, page_holes in find_data_holes(session, eligible, yesterday).items():
+        results[page_id]["missing_dates"] = page_holes["health"]
+        results[page_id]["post_metric_gaps"] = page_holes["post_metrics"]
+    return results
+
+
+def get_active_posts_for_pages(session: Session, page_ids: List[str], days: int = ACTIVE_POST_DAYS) -> Dict[str, List[Dict]]:
+    """
+    Bài (không phải story) đăng trong N ngày gần nhất của nhiều page, 1 query.
+    Điều kiện post_type <> 'STORY' khớp partial index ix_post_meta_page_created_nostory.
+    """
+    page_ids = list(dict.fromkeys(page_ids))
+    results: Dict[str, List[Dict]] = {pid: [] for pid in page_ids}
+    if not page_ids:
+        return results
+
+    since = datetime.utcnow() - timedelta(days=days)
+    rows = session.exec(
+        select(PostMeta.page_id, PostMeta.post_id, PostMeta.created_time)
+        .where(PostMeta.page_id.in_(page_ids))
+        .where(PostMeta.created_time >= since)
+        .where(PostMeta.post_type != "STORY")
+        .order_by(PostMeta.page_id, PostMeta.created_time.desc())
+    ).all()
+
+    grouped = defaultdict(list)
+    for page_id, post_id, created_time in rows:
+        grouped[page_id].append({"post_id": post_id, "created_time": created_time.isoformat()})
+    results.update(grouped)
+    return results
+
+
+def _scan_interval_hours(age_hours: float) -> Optional[int]:
+    for max_age, interval in SCAN_POLICY:
+        if age_hours < max_age:
+            return interval
+    return None
+
+
+def finalize_old_posts(session: Session, page_ids: List[str], now: Optional[datetime] = None) -> int:
+    """Đánh dấu is_final cho bài quá SCAN_FINAL_AFTER_DAYS (không commit)"""
+    cutoff = (now or datetime.utcnow()) - timedelta(days=SCAN_FINAL_AFTER_DAYS)
+    result = session.exec(
+        update(PostMeta)
+        .where(PostMeta.page_id.in_(page_ids))
+        .where(PostMeta.created_time < cutoff)
+        .where(PostMeta.is_final == False)  # noqa: E712
+        .values(is_final=True)
+    )
+    return result.rowcount
+
+
+def build_scan_plan(session: Session, page_ids: List[str], limit_per_page: Optional[int] = None) -> Dict[str, List[Dict]]:
+    """
+    Bài cần quét lại chỉ số, theo từng page:
+    - Bài chưa final, trong SCAN_FINAL_AFTER_DAYS ngày, đã quá chu kỳ quét theo tuổi (SCAN_POLICY)
+    - Ưu tiên = độ trễ so với chu kỳ / (1 + tuổi theo ngày): bài mới + lâu chưa quét lên đầu,
+      bài chưa quét lần nào luôn đứng trước
+    """
+    page_ids = list(dict.fromkeys(page_ids))
+    plan: Dict[str, List[Dict]] = {pid: [] for pid in page_ids}
+    if not page_ids:
+        return plan
+
+    now = datetime.utcnow()
+    since = now - timedelta(days=SCAN_FINAL_AFTER_DAYS)
+    rows = session.exec(
+        select(PostMeta.page_id, PostMeta.post_id, PostMeta.created_time, PostMeta.last_scanned_at)
+        .where(PostMeta.page_id.in_(page_ids))
+        .where(PostMeta.created_time >= since)
+        .where(PostMeta.post_type != "STORY")
+        .where(PostMeta.is_final == False)  # noqa: E712
+    ).all()
+
+    for page_id, post_id, created_time, last_scanned_at in rows:
+        age_hours = max((now - created_time).total_seconds() / 3600, 0)
+        interval = _scan_interval_hours(age_hours)
+        if interval is None:
+            continue
+
+        if last_scanned_at is None:
+            overdue = float("inf")
+        else:
+            overdue = (now - last_scanned_at).total_seconds() / 3600 / interval
+            if overdue < 1:
+                continue
+
+        priority = overdue / (1 + age_hours / 24)
+        plan[page_id].append({
+            "post_id": post_id,
+            "created_time": created_time.isoformat(),
+            "last_scanned_at": last_scanned_at.isoformat() if last_scanned_at else None,
+            "interval_hours": interval,
+            "priority": None if priority == float("inf") else round(priority, 3),
+            "_sort": priority,
+        })
+
+    for page_id, posts in plan.items():
+        posts.sort(key=lambda p: p["_sort"], reverse=True)
+        for p in posts:
+            del p["_sort"]
+        if limit_per_page:
+            plan[page_id] = posts[:limit_per_page]
+    return plan
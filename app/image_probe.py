@@ -0,0 +1,160 @@
+# app/image_probe.py
+"""
+Đọc kích thước ảnh (width, height) từ vài KB đầu file
+- Hỗ trợ PNG, GIF, JPEG, WEBP (VP8 / VP8L / VP8X)
+- Dùng cho các ảnh mà Drive không trả imageMediaMetadata
+- Đọc header song song bằng thread pool (mỗi thread 1 Drive client riêng)
+"""
+import struct
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from sqlmodel import Session, select, text
+
+from app.models import Image
+from app.drive_service import get_drive_service, fetch_image_header
+
+logger = logging.getLogger(__name__)
+
+HEADER_BYTES = 64 * 1024
+# JPEG có EXIF/thumbnail lớn -> SOF nằm sau, đọc lại với Range rộng hơn
+RETRY_HEADER_BYTES = 512 * 1024
+PROBE_WORKERS = 8
+PROBE_LIMIT_PER_FOLDER = 500
+
+
+def parse_image_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """Trả về (width, height) nếu đọc được từ header, ngược lại None"""
+    if not data or len(data) < 26:
+        return None
+
+    # PNG: chunk IHDR luôn đứng đầu
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        width, height = struct.unpack(">II", data[16:24])
+        return width, height
+
+    # GIF: logical screen width/height (little-endian)
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        width, height = struct.unpack("<HH", data[6:10])
+        return width, height
+
+    # WEBP
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        chunk = data[12:16]
+        if chunk == b"VP8 " and len(data) >= 30:
+            width, height = struct.unpack("<HH", data[26:30])
+            return width & 0x3FFF, height & 0x3FFF
+        if chunk == b"VP8L" and len(data) >= 25:
+            b = data[21:25]
+            width = 1 + (((b[1] & 0x3F) << 8) | b[0])
+            height = 1 + (((b[3] & 0x0F) << 10) | (b[2] << 2) | ((b[1] & 0xC0) >> 6))
+            return width, height
+        if chunk == b"VP8X" and len(data) >= 30:
+            width = 1 + int.from_bytes(data[24:27], "little")
+            height = 1 + int.from_bytes(data[27:30], "little")
+            return width, height
+        return None
+
+    # JPEG: duyệt marker tới SOFn
+    if data[:2] == b"\xff\xd8":
+        i = 2
+        while i + 9 < len(data):
+            if data[i] != 0xFF:
+                i += 1
+                continue
+            marker = data[i + 1]
+            if marker == 0xFF:  # padding
+                i += 1
+                continue
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:  # marker không có độ dài
+                i += 2
+                continue
+            seg_len = struct.unpack(">H", data[i + 2:i + 4])[0]
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", data[i + 5:i + 9])
+                return width, height
+            i += 2 + seg_len
+        return None
+
+    return None
+
+
+_local = threading.local()
+
+
+def _thread_drive_service():
+    # Client Drive (httplib2) không thread-safe -> mỗi thread giữ 1 client
+    if not hasattr(_local, "service"):
+        _local.service = get_drive_service()
+    return _local.service
+
+
+def _probe_one(file_id: str) -> Tuple[str, Optional[Tuple[int, int]], bool]:
+    """(file_id, (w, h) | None, đã đọc được header hay chưa)"""
+    service = _thread_drive_service()
+    data = fetch_image_header(file_id, HEADER_BYTES, service=service)
+    if not data:
+        return file_id, None, False
+    size = parse_image_size(data)
+    if size is None and data[:2] == b"\xff\xd8":
+        data = fetch_image_header(file_id, RETRY_HEADER_BYTES, service=service)
+        if not data:
+            return file_id, None, False
+        size = parse_image_size(data)
+    return file_id, size, True
+
+
+def probe_image_sizes(file_ids: List[str], workers: int = PROBE_WORKERS) -> Dict[str, Optional[Tuple[int, int]]]:
+    """
+    Đọc header song song. Trả về {file_id: (w, h) | None (header đọc được nhưng không parse được)}.
+    Ảnh tải header lỗi (mạng / Drive) không có trong kết quả -> lần sau thử lại
+    """
+    if not file_ids:
+        return {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return {fid: size for fid, size, fetched in pool.map(_probe_one, file_ids) if fetched}
+
+
+def fill_missing_dimensions(session: Session, folder_id: str, limit: int = PROBE_LIMIT_PER_FOLDER) -> int:
+    """
+    Ảnh chưa có width/height (Drive không trả imageMediaMetadata) -> đọc header bằng Range request.
+    Header đọc được mà không parse được -> ghi 0x0 để lần sync sau không thử lại;
+    tải header lỗi -> giữ NULL để lần sau đọc lại. Có commit.
+    """
+    missing = list(session.exec(
+        select(Image.id)
+        .where(Image.folder_id == folder_id)
+        .where(Image.width == None)  # noqa: E711
+        .limit(limit)
+    ).all())
+    if not missing:
+        return 0
+
+    sizes = probe_image_sizes(missing)
+    if not sizes:
+        logger.warning(f"⚠️ Folder {folder_id}: không tải được header ảnh nào, để lần sau")
+        return 0
+    rows = [
+        {"id": fid, "w": size[0] if size else 0, "h": size[1] if size else 0}
+        for fid, size in sizes.items()
+    ]
+
+    values_sql = ", ".join(f"(:id{n}, CAST(:w{n} AS INTEGER), CAST(:h{n} AS INTEGER))" for n in range(len(rows)))
+    params = {}
+    for n, r in enumerate(rows):
+        params.update({f"id{n}": r["id"], f"w{n}": r["w"], f"h{n}": r["h"]})
+
+    session.exec(text(f"""
+        UPDATE images AS i SET width = v.w, height = v.h
+        FROM (VALUES {values_sql}) AS v(id, w, h)
+        WHERE i.id = v.id
+    """), params=params)
+    session.commit()
+
+    found = sum(1 for r in rows if r["w"])
+    logger.info(
+        f"📐 Folder {folder_id}: đọc header {len(rows)}/{len(missing)} ảnh, {found} có kích thước"
+    )
+    return len(rows)
@@ -0,0 +1,368 @@
+# app/ingest_buffer.py
+"""
+Bộ đệm ghi (Group commit) cho dữ liệu Extension gửi lên
+- Request chỉ cần ghi 1 dòng JSON vào file spool + fsync là trả về (bền vững trên đĩa)
+- Thread flusher gom nhiều request, ghi Postgres trong 1 transaction mỗi N ms hoặc M row
+- Crash giữa chừng: lúc khởi động đọc lại các segment spool chưa xóa và ghi lại (at-least-once,
+  các hàm ingest đều là upsert nên ghi lại không sinh trùng, trừ log thô analytics_post_metric)
+- Mỗi thư mục spool chỉ 1 process sở hữu (khóa file). Process khác -> ghi trực tiếp như cũ
+- Lỗi tạm thời (mất kết nối DB...) -> giữ nguyên segment, thử lại lần flush sau
+  Lỗi dữ liệu (tràn INTEGER, vi phạm FK...) -> ghi lại từng entry riêng, entry lỗi chuyển sang
+  spool-*.dead (dead-letter) để 1 bản ghi hỏng không chặn các segment phía sau
+- Idempotency-Key: chỉ ghi vào DB cùng transaction flush dữ liệu (key không bao giờ bền vững trước dữ liệu);
+  trong lúc chờ flush, key nằm trong _pending_keys -> retry cùng key không bị spool lần 2
+"""
+import os
+import json
+import glob
+import time
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+from sqlmodel import Session
+
+from app.database import engine
+from app.ingest_service import (
+    upsert_page_health, upsert_post_meta, ingest_post_metrics, remember_idempotency_key,
+)
+
+logger = logging.getLogger(__name__)
+
+BUFFER_ENABLED = os.getenv("INGEST_BUFFER_ENABLED", "0") == "1"
+SPOOL_DIR = os.getenv("INGEST_SPOOL_DIR", "ingest_spool")
+FLUSH_INTERVAL_MS = int(os.getenv("INGEST_FLUSH_INTERVAL_MS", "250"))
+FLUSH_MAX_ROWS = int(os.getenv("INGEST_FLUSH_MAX_ROWS", "5000"))
+
+# Thứ tự áp dụng trong 1 lần flush: bài viết trước, rồi health, rồi metrics (metrics cần PostMeta)
+KIND_ORDER = {"posts": 0, "page_health": 1, "post_metrics": 2}
+
+
+def apply_entries(session: Session, entries: List[Dict]) -> Dict[str, int]:
+    """Ghi các entry spool vào DB (không commit). Dùng chung cho flush và replay."""
+    counts = {"posts": 0, "page_health": 0, "post_metrics": 0}
+    ordered = sorted(enumerate(entries), key=lambda x: (KIND_ORDER.get(x[1]["kind"], 9), x[0]))
+
+    # posts / page_health: gộp cả lô thành 1 lần upsert
+    for kind in ("posts", "page_health"):
+        records = [r for _, e in ordered if e["kind"] == kind for r in e["records"]]
+        if not records:
+            continue
+        if kind == "posts":
+            upsert_post_meta(session, records)
+        else:
+            upsert_page_health(session, records)
+        counts[kind] = len(records)
+
+    # post_metrics: giữ thời điểm nhận request làm thời điểm quét (quyết định local_day)
+    for _, e in ordered:
+        if e["kind"] == "post_metrics":
+            received_at = datetime.fromisoformat(e["received_at"])
+            ingest_post_metrics(session, e["records"], scanned_at=received_at)
+            counts["post_metrics"] += len(e["records"])
+
+    # Idempotency-Key ghi cùng transaction với dữ liệu của request
+    for e in entries:
+        idem = e.get("idempotency")
+        if idem:
+            remember_idempotency_key(session, idem["endpoint"], idem["key"], idem["response"])
+    return counts
+
+
+def is_transient_error(e: Exception) -> bool:
+    """Lỗi do kết nối / server DB (thử lại được), không phải do dữ liệu"""
+    if isinstance(e, (OperationalError, InterfaceError)):
+        return True
+    return isinstance(e, DBAPIError) and e.connection_invalidated
+
+
+def _count_lines(path: str) -> int:
+    with open(path, "r", encoding="utf-8") as f:
+        return sum(1 for _ in f)
+
+
+def _read_segment(path: str) -> List[Dict]:
+    entries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                # Dòng cuối ghi dở lúc crash (chưa fsync xong -> request chưa được ack)
+                logger.warning(f"⚠️ Bỏ qua dòng spool hỏng trong {path}")
+    return entries
+
+
+def _lock_file(f) -> bool:
+    """Khóa độc quyền không chờ trên file đang mở (POSIX: flock, Windows: msvcrt)"""
+    try:
+        if os.name == "nt":
+            import msvcrt
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+class IngestBuffer:
+    def __init__(self, spool_dir: str = SPOOL_DIR, flush_interval_ms: int = FLUSH_INTERVAL_MS,
+                 max_rows: int = FLUSH_MAX_ROWS):
+        self.spool_dir = spool_dir
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_rows = max_rows
+
+        self._cond = threading.Condition()
+        self._segment_path: Optional[str] = None
+        self._segment = None
+        self._entries: List[Dict] = []
+        self._rows = 0
+        # Segment đã xoay nhưng ghi DB lỗi -> thử lại trước khi flush segment mới
+        self._retry: List[Tuple[str, List[Dict]]] = []
+        self._retry_entries: Dict[str, List[Dict]] = {}
+        # (endpoint, key) -> response của các entry đã spool nhưng chưa flush xong
+        self._pending_keys: Dict[Tuple[str, str], Dict] = {}
+
+        self._lock_handle = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self.active = False
+        self.stats = {
+            "appended_rows": 0, "flushed_rows": 0, "flushes": 0, "flush_errors": 0,
+            # Số entry nằm trong các file spool-*.dead (kể cả từ lần chạy trước)
+            "dead_letters": 0,
+        }
+
+    # --- Vòng đời ---
+
+    def start(self) -> bool:
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._lock_handle = open(os.path.join(self.spool_dir, ".lock"), "a+")
+        if not _lock_file(self._lock_handle):
+            logger.warning(f"⚠️ Spool {self.spool_dir} đã có process khác giữ -> ghi trực tiếp DB")
+            self._lock_handle.close()
+            return False
+
+        self.stats["dead_letters"] = sum(
+            _count_lines(p) for p in glob.glob(os.path.join(self.spool_dir, "spool-*.dead"))
+        )
+        self._replay_leftovers()
+        self._open_segment()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="ingest-flusher", daemon=True)
+        self._thread.start()
+        self.active = True
+        logger.info(f"📥 Ingest buffer bật: flush mỗi {int(self.flush_interval * 1000)}ms / {self.max_rows} row")
+        return True
+
+    def stop(self):
+        if not self.active:
+            return
+        self.active = False
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout=30)
+            if self._thread.is_alive():
+                # Flusher còn kẹt trong 1 lần flush -> không flush chồng lên cùng segment, không đóng file nó đang dùng.
+                # Segment còn lại được replay ở lần khởi động sau
+                logger.warning("⚠️ Ingest flusher chưa dừng sau 30s -> để spool lại cho lần khởi động sau")
+                return
+        self._flush()
+        if self._segment:
+            self._segment.close()
+        self._lock_handle.close()
+
+    # --- Ghi ---
+
+    def pending_response(self, endpoint: str, key: Optional[str]) -> Optional[Dict]:
+        """Response của request cùng (endpoint, key) đã spool nhưng chưa flush, None nếu không có"""
+        if not key:
+            return None
+        with self._cond:
+            return self._pending_keys.get((endpoint, key))
+
+    def append(self, kind: str, records: List[Dict], idempotency: Optional[Dict] = None) -> int:
+        """
+        Ghi bền vững xuống spool (fsync) rồi trả về. Dữ liệu vào DB ở lần flush kế tiếp.
+        idempotency: {"endpoint", "key", "response"} -> key được ghi cùng transaction flush.
+        Key đang chờ flush (request trùng chen vào) -> không ghi lại, trả về 0
+        """
+        entry = {"kind": kind, "records": records, "received_at": datetime.utcnow().isoformat()}
+        pending_key = None
+        if idempotency and idempotency.get("key"):
+            entry["idempotency"] = idempotency
+            pending_key = (idempotency["endpoint"], idempotency["key"])
+        line = json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+        with self._cond:
+            if pending_key in self._pending_keys:
+                return 0
+            self._segment.write(line)
+            self._segment.flush()
+            os.fsync(self._segment.fileno())
+            self._entries.append(entry)
+            if pending_key:
+                self._pending_keys[pending_key] = idempotency["response"]
+            self._rows += len(records)
+            self.stats["appended_rows"] += len(records)
+            if self._rows >= self.max_rows:
+                self._cond.notify()
+        return len(records)
+
+    # --- Flush ---
+
+    def _track_keys(self, entries: List[Dict]):
+        with self._cond:
+            for e in entries:
+                idem = e.get("idempotency")
+                if idem:
+                    self._pending_keys[(idem["endpoint"], idem["key"])] = idem["response"]
+
+    def _forget_keys(self, entries: List[Dict]):
+        """Gọi sau khi entry đã commit vào DB (key đã có trong DB) hoặc đã vào dead-letter (key không được ghi)"""
+        with self._cond:
+            for e in entries:
+                idem = e.get("idempotency")
+                if idem:
+                    self._pending_keys.pop((idem["endpoint"], idem["key"]), None)
+
+    def _open_segment(self):
+        self._segment_path = os.path.join(self.spool_dir, f"spool-{time.time_ns()}.log")
+        self._segment = open(self._segment_path, "a", encoding="utf-8")
+
+    def _rotate(self) -> Optional[Tuple[str, List[Dict]]]:
+        """Đóng segment hiện tại (kèm entry của nó), mở segment mới. Gọi khi đang giữ _cond"""
+        if not self._entries:
+            return None
+        self._segment.close()
+        rotated = (self._segment_path, self._entries)
+        self._entries, self._rows = [], 0
+        self._open_segment()
+        return rotated
+
+    def _apply_segment(self, path: str, entries: List[Dict]) -> bool:
+        """True = segment đã xử lý xong (ghi DB hoặc vào dead-letter) và bị xóa. False = lỗi tạm thời, thử lại sau"""
+        try:
+            with Session(engine) as session:
+                counts = apply_entries(session, entries)
+                session.commit()
+        except Exception as e:
+            self.stats["flush_errors"] += 1
+            if is_transient_error(e):
+                logger.error(f"❌ Flush spool lỗi kết nối, sẽ thử lại: {e}")
+                return False
+            logger.error(f"❌ Flush spool lỗi dữ liệu, ghi lại từng entry: {e}")
+            return self._apply_one_by_one(path, entries)
+        os.remove(path)
+        self._forget_keys(entries)
+        self.stats["flushes"] += 1
+        self.stats["flushed_rows"] += sum(counts.values())
+        return True
+
+    def _apply_one_by_one(self, path: str, entries: List[Dict]) -> bool:
+        """Mỗi entry 1 transaction; entry lỗi dữ liệu -> dead-letter, lỗi tạm thời -> giữ phần còn lại để thử lại"""
+        dead_path = path[:-len(".log")] + ".dead"
+        for i, entry in enumerate(entries):
+            try:
+                with Session(engine) as session:
+                    counts = apply_entries(session, [entry])
+                    session.commit()
+                self.stats["flushed_rows"] += sum(counts.values())
+                self._forget_keys([entry])
+            except Exception as e:
+                if is_transient_error(e):
+                    # Ghi đè segment bằng phần chưa xử lý -> replay / retry không ghi lại entry đã xong
+                    self._rewrite_segment(path, entries[i:])
+                    self._retry_entries[path] = entries[i:]
+                    logger.error(f"❌ Mất kết nối khi ghi lại từng entry, sẽ thử lại: {e}")
+                    return False
+                self._dead_letter(dead_path, entry, e)
+                self._forget_keys([entry])
+        os.remove(path)
+        self.stats["flushes"] += 1
+        return True
+
+    def _dead_letter(self, dead_path: str, entry: Dict, error: Exception):
+        line = json.dumps({**entry, "error": str(error)[:1000]}, ensure_ascii=False, default=str) + "\n"
+        with open(dead_path, "a", encoding="utf-8") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self.stats["dead_letters"] += 1
+        records = entry.get("records") or []
+        logger.error(
+            f"☠️ Entry {entry.get('kind')} ({len(records)} record) lỗi dữ liệu -> {os.path.basename(dead_path)}: {error}"
+        )
+
+    @staticmethod
+    def _rewrite_segment(path: str, entries: List[Dict]):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _flush(self):
+        with self._cond:
+            rotated = self._rotate()
+        if rotated:
+            self._retry.append(rotated)
+        while self._retry:
+            path, entries = self._retry[0]
+            # Lần trước ghi từng entry dở dang -> chỉ còn phần chưa xử lý
+            entries = self._retry_entries.pop(path, entries)
+            if not self._apply_segment(path, entries):
+                return
+            self._retry.pop(0)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopping and self._rows < self.max_rows:
+                    self._cond.wait(self.flush_interval)
+                if self._stopping:
+                    return
+            self._flush()
+
+    def _replay_leftovers(self):
+        """Segment còn lại từ lần chạy trước (crash / tắt đột ngột) -> ghi lại vào DB"""
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, "spool-*.log"))):
+            entries = _read_segment(path)
+            if not entries:
+                os.remove(path)
+                continue
+            logger.info(f"♻️ Replay {len(entries)} entry từ {os.path.basename(path)}")
+            self._track_keys(entries)
+            if not self._apply_segment(path, entries):
+                self._retry.append((path, entries))
+
+
+_buffer: Optional[IngestBuffer] = None
+
+
+def start_ingest_buffer():
+    global _buffer
+    if not BUFFER_ENABLED or _buffer:
+        return
+    buffer = IngestBuffer()
+    if buffer.start():
+        _buffer = buffer
+
+
+def stop_ingest_buffer():
+    global _buffer
+    if _buffer:
+        _buffer.stop()
+        _buffer = None
+
+
+def get_ingest_buffer() -> Optional[IngestBuffer]:
+    """Buffer đang hoạt động trong process này, None -> endpoint ghi trực tiếp"""
+    return _buffer if _buffer and _buffer.active else None
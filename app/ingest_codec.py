@@ -0,0 +1,159 @@
+# app/ingest_codec.py
+"""
+Giải mã body của các endpoint ingest theo lô (Extension gửi 1000+ row / request)
+- Content-Encoding: gzip
+- Content-Type: application/json (mặc định) hoặc application/msgpack
+- Dạng cột (columnar): {"columns": {"post_id": [...], "reach": [...], ...}} -> mỗi field gửi 1 lần
+  Dạng list object cũ vẫn dùng được
+- Validate cả lô 1 lần bằng Pydantic TypeAdapter (thay vì FastAPI validate từng object)
+Decoder nhanh: msgspec nếu có cài, không thì msgpack / json chuẩn
+"""
+import os
+import json
+import zlib
+from typing import Any, Callable, Dict, List, Type
+
+from fastapi import HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ValidationError
+
+try:
+    from pydantic import TypeAdapter
+except ImportError:  # Pydantic v1
+    TypeAdapter = None
+    from pydantic import parse_obj_as
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Chặn body quá lớn: cả bytes nhận về (gzip hay không) lẫn body sau giải nén (gzip bomb) tối đa N MB
+MAX_DECODED_BYTES = int(os.getenv("INGEST_MAX_BODY_MB", "50")) * 1024 * 1024
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+
+
+def _gunzip(body: bytes) -> bytes:
+    decoder = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    try:
+        data = decoder.decompress(body, MAX_DECODED_BYTES)
+    except zlib.error:
+        raise HTTPException(status_code=400, detail="Invalid gzip body")
+    if decoder.unconsumed_tail:
+        raise HTTPException(status_code=413, detail="Decoded body too large")
+    return data
+
+
+def _loads(body: bytes, content_type: str) -> Any:
+    try:
+        if content_type in MSGPACK_TYPES:
+            if msgspec:
+                return msgspec.msgpack.decode(body)
+            if msgpack:
+                return msgpack.unpackb(body, raw=False)
+            raise HTTPException(status_code=415, detail="msgpack not supported on this server")
+        if msgspec:
+            return msgspec.json.decode(body)
+        return json.loads(body)
+    except HTTPException:
+        raise
+    except Exception:
+        raise HTTPException(status_code=400, detail="Malformed request body")
+
+
+def columns_to_rows(payload: Dict) -> List[Dict]:
+    """{"columns": {field: [v1, v2, ...]}} -> [{field: v1}, {field: v2}, ...]. Lô rỗng ({} / cột rỗng) -> []"""
+    columns = payload.get("columns")
+    if not isinstance(columns, dict):
+        raise HTTPException(status_code=400, detail="'columns' must be an object of lists")
+    if not columns:
+        return []
+    if not all(isinstance(v, list) for v in columns.values()):
+        raise HTTPException(status_code=400, detail="Every column must be a list")
+
+    lengths = {len(v) for v in columns.values()}
+    if len(lengths) != 1:
+        raise HTTPException(status_code=400, detail="All columns must have the same length")
+
+    names = list(columns.keys())
+    return [dict(zip(names, values)) for values in zip(*columns.values())]
+
+
+async def _read_body(request: Request) -> bytes:
+    """Đọc body theo stream, vượt MAX_DECODED_BYTES thì dừng ngay (không đọc hết vào RAM rồi mới kiểm)"""
+    declared = request.headers.get("content-length", "")
+    if declared.isdigit() and int(declared) > MAX_DECODED_BYTES:
+        raise HTTPException(status_code=413, detail="Body too large")
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_DECODED_BYTES:
+            raise HTTPException(status_code=413, detail="Body too large")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+async def read_payload(request: Request) -> Any:
+    body = await _read_body(request)
+    if request.headers.get("content-encoding", "").lower() == "gzip":
+        body = _gunzip(body)
+
+    content_type = request.headers.get("content-type", "application/json").split(";")[0].strip().lower()
+    return _loads(body, content_type)
+
+
+async def read_rows(request: Request) -> List[Dict]:
+    payload = await read_payload(request)
+    if isinstance(payload, dict) and "columns" in payload:
+        return columns_to_rows(payload)
+    if not isinstance(payload, list):
+        raise HTTPException(status_code=400, detail="Expected a list of records or a columnar object")
+    return payload
+
+
+_adapters: Dict[type, Any] = {}
+
+
+def _validate(tp, data):
+    """Validate bằng TypeAdapter dựng sẵn (cache theo kiểu). Lỗi -> 422 cùng format FastAPI"""
+    try:
+        if TypeAdapter is None:
+            return parse_obj_as(tp, data)
+        adapter = _adapters.get(tp)
+        if adapter is None:
+            adapter = _adapters[tp] = TypeAdapter(tp)
+        return adapter.validate_python(data)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+
+def validate_batch(model: Type[BaseModel], rows: List[Dict]) -> List[BaseModel]:
+    """Validate cả lô trong 1 lần gọi"""
+    return _validate(List[model], rows)
+
+
+def batch_body(model: Type[BaseModel]) -> Callable:
+    """Dependency: body (json / msgpack, gzip, list hoặc columnar) -> List[model]"""
+    async def dependency(request: Request) -> List[BaseModel]:
+        return validate_batch(model, await read_rows(request))
+    return dependency
+
+
+def object_body(model: Type[BaseModel]) -> Callable:
+    """Dependency: body là 1 object (json / msgpack, gzip), field dạng list cũng được gửi dạng cột"""
+    async def dependency(request: Request) -> BaseModel:
+        payload = await read_payload(request)
+        if not isinstance(payload, dict):
+            raise HTTPException(status_code=400, detail="Expected an object")
+        payload = {
+            k: columns_to_rows(v) if isinstance(v, dict) and "columns" in v else v
+            for k, v in payload.items()
+        }
+        return _validate(model, payload)
+    return dependency
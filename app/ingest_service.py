@@ -0,0 +1,418 @@
+# app/ingest_service.py
+"""
+Ghi dữ liệu Analytics từ Extension theo lô (set-based)
+- Không query từng row, không commit -> endpoint (hoặc caller) tự commit 1 lần
+- Input là list dict (đã qua Pydantic ở tầng API)
+"""
+import os
+import hashlib
+import logging
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import DateTime, String, and_, column, func, literal_column, or_, values
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlmodel import Session, select, update, delete, text
+
+from app.rollup_service import mark_rollup_dirty, mark_stats_cache_dirty
+from app.models import (
+    Page, PageConfig, PageHealth, PostMeta, PostMetric, PostDailyMetric, IngestIdempotencyKey,
+)
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000
+
+HEALTH_FIELDS = (
+    "followers_total", "followers_new", "unfollows", "net_follows",
+    "total_reach", "total_interaction", "link_clicks",
+)
+
+POST_METRIC_FIELDS = (
+    "reach", "impressions", "reactions", "comments", "shares", "clicks", "other_clicks",
+)
+
+# Ngày "local" của snapshot = giờ quét (UTC) + offset (mặc định +7h, giờ Việt Nam)
+LOCAL_UTC_OFFSET_HOURS = float(os.getenv("STATS_UTC_OFFSET_HOURS", "7"))
+LOCAL_DAY_OFFSET = timedelta(hours=LOCAL_UTC_OFFSET_HOURS)
+
+# Log thô analytics_post_metric (1 row / lần quét) giờ là tùy chọn, stats đọc analytics_post_daily
+RAW_METRIC_LOG_ENABLED = os.getenv("POST_METRIC_RAW_LOG", "1") == "1"
+# Giữ log thô bao nhiêu ngày (0 = giữ vĩnh viễn)
+RAW_METRIC_RETENTION_DAYS = int(os.getenv("POST_METRIC_RAW_RETENTION_DAYS", "0"))
+
+# Idempotency-Key của request ingest giữ bao lâu
+IDEMPOTENCY_TTL_HOURS = int(os.getenv("INGEST_IDEMPOTENCY_TTL_HOURS", "48"))
+
+# Field của PostMeta hay đến muộn (lần quét sau mới có) -> cho phép bổ sung vào bài đã tồn tại
+POST_META_LATE_FIELDS = ("permalink", "caption_snippet", "folder_id")
+
+
+def parse_created_time(value: Optional[str]) -> datetime:
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except (ValueError, AttributeError):
+        return datetime.utcnow()
+
+
+def parse_record_date(value: Optional[str]) -> Optional[date]:
+    """'YYYY-MM-DD' hoặc ISO datetime -> date. Sai format -> None"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).date()
+    except (ValueError, AttributeError):
+        return None
+
+
+def existing_page_ids(session: Session, page_ids) -> set:
+    """1 query IN để lọc page chưa tồn tại (tránh vỡ cả lô vì FK)"""
+    page_ids = list(set(page_ids))
+    if not page_ids:
+        return set()
+    return set(session.exec(select(Page.page_id).where(Page.page_id.in_(page_ids))).all())
+
+
+def foreign_post_ids(session: Session, post_ids, page_id: str) -> List[str]:
+    """post_id đã có PostMeta nhưng thuộc page khác page_id (1 query / 1000 bài)"""
+    post_ids = list(set(post_ids))
+    foreign: List[str] = []
+    for i in range(0, len(post_ids), CHUNK_SIZE):
+        foreign.extend(session.exec(
+            select(PostMeta.post_id)
+            .where(PostMeta.post_id.in_(post_ids[i:i + CHUNK_SIZE]))
+            .where(PostMeta.page_id != page_id)
+        ).all())
+    return sorted(foreign)
+
+
+def upsert_page_health(session: Session, records: List[Dict]) -> Dict:
+    """
+    Ghi nhiều (page_id, ngày) bằng INSERT ... ON CONFLICT (page_id, record_date) DO UPDATE,
+    sau đó đẩy watermark last_synced_date cho tất cả page bị ảnh hưởng bằng 1 câu UPDATE.
+    """
+    rows: Dict[tuple, Dict] = {}
+    invalid = 0
+    for r in records:
+        r_date = parse_record_date(r.get("record_date"))
+        if not r_date:
+            invalid += 1
+            continue
+        row = {"page_id": r["page_id"], "record_date": datetime.combine(r_date, time.min)}
+        row.update({f: r.get(f) or 0 for f in HEALTH_FIELDS})
+        # Trùng (page, ngày) trong cùng lô -> bản sau thắng (ON CONFLICT không cho đụng 1 row 2 lần)
+        rows[(row["page_id"], r_date)] = row
+
+    known = existing_page_ids(session, [k[0] for k in rows])
+    unknown_pages = sorted({k[0] for k in rows} - known)
+    rows_list = [row for (page_id, _), row in rows.items() if page_id in known]
+
+    for i in range(0, len(rows_list), CHUNK_SIZE):
+        stmt = pg_insert(PageHealth).values(rows_list[i:i + CHUNK_SIZE])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["page_id", "record_date"],
+            set_={f: stmt.excluded[f] for f in HEALTH_FIELDS},
+        )
+        session.exec(stmt)
+
+    # Watermark: ngày lớn nhất vừa ghi của từng page
+    watermarks: Dict[str, datetime] = {}
+    for row in rows_list:
+        current = watermarks.get(row["page_id"])
+        if not current or row["record_date"] > current:
+            watermarks[row["page_id"]] = row["record_date"]
+    advance_watermarks(session, watermarks)
+    mark_rollup_dirty(session, {(row["page_id"], row["record_date"].date()) for row in rows_list})
+
+    return {
+        "upserted": len(rows_list),
+        "pages": len(watermarks),
+        "invalid": invalid,
+        "unknown_pages": unknown_pages,
+    }
+
+
+def advance_watermarks(session: Session, page_dates: Dict[str, datetime]) -> None:
+    """Tịnh tiến PageConfig.last_synced_date (chỉ tăng, không lùi) cho nhiều page trong 1 câu UPDATE"""
+    if not page_dates:
+        return
+    v = values(
+        column("page_id", String),
+        column("synced_date", DateTime),
+        name="v",
+    ).data(list(page_dates.items()))
+
+    session.exec(
+        update(PageConfig)
+        .where(PageConfig.page_id == v.c.page_id)
+        .where(or_(PageConfig.last_synced_date == None, PageConfig.last_synced_date < v.c.synced_date))  # noqa: E711
+        .values(last_synced_date=v.c.synced_date)
+    )
+
+
+def upsert_post_meta(session: Session, posts: List[Dict], update_existing: bool = True) -> Dict:
+    """
+    Ghi metadata bài viết bằng INSERT ... ON CONFLICT (post_id), không lookup từng bài.
+    - update_existing=False: DO NOTHING (metadata chỉ tạo 1 lần)
+    - update_existing=True: bổ sung permalink / caption_snippet / folder_id nếu lần này mới có
+    Đếm mới / đã có / được cập nhật từ RETURNING (xmax = 0 <=> row vừa INSERT).
+    """
+    rows: Dict[str, Dict] = {}
+    for p in posts:
+        rows[p["post_id"]] = {
+            "post_id": p["post_id"],
+            "page_id": p["page_id"],
+            "created_time": parse_created_time(p.get("created_time")),
+            "post_type": p.get("post_type"),
+            "permalink": p.get("permalink"),
+            "caption_snippet": p.get("caption_snippet"),
+            "folder_id": p.get("folder_id"),
+        }
+
+    known = existing_page_ids(session, [r["page_id"] for r in rows.values()])
+    rows_list = [r for r in rows.values() if r["page_id"] in known]
+    table = PostMeta.__table__
+
+    count_new, count_updated = 0, 0
+    touched_pages = set()
+    for i in range(0, len(rows_list), CHUNK_SIZE):
+        stmt = pg_insert(PostMeta).values(rows_list[i:i + CHUNK_SIZE])
+        if update_existing:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["post_id"],
+                set_={f: func.coalesce(stmt.excluded[f], table.c[f]) for f in POST_META_LATE_FIELDS},
+                # Chỉ đụng tới row khi thật sự có giá trị mới -> không sinh dead tuple vô ích
+                where=or_(*[
+                    and_(stmt.excluded[f].isnot(None), stmt.excluded[f].is_distinct_from(table.c[f]))
+                    for f in POST_META_LATE_FIELDS
+                ]),
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=["post_id"])
+
+        returned = session.exec(
+            stmt.returning(table.c.post_id, table.c.page_id, literal_column("(xmax = 0)").label("inserted"))
+        ).fetchall()
+        chunk_new = sum(1 for r in returned if r.inserted)
+        count_new += chunk_new
+        count_updated += len(returned) - chunk_new
+        touched_pages.update(r.page_id for r in returned)
+
+    # Caption / permalink hiển thị ở top posts + page detail -> cache /stats của các page này cũ sau commit
+    mark_stats_cache_dirty(session, {(page_id, None) for page_id in touched_pages})
+
+    return {
+        "new_posts": count_new,
+        "existing_posts": len(rows_list) - count_new,
+        "updated_posts": count_updated,
+        "skipped_unknown_page": len(rows) - len(rows_list),
+    }
+
+
+def local_day_of(ts: datetime) -> date:
+    return (ts + LOCAL_DAY_OFFSET).date()
+
+
+def local_today() -> date:
+    return local_day_of(datetime.utcnow())
+
+
+def metric_values_hash(m: Dict) -> str:
+    """Hash gọn (16 hex) của các chỉ số + is_final"""
+    raw = "|".join(str(m.get(f) or 0) for f in POST_METRIC_FIELDS) + f"|{int(bool(m.get('is_final')))}"
+    return hashlib.blake2b(raw.encode(), digest_size=8).hexdigest()
+
+
+def _lookup_metric_hashes(session: Session, post_ids: List[str], local_day: date) -> Dict[str, Tuple[str, Optional[str]]]:
+    """
+    post_id -> (page_id, hash đã lưu của ngày local_day | None). Bài chưa có PostMeta không có trong kết quả.
+    Luôn đọc từ DB (1 query / 1000 bài theo PK analytics_post_daily): cache trong RAM của từng process
+    không thấy bản ghi do process khác ghi -> có thể bỏ qua nhầm một snapshot mà DB không có
+    """
+    known: Dict[str, Tuple[str, Optional[str]]] = {}
+    for i in range(0, len(post_ids), CHUNK_SIZE):
+        rows = session.exec(
+            select(PostMeta.post_id, PostMeta.page_id, PostDailyMetric.values_hash)
+            .join(
+                PostDailyMetric,
+                and_(PostDailyMetric.post_id == PostMeta.post_id, PostDailyMetric.local_day == local_day),
+                isouter=True,
+            )
+            .where(PostMeta.post_id.in_(post_ids[i:i + CHUNK_SIZE]))
+        ).all()
+        known.update({post_id: (page_id, values_hash) for post_id, page_id, values_hash in rows})
+    return known
+
+
+def ingest_post_metrics(session: Session, metrics: List[Dict], scanned_at: Optional[datetime] = None) -> Dict:
+    """
+    Ghi snapshot chỉ số bài viết:
+    - analytics_post_daily: upsert theo (post_id, local_day), chỉ giữ snapshot mới nhất trong ngày
+    - analytics_post_metric: log thô (tùy chọn, POST_METRIC_RAW_LOG)
+    Chỉ số y hệt lần lưu trước trong cùng ngày (so values_hash) -> không ghi gì, chỉ cập nhật last_scanned_at.
+    Bài chưa có PostMeta bị bỏ qua.
+    """
+    scanned_at = scanned_at or datetime.utcnow()
+    local_day = local_day_of(scanned_at)
+
+    # Trùng post_id trong cùng lô -> bản sau thắng
+    latest: Dict[str, Dict] = {m["post_id"]: m for m in metrics}
+    hashes = {post_id: metric_values_hash(m) for post_id, m in latest.items()}
+    known = _lookup_metric_hashes(session, list(latest.keys()), local_day)
+
+    rows = []
+    for post_id, (page_id, stored_hash) in known.items():
+        if stored_hash == hashes[post_id]:
+            continue
+        m = latest[post_id]
+        row = {
+            "post_id": post_id,
+            "updated_at": scanned_at,
+            "local_day": local_day,
+            "is_final": bool(m.get("is_final")),
+        }
+        row.update({f: m.get(f) or 0 for f in POST_METRIC_FIELDS})
+        rows.append(row)
+
+    for i in range(0, len(rows), CHUNK_SIZE):
+        chunk = rows[i:i + CHUNK_SIZE]
+
+        if RAW_METRIC_LOG_ENABLED:
+            session.exec(pg_insert(PostMetric).values(chunk))
+
+        daily_rows = [
+            {**r, "page_id": known[r["post_id"]][0], "values_hash": hashes[r["post_id"]]}
+            for r in chunk
+        ]
+        stmt = pg_insert(PostDailyMetric).values(daily_rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["post_id", "local_day"],
+            set_={f: stmt.excluded[f] for f in POST_METRIC_FIELDS + ("updated_at", "is_final", "values_hash")},
+            # Request đến trễ (retry cũ) không được đè snapshot mới hơn
+            where=PostDailyMetric.__table__.c.updated_at <= stmt.excluded.updated_at,
+        )
+        session.exec(stmt)
+
+    mark_rollup_dirty(session, {(known[r["post_id"]][0], local_day) for r in rows})
+
+    # Trạng thái quét trên PostMeta cho scan planner (không bao giờ lùi mốc / bỏ cờ final)
+    scanned_ids = list(known.keys())
+    for i in range(0, len(scanned_ids), CHUNK_SIZE):
+        session.exec(
+            update(PostMeta)
+            .where(PostMeta.post_id.in_(scanned_ids[i:i + CHUNK_SIZE]))
+            .where(or_(PostMeta.last_scanned_at == None, PostMeta.last_scanned_at < scanned_at))  # noqa: E711
+            .values(last_scanned_at=scanned_at)
+        )
+    final_ids = [r["post_id"] for r in rows if r["is_final"]]
+    for i in range(0, len(final_ids), CHUNK_SIZE):
+        session.exec(update(PostMeta).where(PostMeta.post_id.in_(final_ids[i:i + CHUNK_SIZE])).values(is_final=True))
+
+    return {
+        "saved": len(rows),
+        "unchanged": len(known) - len(rows),
+        "skipped_unknown_post": len(latest) - len(known),
+        "local_day": local_day.isoformat(),
+    }
+
+
+def ingest_bundle(session: Session, health: List[Dict], posts: List[Dict], metrics: List[Dict],
+                  scanned_at: Optional[datetime] = None) -> Dict:
+    """
+    Toàn bộ dữ liệu của 1 page trong 1 lần gọi, đúng thứ tự phụ thuộc (không commit):
+    1. PostMeta (metrics cần bài đã tồn tại)
+    2. Snapshot chỉ số -> analytics_post_daily (+ log thô)
+    3. Page health + watermark
+    4. Rollup page_daily_stats: tính lại 1 lần cho mọi (page, ngày) bị ảnh hưởng lúc caller commit
+    Caller commit 1 lần -> không bao giờ ghi dở dang.
+    """
+    return {
+        "posts": upsert_post_meta(session, posts) if posts else None,
+        "post_metrics": ingest_post_metrics(session, metrics, scanned_at=scanned_at) if metrics else None,
+        "page_health": upsert_page_health(session, health) if health else None,
+    }
+
+
+def _idempotency_pk(endpoint: str, key: str) -> str:
+    return f"{endpoint}:{key}"
+
+
+def get_idempotent_response(session: Session, endpoint: str, key: Optional[str]) -> Optional[Dict]:
+    """Kết quả đã lưu cho (endpoint, Idempotency-Key), None nếu key mới / không gửi key. Chỉ đọc"""
+    if not key:
+        return None
+    row = session.get(IngestIdempotencyKey, _idempotency_pk(endpoint, key))
+    return (row.response or {}) if row else None
+
+
+def reserve_idempotency_key(session: Session, endpoint: str, key: Optional[str],
+                            response: Optional[Dict] = None) -> Optional[Dict]:
+    """
+    Giữ key ngay lúc nhận request: INSERT ... ON CONFLICT DO NOTHING (không commit).
+    Request trùng key đang chạy song song sẽ chờ unique index tới khi request đầu commit / rollback.
+    Trả về None nếu giữ được (hoặc không gửi key), response đã lưu nếu key đã có
+    """
+    if not key:
+        return None
+    pk = _idempotency_pk(endpoint, key)
+    reserved = session.exec(
+        pg_insert(IngestIdempotencyKey)
+        .values(key=pk, endpoint=endpoint, response=response, created_at=datetime.utcnow())
+        .on_conflict_do_nothing(index_elements=["key"])
+        .returning(IngestIdempotencyKey.__table__.c.key)
+    ).first()
+    if reserved:
+        return None
+    row = session.get(IngestIdempotencyKey, pk)
+    return (row.response if row else None) or {}
+
+
+def remember_idempotency_key(session: Session, endpoint: str, key: Optional[str], response: Dict) -> None:
+    """Ghi kết quả vào key (đã giữ lúc nhận request, hoặc tạo mới) cùng transaction với dữ liệu. Không commit"""
+    if not key:
+        return
+    stmt = pg_insert(IngestIdempotencyKey).values(
+        key=_idempotency_pk(endpoint, key), endpoint=endpoint, response=response, created_at=datetime.utcnow()
+    )
+    session.exec(stmt.on_conflict_do_update(
+        index_elements=["key"],
+        set_={"response": stmt.excluded.response},
+        where=IngestIdempotencyKey.__table__.c.response == None,  # noqa: E711
+    ))
+
+
+def purge_idempotency_keys(session: Session, ttl_hours: int = IDEMPOTENCY_TTL_HOURS) -> int:
+    """Xóa Idempotency-Key quá hạn. Có commit."""
+    cutoff = datetime.utcnow() - timedelta(hours=ttl_hours)
+    result = session.exec(delete(IngestIdempotencyKey).where(IngestIdempotencyKey.created_at < cutoff))
+    session.commit()
+    return result.rowcount
+
+
+def purge_raw_post_metrics(session: Session, retention_days: int = RAW_METRIC_RETENTION_DAYS, batch_size: int = 5000) -> int:
+    """Xóa log thô cũ hơn N ngày theo từng lô nhỏ (không giữ lock lâu). Có commit."""
+    if retention_days <= 0:
+        return 0
+    cutoff_day = local_today() - timedelta(days=retention_days)
+    # local_day < cutoff_day <=> updated_at < cutoff_ts: điều kiện trên updated_at để chỉ quét các partition tháng cũ
+    cutoff_ts = datetime.combine(cutoff_day, time.min) - LOCAL_DAY_OFFSET
+    total = 0
+    while True:
+        # Lọc theo local_day (có index) thay vì biểu thức trên updated_at
+        result = session.exec(text("""
+            DELETE FROM analytics_post_metric
+            WHERE (id, updated_at) IN (
+                SELECT id, updated_at FROM analytics_post_metric
+                WHERE local_day < :cutoff_day
+                  AND updated_at < :cutoff_ts
+                LIMIT :batch_size
+            )
+            AND updated_at < :cutoff_ts
+        """), params={"cutoff_day": cutoff_day, "cutoff_ts": cutoff_ts, "batch_size": batch_size})
+        session.commit()
+        total += result.rowcount
+        if result.rowcount < batch_size:
+            break
+    if total:
+        logger.info(f"🧹 Đã xóa {total} snapshot thô cũ hơn {retention_days} ngày")
+    return total
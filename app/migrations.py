@@ -0,0 +1,243 @@
+# app/migrations.py
+"""
+Migration gọn nhẹ chạy lúc startup (sau SQLModel.metadata.create_all)
+- create_all chỉ tạo bảng MỚI, không ALTER bảng đã có -> cột/index mới của bảng cũ khai báo ở đây
+- Mỗi migration chạy đúng 1 lần (ghi tên vào bảng schema_migrations), trong 1 transaction
+- Advisory lock để nhiều process khởi động cùng lúc không chạy trùng
+"""
+import logging
+from datetime import date
+from typing import Callable, List, Tuple, Union
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_LOCK_KEY = 727000
+
+# Mỗi bước là 1 câu SQL hoặc 1 hàm nhận Connection (cho logic cần Python)
+Step = Union[str, Callable[[Connection], None]]
+
+
+def _backfill_post_daily(conn: Connection):
+    # Dựng bảng snapshot theo ngày từ log thô hiện có (bản mới nhất của mỗi post / ngày local)
+    # Cùng offset với lúc ingest (STATS_UTC_OFFSET_HOURS)
+    from app.ingest_service import LOCAL_UTC_OFFSET_HOURS  # Import lười để tránh vòng lặp
+
+    conn.execute(text("""
+        INSERT INTO analytics_post_daily (
+            post_id, local_day, page_id, updated_at,
+            reach, impressions, reactions, comments, shares, clicks, other_clicks, is_final
+        )
+        SELECT DISTINCT ON (pm.post_id, CAST(pm.updated_at + make_interval(secs => :offset_seconds) AS DATE))
+            pm.post_id,
+            CAST(pm.updated_at + make_interval(secs => :offset_seconds) AS DATE),
+            am.page_id,
+            pm.updated_at,
+            COALESCE(pm.reach, 0), COALESCE(pm.impressions, 0), COALESCE(pm.reactions, 0),
+            COALESCE(pm.comments, 0), COALESCE(pm.shares, 0), COALESCE(pm.clicks, 0),
+            COALESCE(pm.other_clicks, 0), COALESCE(pm.is_final, false)
+        FROM analytics_post_metric pm
+        JOIN analytics_post_meta am ON am.post_id = pm.post_id
+        ORDER BY pm.post_id, CAST(pm.updated_at + make_interval(secs => :offset_seconds) AS DATE), pm.updated_at DESC
+        ON CONFLICT (post_id, local_day) DO NOTHING
+    """), {"offset_seconds": LOCAL_UTC_OFFSET_HOURS * 3600})
+
+
+def _backfill_post_metric_local_day(conn: Connection):
+    # Cùng offset với lúc ingest (STATS_UTC_OFFSET_HOURS)
+    from app.ingest_service import LOCAL_UTC_OFFSET_HOURS  # Import lười để tránh vòng lặp
+
+    conn.execute(text("""
+        UPDATE analytics_post_metric
+        SET local_day = CAST(updated_at + make_interval(secs => :offset_seconds) AS DATE)
+        WHERE local_day IS NULL
+    """), {"offset_seconds": LOCAL_UTC_OFFSET_HOURS * 3600})
+
+
+
+def _backfill_page_daily_stats(conn: Connection):
+    from app.rollup_service import rebuild_query  # Import lười để tránh vòng lặp
+
+    conn.execute(rebuild_query(), {"start": date.min, "end": date.max})
+
+
+def _backfill_followers_asof(conn: Connection):
+    from app.rollup_service import carry_forward_query, carry_forward_starts_sql, carry_forward_until  # Import lười để tránh vòng lặp
+
+    conn.execute(carry_forward_query(carry_forward_starts_sql()), {"start": date.min, "until": carry_forward_until([])})
+
+
+def _partition_by_month(table: str) -> Step:
+    """
+    Chuyển bảng thường sang bảng partition theo tháng (bảng do create_all tạo ở DB mới đã là partition -> bỏ qua):
+    đổi tên bảng cũ + index + sequence sang *_legacy, tạo bảng mới từ model, tạo partition phủ dữ liệu cũ,
+    chép dữ liệu (giữ nguyên id), đẩy sequence mới qua id lớn nhất, drop bảng cũ
+    """
+    def step(conn: Connection):
+        from app.models import PageHealth, PostMetric  # Import lười để tránh vòng lặp
+        from app.partition_service import PARTITIONED_TABLES, ensure_partitions, is_partitioned
+
+        if is_partitioned(conn, table):
+            ensure_partitions(conn)
+            return
+
+        model = {PageHealth.__tablename__: PageHealth, PostMetric.__tablename__: PostMetric}[table]
+        column = PARTITIONED_TABLES[table]
+        legacy = f"{table}_legacy"
+        old_seq = conn.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"), {"table": table}).scalar()
+
+        conn.execute(text(f"ALTER TABLE {table} RENAME TO {legacy}"))
+        indexes = conn.execute(text("""
+            SELECT indexname FROM pg_indexes WHERE tablename = :legacy AND schemaname = current_schema()
+        """), {"legacy": legacy}).scalars().all()
+        for index in indexes:
+            conn.execute(text(f'ALTER INDEX "{index}" RENAME TO "{index[:50]}_legacy"'))
+        if old_seq:
+            conn.execute(text(f"ALTER SEQUENCE {old_seq} RENAME TO {table}_id_seq_legacy"))
+
+        model.__table__.create(conn)
+        first_month = conn.execute(text(f"SELECT MIN({column}) FROM {legacy}")).scalar()
+        ensure_partitions(conn, from_month=first_month.date() if first_month else None)
+
+        columns = ", ".join(c.name for c in model.__table__.columns)
+        copied = conn.execute(text(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {legacy}")).rowcount
+        # id tiếp theo nối tiếp sequence cũ (kể cả id đã cấp rồi bị xóa)
+        old_last = f"(SELECT last_value FROM {table}_id_seq_legacy)" if old_seq else "1"
+        conn.execute(text(f"""
+            SELECT setval(pg_get_serial_sequence('{table}', 'id'),
+                          GREATEST((SELECT MAX(id) FROM {table}), {old_last}, 1))
+        """))
+        conn.execute(text(f"DROP TABLE {legacy}"))
+        logger.info(f"🧩 {table}: chuyển {copied} row sang bảng partition theo tháng")
+
+    return step
+
+
+MIGRATIONS: List[Tuple[str, List[Step]]] = [
+    ("028_image_fingerprint", [
+        "ALTER TABLE images ADD COLUMN IF NOT EXISTS modified_time TIMESTAMP",
+        "ALTER TABLE images ADD COLUMN IF NOT EXISTS fingerprint VARCHAR",
+    ]),
+    ("029_image_dimensions", [
+        "ALTER TABLE images ADD COLUMN IF NOT EXISTS width INTEGER",
+        "ALTER TABLE images ADD COLUMN IF NOT EXISTS height INTEGER",
+        "ALTER TABLE images ADD COLUMN IF NOT EXISTS size_bytes INTEGER",
+    ]),
+    ("031_page_health_unique_day", [
+        # Dữ liệu cũ có thể trùng ngày (lưu kèm giờ) -> giữ bản ghi mới nhất, chuẩn hóa về 00:00
+        """
+        DELETE FROM analytics_page_health a
+        USING analytics_page_health b
+        WHERE a.page_id = b.page_id
+          AND date_trunc('day', a.record_date) = date_trunc('day', b.record_date)
+          AND a.id < b.id
+        """,
+        """
+        UPDATE analytics_page_health SET record_date = date_trunc('day', record_date)
+        WHERE record_date <> date_trunc('day', record_date)
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_page_health_page_date ON analytics_page_health (page_id, record_date)",
+    ]),
+    ("033_backfill_post_daily", [
+        _backfill_post_daily,
+    ]),
+    ("035_post_meta_active_index", [
+        """
+        CREATE INDEX IF NOT EXISTS ix_post_meta_page_created_nostory
+        ON analytics_post_meta (page_id, created_time)
+        WHERE post_type <> 'STORY'
+        """,
+    ]),
+    ("036_post_meta_scan_state", [
+        "ALTER TABLE analytics_post_meta ADD COLUMN IF NOT EXISTS is_final BOOLEAN NOT NULL DEFAULT false",
+        "ALTER TABLE analytics_post_meta ADD COLUMN IF NOT EXISTS last_scanned_at TIMESTAMP",
+        # Lần quét gần nhất + cờ final lấy từ bảng snapshot theo ngày
+        """
+        UPDATE analytics_post_meta am
+        SET last_scanned_at = d.last_scanned_at, is_final = am.is_final OR d.is_final
+        FROM (
+            SELECT post_id, MAX(updated_at) AS last_scanned_at, bool_or(is_final) AS is_final
+            FROM analytics_post_daily
+            GROUP BY post_id
+        ) d
+        WHERE am.post_id = d.post_id
+        """,
+    ]),
+    ("038_post_daily_values_hash", [
+        "ALTER TABLE analytics_post_daily ADD COLUMN IF NOT EXISTS values_hash VARCHAR",
+    ]),
+    ("041_post_metric_local_day", [
+        "ALTER TABLE analytics_post_metric ADD COLUMN IF NOT EXISTS local_day DATE",
+        _backfill_post_metric_local_day,
+        "CREATE INDEX IF NOT EXISTS ix_analytics_post_metric_local_day ON analytics_post_metric (local_day)",
+        """
+        CREATE INDEX IF NOT EXISTS ix_post_metric_post_day_updated
+        ON analytics_post_metric (post_id, local_day, updated_at DESC)
+        """,
+    ]),
+    ("042_page_daily_stats_backfill", [
+        # Bảng do create_all tạo, ở đây chỉ dựng dữ liệu lần đầu từ health + snapshot theo ngày
+        _backfill_page_daily_stats,
+    ]),
+    ("047_page_daily_stats_followers_asof", [
+        "ALTER TABLE page_daily_stats ADD COLUMN IF NOT EXISTS followers_asof INTEGER",
+        # Điền đủ mọi ngày từ health đầu tiên của từng page tới ngày mai
+        _backfill_followers_asof,
+    ]),
+    ("050_partition_analytics_by_month", [
+        # Chạy lúc startup, TRƯỚC scheduler -> chép nguyên bảng chưa downsample (049 chưa kịp chạy),
+        # giữ ACCESS EXCLUSIVE suốt lúc chép và mọi process khởi động phải chờ migration xong.
+        # Bảng lớn: deploy trong khung giờ bảo trì, hoặc chạy compact_post_metrics tay trước khi deploy
+        _partition_by_month("analytics_post_metric"),
+        _partition_by_month("analytics_page_health"),
+    ]),
+    ("030_rendition_source_modified_time", [
+        "ALTER TABLE image_renditions ADD COLUMN IF NOT EXISTS source_modified_time TIMESTAMP",
+        # Rendition tạo sau lần sửa cuối của ảnh gốc vẫn còn đúng -> không phải render lại lúc deploy
+        """
+        UPDATE image_renditions r
+        SET source_modified_time = i.modified_time
+        FROM images i
+        WHERE i.id = r.image_id AND (i.modified_time IS NULL OR r.created_at >= i.modified_time)
+        """,
+        "ALTER TABLE image_renditions DROP COLUMN IF EXISTS source_fingerprint",
+    ]),
+]
+
+
+def run_migrations(engine: Engine):
+    with engine.connect() as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        conn.commit()
+        try:
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    name VARCHAR PRIMARY KEY,
+                    applied_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'UTC')
+                )
+            """))
+            conn.commit()
+
+            applied = set(conn.execute(text("SELECT name FROM schema_migrations")).scalars())
+
+            for name, steps in MIGRATIONS:
+                if name in applied:
+                    continue
+                logger.info(f"🧱 Migration {name}...")
+                try:
+                    for step in steps:
+                        if callable(step):
+                            step(conn)
+                        else:
+                            conn.execute(text(step))
+                    conn.execute(text("INSERT INTO schema_migrations (name) VALUES (:name)"), {"name": name})
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    logger.error(f"❌ Migration {name} lỗi, dừng tại đây")
+                    raise
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+            conn.commit()
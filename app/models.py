@@ -1,8 +1,8 @@
 # app/models.py
 from typing import Optional, List
 from sqlmodel import SQLModel, Field, Relationship
-from sqlalchemy import Column, JSON, Text, Date
-from datetime import datetime
+from sqlalchemy import Column, JSON, Text, Date, Index, UniqueConstraint, text
+from datetime import date, datetime
 
 # 1. Bảng Page (Đã cập nhật các field mới)
 class Page(SQLModel, table=True):
@@ -66,6 +66,13 @@ class Image(SQLModel, table=True):
     mime_type: Optional[str] = None
     thumbnail_link: Optional[str] = None
     created_time: Optional[datetime] = None
+    modified_time: Optional[datetime] = None
+    # md5(name|mime|modifiedTime) -> sync chỉ UPDATE ảnh có fingerprint thay đổi
+    fingerprint: Optional[str] = None
+    # Kích thước ảnh (từ imageMediaMetadata của Drive hoặc đọc header). 0 = đã thử nhưng không đọc được
+    width: Optional[int] = None
+    height: Optional[int] = None
+    size_bytes: Optional[int] = None
     folder_id: Optional[str] = Field(default=None, foreign_key="folders.id")
     
     folder: Optional[Folder] = Relationship(back_populates="images")
@@ -107,14 +114,21 @@ class SwipeLinkUsage(SQLModel, table=True):
 # 8. Sức khỏe Page theo ngày (Lưu lịch sử biến động)
 class PageHealth(SQLModel, table=True):
     __tablename__ = "analytics_page_health"
+    __table_args__ = (
+        # 1 page chỉ có 1 record / ngày -> ingest dùng INSERT ... ON CONFLICT DO UPDATE
+        UniqueConstraint("page_id", "record_date", name="uq_page_health_page_date"),
+        # Partition theo tháng trên record_date (app/partition_service.py, migration 050)
+        {"postgresql_partition_by": "RANGE (record_date)"},
+    )
     
     # Khóa chính phức hợp (Composite Key) giả lập
     # Lưu ý: SQLModel chưa hỗ trợ composite PK trực tiếp tốt, nên ta dùng ID tự tăng
-    # và đặt UniqueConstraint ở mức DB (sẽ xử lý sau nếu cần).
-    id: Optional[int] = Field(default=None, primary_key=True)
+    # và UniqueConstraint (page_id, record_date) ở mức DB.
+    # Bảng partition: PK bắt buộc chứa cột partition -> (id, record_date)
+    id: Optional[int] = Field(default=None, primary_key=True, sa_column_kwargs={"autoincrement": True})
     
     page_id: str = Field(foreign_key="pages.page_id", index=True)
-    record_date: datetime = Field(index=True)  # Ngày ghi nhận (YYYY-MM-DD)
+    record_date: datetime = Field(primary_key=True, index=True)  # Ngày ghi nhận (YYYY-MM-DD 00:00)
     
     # Chỉ số Tăng trưởng (Growth)
     followers_total: int = Field(default=0)
@@ -133,6 +147,15 @@ class PageHealth(SQLModel, table=True):
 # 9. Metadata Bài viết (Lưu thông tin tĩnh, chỉ tạo 1 lần)
 class PostMeta(SQLModel, table=True):
     __tablename__ = "analytics_post_meta"
+    __table_args__ = (
+        # Phục vụ /sync/active-posts: bài (không phải story) của page trong N ngày gần nhất
+        Index(
+            "ix_post_meta_page_created_nostory",
+            "page_id",
+            "created_time",
+            postgresql_where=text("post_type <> 'STORY'"),
+        ),
+    )
     
     post_id: str = Field(primary_key=True)
     page_id: str = Field(foreign_key="pages.page_id", index=True)
@@ -143,6 +166,10 @@ class PostMeta(SQLModel, table=True):
     post_type: Optional[str] = None        # PHOTO, VIDEO, ALBUM, STATUS...
     permalink: Optional[str] = None        # Link gốc bài viết
     caption_snippet: Optional[str] = None  # 50 ký tự đầu để nhận diện nội dung
+
+    # Lập lịch quét chỉ số (/sync/scan-plan)
+    is_final: bool = Field(default=False)           # Quá tuổi quét -> không bao giờ quét lại
+    last_scanned_at: Optional[datetime] = None      # Lần gần nhất Extension gửi metrics của bài
     
     # Quan hệ
     metrics: List["PostMetric"] = Relationship(back_populates="post_meta")
@@ -150,11 +177,20 @@ class PostMeta(SQLModel, table=True):
 # 10. Chỉ số Bài viết (Lưu Snapshot biến động)
 class PostMetric(SQLModel, table=True):
     __tablename__ = "analytics_post_metric"
+    __table_args__ = (
+        Index("ix_post_metric_post_day_updated", "post_id", "local_day", text("updated_at DESC")),
+        # Partition theo tháng trên updated_at (app/partition_service.py, migration 050)
+        {"postgresql_partition_by": "RANGE (updated_at)"},
+    )
     
-    id: Optional[int] = Field(default=None, primary_key=True)
+    # Bảng partition: PK bắt buộc chứa cột partition -> (id, updated_at)
+    id: Optional[int] = Field(default=None, primary_key=True, sa_column_kwargs={"autoincrement": True})
     post_id: str = Field(foreign_key="analytics_post_meta.post_id", index=True)
     
-    updated_at: datetime = Field(default_factory=datetime.utcnow) # Thời điểm quét
+    updated_at: datetime = Field(default_factory=datetime.utcnow, primary_key=True) # Thời điểm quét
+    # Ngày local (UTC + STATS_UTC_OFFSET_HOURS) của lần quét, ghi lúc ingest -> lọc theo ngày dùng được index
+    # Lọc theo ngày nên kèm điều kiện updated_at tương ứng để Postgres bỏ qua các partition tháng khác
+    local_day: Optional[date] = Field(default=None, index=True)
     
     # Các chỉ số Engagement (Analyst cần cái này để tính tỷ lệ)
     reach: int = Field(default=0)
@@ -169,4 +205,126 @@ class PostMetric(SQLModel, table=True):
     # Cờ đánh dấu để tối ưu hiệu năng quét
     is_final: bool = Field(default=False) # Nếu bài > 7 ngày -> True -> Extension sẽ bỏ qua không quét nữa
     
-    post_meta: Optional[PostMeta] = Relationship(back_populates="metrics")
\ No newline at end of file
+    post_meta: Optional[PostMeta] = Relationship(back_populates="metrics")
+
+# 11. Hàng đợi Sync (Job bền vững - sống sót qua restart, có checkpoint theo folder)
+class SyncJob(SQLModel, table=True):
+    __tablename__ = "sync_jobs"
+    __table_args__ = (
+        # Khóa: tại một thời điểm chỉ có tối đa 1 job FULL đang chờ hoặc đang chạy
+        Index(
+            "uq_sync_jobs_active_full",
+            "kind",
+            unique=True,
+            postgresql_where=text("kind = 'FULL' AND status IN ('PENDING', 'RUNNING')"),
+        ),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    kind: str = Field(default="FULL")                  # FULL | FOLDER
+    status: str = Field(default="PENDING", index=True) # PENDING | RUNNING | DONE | FAILED
+
+    # Danh sách folder cần quét (FULL: chụp lại sau bước sync structure)
+    folder_ids: List[str] = Field(default=[], sa_column=Column(JSON))
+    # Checkpoint: vị trí folder tiếp theo trong folder_ids -> restart sẽ chạy tiếp từ đây
+    position: int = Field(default=0)
+
+    total_folders: int = Field(default=0)
+    done_folders: int = Field(default=0)
+    failed_folders: int = Field(default=0)
+    attempts: int = Field(default=0)
+    error: Optional[str] = Field(default=None, sa_column=Column(Text))
+
+    worker_id: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    started_at: Optional[datetime] = None
+    heartbeat_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+# 12. Trạng thái lịch Sync của từng Folder (Scheduler tự điều chỉnh nhịp quét)
+class FolderSyncState(SQLModel, table=True):
+    __tablename__ = "folder_sync_state"
+
+    # Không đặt FK sang folders để sync structure xóa folder không bị vướng
+    folder_id: str = Field(primary_key=True)
+
+    is_hot: bool = Field(default=False)               # Folder đang được Page đủ điều kiện dùng
+    interval_minutes: int = Field(default=60)         # Nhịp quét hiện tại (tự co giãn theo tần suất thay đổi)
+    last_synced_at: Optional[datetime] = None
+    last_change_count: int = Field(default=0)         # Số ảnh thêm/xóa/sửa ở lần quét gần nhất
+    next_sync_at: Optional[datetime] = Field(default=None, index=True)
+
+# 13. Bản render sẵn (Rendition) của ảnh: POST ~1080px ngang, STORY 1080x1920
+class ImageRendition(SQLModel, table=True):
+    __tablename__ = "image_renditions"
+    __table_args__ = (
+        Index("uq_image_renditions_image_kind", "image_id", "kind", unique=True),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    image_id: str = Field(index=True)
+    kind: str                                   # POST | STORY
+    content_hash: str = Field(index=True)       # sha256 nội dung file -> tên file trong cache
+    path: str                                   # Đường dẫn file trong static_images/renditions
+    width: int = Field(default=0)
+    height: int = Field(default=0)
+    size_bytes: int = Field(default=0)
+    source_modified_time: Optional[datetime] = None  # Image.modified_time lúc render -> nội dung ảnh gốc đổi thì render lại
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+# 14. Snapshot mới nhất của bài viết theo ngày (1 row / post / ngày local)
+# Ingest upsert vào đây -> query stats chỉ cần range scan, không phải DISTINCT ON cả lịch sử
+class PostDailyMetric(SQLModel, table=True):
+    __tablename__ = "analytics_post_daily"
+    __table_args__ = (
+        Index("ix_post_daily_page_day", "page_id", "local_day"),
+    )
+
+    post_id: str = Field(primary_key=True, foreign_key="analytics_post_meta.post_id")
+    local_day: date = Field(primary_key=True)  # Ngày theo giờ địa phương (UTC+7) của lần quét
+    page_id: str = Field(foreign_key="pages.page_id")
+
+    updated_at: datetime = Field(default_factory=datetime.utcnow)  # Thời điểm quét của snapshot này
+
+    reach: int = Field(default=0)
+    impressions: int = Field(default=0)
+    reactions: int = Field(default=0)
+    comments: int = Field(default=0)
+    shares: int = Field(default=0)
+    clicks: int = Field(default=0)
+    other_clicks: int = Field(default=0)
+    is_final: bool = Field(default=False)
+    values_hash: Optional[str] = None  # Hash gọn các chỉ số -> Extension gửi lại y hệt thì bỏ qua không ghi
+
+# 15. Idempotency-Key của các request ingest theo lô (retry cùng key -> trả lại kết quả cũ, không ghi lại)
+class IngestIdempotencyKey(SQLModel, table=True):
+    __tablename__ = "ingest_idempotency_keys"
+
+    key: str = Field(primary_key=True)
+    endpoint: str
+    response: Optional[dict] = Field(default=None, sa_column=Column(JSON))
+    created_at: datetime = Field(default_factory=datetime.utcnow, index=True)
+
+# 16. Rollup theo Page x ngày (stats đọc ở đây thay vì tổng hợp lại từ health + snapshot bài mỗi request)
+# Ingest tự cập nhật các (page, ngày) bị ảnh hưởng ngay trong transaction ghi (app/rollup_service.py)
+class PageDailyStats(SQLModel, table=True):
+    __tablename__ = "page_daily_stats"
+
+    page_id: str = Field(primary_key=True, foreign_key="pages.page_id")
+    day: date = Field(primary_key=True, index=True)
+
+    reach: int = Field(default=0)                   # analytics_page_health.total_reach
+    impressions: int = Field(default=0)             # SUM analytics_post_daily.impressions của ngày
+    clicks: int = Field(default=0)                  # analytics_page_health.link_clicks
+    engagement: int = Field(default=0)              # analytics_page_health.total_interaction
+    followers_total: Optional[int] = None           # Followers cuối ngày (NULL = ngày chưa có page health)
+    followers_asof: Optional[int] = None            # Followers tính tới ngày này (carry-forward từ health gần nhất)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+# 17. Checkpoint của các job bảo trì chạy theo lô (chạy tiếp từ chỗ dừng sau restart / hết lượt)
+class MaintenanceCheckpoint(SQLModel, table=True):
+    __tablename__ = "maintenance_checkpoints"
+
+    name: str = Field(primary_key=True)           # vd: post_metric_daily, post_metric_weekly
+    done_through: Optional[date] = None           # Đã xử lý xong tới ngày này (tính cả ngày này)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
@@ -0,0 +1,160 @@
+# app/partition_service.py
+"""
+Partition theo tháng (RANGE) cho 2 bảng analytics lớn dần theo thời gian
+- analytics_post_metric  theo updated_at   (thời điểm quét, UTC)
+- analytics_page_health  theo record_date  (ngày ghi nhận 00:00)
+Tên partition: <bảng>_pYYYYMM, cộng 1 partition DEFAULT hứng dữ liệu lệch (ngày quá xa / quá cũ)
+- ensure_partitions: tạo trước các tháng tới (PARTITION_MONTHS_AHEAD), chạy lúc startup + task định kỳ
+  Tháng mới mà DEFAULT đang có row của tháng đó -> tách DEFAULT, tạo tháng, chuyển row, gắn lại
+- detach_old_partitions: tách partition cũ khỏi bảng trong O(1) (giữ lại thành bảng thường để lưu trữ / drop)
+  Chỉ áp cho các bảng trong PARTITION_DETACH_TABLES (mặc định chỉ analytics_post_metric):
+  analytics_page_health là nguồn duy nhất của rebuild_page_daily_stats + followers_asof -> tách đi là mất lịch sử rollup
+Query nên lọc thẳng trên cột partition (updated_at / record_date) để Postgres chỉ đụng các tháng liên quan
+"""
+import os
+import logging
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from sqlmodel import Session
+
+logger = logging.getLogger(__name__)
+
+# bảng -> cột partition
+PARTITIONED_TABLES: Dict[str, str] = {
+    "analytics_post_metric": "updated_at",
+    "analytics_page_health": "record_date",
+}
+
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+# Tách partition cũ hơn N tháng (0 = không tự tách)
+PARTITION_DETACH_AFTER_MONTHS = int(os.getenv("PARTITION_DETACH_AFTER_MONTHS", "0"))
+# Bảng được tự tách partition cũ (phân cách bằng dấu phẩy)
+PARTITION_DETACH_TABLES = [
+    t.strip() for t in os.getenv("PARTITION_DETACH_TABLES", "analytics_post_metric").split(",")
+    if t.strip() in PARTITIONED_TABLES
+]
+
+PARTITION_LOCK_KEY = 727002
+
+
+def month_start(d: date) -> date:
+    return date(d.year, d.month, 1)
+
+
+def add_months(d: date, months: int) -> date:
+    index = d.year * 12 + d.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_p{month:%Y%m}"
+
+
+def is_partitioned(conn: Connection, table: str) -> bool:
+    return bool(conn.execute(text("""
+        SELECT 1 FROM pg_partitioned_table pt
+        JOIN pg_class c ON c.oid = pt.partrelid
+        WHERE c.relname = :table AND c.relnamespace = to_regnamespace(current_schema())::oid
+    """), {"table": table}).scalar())
+
+
+def _existing_partitions(conn: Connection, table: str) -> List[str]:
+    return list(conn.execute(text("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = CAST(:table AS regclass)
+    """), {"table": table}).scalars())
+
+
+def _create_month_partition(conn: Connection, table: str, column: str, month: date):
+    name = partition_name(table, month)
+    lower, upper = month, add_months(month, 1)
+    default = f"{table}_default"
+    has_default_rows = conn.execute(text(f"""
+        SELECT EXISTS (SELECT 1 FROM {default} WHERE {column} >= :lower AND {column} < :upper)
+    """), {"lower": lower, "upper": upper}).scalar()
+
+    if not has_default_rows:
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} FOR VALUES FROM ('{lower}') TO ('{upper}')"
+        ))
+        return
+
+    # DEFAULT đang giữ row của tháng này -> không tạo thẳng được, chuyển row sang partition mới
+    conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {default}"))
+    conn.execute(text(
+        f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM ('{lower}') TO ('{upper}')"
+    ))
+    moved = conn.execute(text(f"""
+        WITH moved AS (
+            DELETE FROM {default} WHERE {column} >= :lower AND {column} < :upper
+            RETURNING *
+        )
+        INSERT INTO {table} SELECT * FROM moved
+    """), {"lower": lower, "upper": upper}).rowcount
+    conn.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {default} DEFAULT"))
+    logger.info(f"🧩 {name}: chuyển {moved} row từ {default}")
+
+
+def ensure_partitions(conn: Connection, from_month: Optional[date] = None,
+                      months_ahead: int = PARTITION_MONTHS_AHEAD) -> int:
+    """Tạo partition DEFAULT + các tháng [from_month (mặc định tháng này), tháng này + months_ahead]. Không commit"""
+    # Nhiều process (startup / task định kỳ) không tạo trùng cùng lúc
+    conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": PARTITION_LOCK_KEY})
+    current = month_start(datetime.utcnow().date())
+    created = 0
+    for table, column in PARTITIONED_TABLES.items():
+        if not is_partitioned(conn, table):
+            continue
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+        existing = set(_existing_partitions(conn, table))
+        month = month_start(from_month) if from_month else current
+        last = add_months(current, months_ahead)
+        while month <= last:
+            if partition_name(table, month) not in existing:
+                _create_month_partition(conn, table, column, month)
+                created += 1
+            month = add_months(month, 1)
+    if created:
+        logger.info(f"🧩 Đã tạo {created} partition theo tháng")
+    return created
+
+
+def detach_old_partitions(conn: Connection, table: str, before_month: date, drop: bool = False) -> List[str]:
+    """
+    Tách các partition tháng < before_month khỏi bảng (O(1), chỉ đổi metadata).
+    drop=False -> giữ lại thành bảng độc lập (lưu trữ / pg_dump rồi drop sau). Không commit
+    """
+    detached = []
+    for name in sorted(_existing_partitions(conn, table)):
+        suffix = name[len(table) + 2:]
+        if not name.startswith(f"{table}_p") or len(suffix) != 6 or not suffix.isdigit():
+            continue
+        if date(int(suffix[:4]), int(suffix[4:]), 1) >= before_month:
+            continue
+        conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+        if drop:
+            conn.execute(text(f"DROP TABLE {name}"))
+        detached.append(name)
+    if detached:
+        logger.info(f"📦 {table}: tách {len(detached)} partition cũ ({'drop' if drop else 'giữ lại'})")
+    return detached
+
+
+def maintain_partitions(session: Session) -> int:
+    """
+    Task định kỳ: tạo trước partition tháng tới, tách partition quá PARTITION_DETACH_AFTER_MONTHS
+    của các bảng trong PARTITION_DETACH_TABLES. Có commit
+    """
+    conn = session.connection()
+    created = ensure_partitions(conn)
+    if PARTITION_DETACH_AFTER_MONTHS > 0:
+        before = add_months(month_start(datetime.utcnow().date()), -PARTITION_DETACH_AFTER_MONTHS)
+        for table in PARTITION_DETACH_TABLES:
+            if is_partitioned(conn, table):
+                detach_old_partitions(conn, table, before)
+    session.commit()
+    return created
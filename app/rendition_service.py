@@ -0,0 +1,288 @@
+# app/rendition_service.py
+"""
+Pipeline render sẵn ảnh (Ahead-of-time rendition)
+- Sau mỗi lượt sync: ảnh mới / ảnh đổi nội dung (modified_time) được render sẵn
+  + Folder _STORY -> STORY: crop 1080x1920
+  + Folder còn lại -> POST: thu về tối đa 1080px chiều ngang
+- Render chạy trong ProcessPoolExecutor (decode/resize ảnh tốn CPU, tránh GIL)
+- File ghi vào static_images/renditions/<sha256>.jpg (content hash -> cache vĩnh viễn)
+- Proxy /api/image/{id} trả rendition mặc định, ?original=1 để lấy ảnh gốc
+- Mỗi lúc chỉ 1 process render (advisory lock), dọn file mồ côi chỉ xóa file cũ hơn RENDITION_ORPHAN_GRACE_SECONDS
+- Chỉ render ảnh tạo / sửa từ ngày bật tính năng (checkpoint renditions_since, tạo ở lượt render đầu tiên);
+  ảnh cũ hơn vẫn dùng ảnh gốc. Render lại toàn bộ thư viện là việc chủ động: POST /sync/renditions/backfill
+"""
+import io
+import os
+import time
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, date
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlmodel import Session, select, delete, text
+
+from app.models import Image, ImageRendition, MaintenanceCheckpoint
+from app.drive_service import download_image_from_drive
+
+logger = logging.getLogger(__name__)
+
+RENDITION_DIR = os.path.join("static_images", "renditions")
+RENDER_WORKERS = int(os.getenv("RENDITION_WORKERS", "2"))
+RENDER_BATCH = int(os.getenv("RENDITION_BATCH", "200"))
+# File vừa render nhưng chưa kịp ghi DB trông giống file mồ côi -> chỉ xóa file cũ hơn ngần này
+ORPHAN_GRACE_SECONDS = int(os.getenv("RENDITION_ORPHAN_GRACE_SECONDS", "3600"))
+JPEG_QUALITY = 85
+
+# Khóa advisory: nhiều process uvicorn chỉ 1 con render tại một thời điểm
+RENDITION_LOCK_KEY = 727004
+
+# MaintenanceCheckpoint: ngày bật rendition (mốc render tự động) / cờ yêu cầu render toàn bộ thư viện
+SINCE_CHECKPOINT = "renditions_since"
+BACKFILL_CHECKPOINT = "renditions_backfill"
+
+POST_MAX_WIDTH = 1080
+STORY_SIZE = (1080, 1920)
+
+
+def rendition_kind_for_folder(folder_name: Optional[str]) -> str:
+    return "STORY" if (folder_name or "").upper().endswith("_STORY") else "POST"
+
+
+# Cùng quy tắc với rendition_kind_for_folder, dùng trong SQL (alias f = folders)
+_KIND_SQL = "CASE WHEN upper(f.name) LIKE '%\\_STORY' THEN 'STORY' ELSE 'POST' END"
+
+
+def _render(source, kind: str):
+    """Nhận PIL Image gốc, trả về PIL Image đã render theo loại"""
+    from PIL import Image as PILImage, ImageOps
+
+    if kind == "STORY":
+        return ImageOps.fit(source, STORY_SIZE, PILImage.LANCZOS, centering=(0.5, 0.5))
+
+    if source.width <= POST_MAX_WIDTH:
+        return source
+    height = round(source.height * POST_MAX_WIDTH / source.width)
+    return source.resize((POST_MAX_WIDTH, height), PILImage.LANCZOS)
+
+
+def render_image_worker(image_id: str, kind: str) -> Dict:
+    """
+    Chạy trong process con: tải ảnh gốc, render, ghi file theo content hash.
+    Trả về metadata cho process cha ghi DB (process con không đụng DB).
+    """
+    try:
+        from PIL import Image as PILImage, ImageOps
+    except ImportError:
+        return {"image_id": image_id, "error": "Pillow chưa được cài (pip install pillow)"}
+
+    stream = download_image_from_drive(image_id)
+    if not stream:
+        return {"image_id": image_id, "error": "Không tải được ảnh gốc"}
+
+    try:
+        source = PILImage.open(stream)
+        source = ImageOps.exif_transpose(source).convert("RGB")
+        rendered = _render(source, kind)
+
+        out = io.BytesIO()
+        rendered.save(out, format="JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+        data = out.getvalue()
+    except Exception as e:
+        return {"image_id": image_id, "error": f"Lỗi render: {e}"}
+
+    content_hash = hashlib.sha256(data).hexdigest()
+    path = os.path.join(RENDITION_DIR, f"{content_hash}.jpg")
+    if not os.path.exists(path):
+        os.makedirs(RENDITION_DIR, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)  # Ghi atomic: không bao giờ serve file ghi dở
+
+    return {
+        "image_id": image_id,
+        "kind": kind,
+        "content_hash": content_hash,
+        "path": path,
+        "width": rendered.width,
+        "height": rendered.height,
+        "size_bytes": len(data),
+    }
+
+
+# (image_id, modified_time) render lỗi trong process này -> không thử lại liên tục
+_failed: set = set()
+
+
+def get_renditions_since(session: Session) -> date:
+    """Mốc render tự động. Lượt render đầu tiên ghi mốc = hôm nay (UTC), các lượt sau giữ nguyên"""
+    session.exec(
+        pg_insert(MaintenanceCheckpoint)
+        .values(name=SINCE_CHECKPOINT, done_through=datetime.utcnow().date(), updated_at=datetime.utcnow())
+        .on_conflict_do_nothing(index_elements=["name"])
+    )
+    session.commit()
+    return session.get(MaintenanceCheckpoint, SINCE_CHECKPOINT).done_through
+
+
+def request_rendition_backfill(session: Session):
+    """Bật render toàn bộ thư viện (kể cả ảnh trước mốc). Cờ tự xóa khi đã render hết"""
+    checkpoint = session.get(MaintenanceCheckpoint, BACKFILL_CHECKPOINT) or MaintenanceCheckpoint(name=BACKFILL_CHECKPOINT)
+    checkpoint.updated_at = datetime.utcnow()
+    session.add(checkpoint)
+    session.commit()
+
+
+def rendition_backfill_requested(session: Session) -> bool:
+    return session.get(MaintenanceCheckpoint, BACKFILL_CHECKPOINT) is not None
+
+
+def find_images_to_render(session: Session, limit: int = RENDER_BATCH,
+                          since: Optional[date] = None) -> List[Tuple[str, str, Optional[datetime]]]:
+    """
+    Ảnh chưa có rendition đúng loại, hoặc rendition cũ render từ bản gốc trước lần sửa cuối (modified_time khác).
+    Không dùng fingerprint: đổi tên / đổi thumbnailLink không làm đổi nội dung ảnh.
+    since: chỉ lấy ảnh tạo hoặc sửa từ ngày này (None = cả thư viện).
+    Ảnh mới nhất trước. Trả về [(image_id, kind, modified_time)]
+    """
+    since_filter = "AND GREATEST(i.created_time, i.modified_time) >= :since" if since else ""
+    rows = session.exec(text(f"""
+        SELECT i.id, i.modified_time, {_KIND_SQL} AS kind
+        FROM images i
+        JOIN folders f ON f.id = i.folder_id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM image_renditions r
+            WHERE r.image_id = i.id
+              AND r.kind = {_KIND_SQL}
+              AND r.source_modified_time IS NOT DISTINCT FROM i.modified_time
+        )
+        {since_filter}
+        ORDER BY i.created_time DESC NULLS LAST
+        LIMIT :limit
+    """), params={"limit": limit + len(_failed), "since": since}).fetchall()
+
+    todo = [(r.id, r.kind, r.modified_time) for r in rows if (r.id, r.modified_time) not in _failed]
+    return todo[:limit]
+
+
+def save_renditions(session: Session, results: List[Dict], modified_times: Dict[str, Optional[datetime]]) -> int:
+    """Upsert metadata rendition (1 row / ảnh / loại) trong 1 câu lệnh. Có commit."""
+    if not results:
+        return 0
+    now = datetime.utcnow()
+    rows = [{**r, "source_modified_time": modified_times.get(r["image_id"]), "created_at": now} for r in results]
+    stmt = pg_insert(ImageRendition).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["image_id", "kind"],
+        set_={
+            col: stmt.excluded[col]
+            for col in ("content_hash", "path", "width", "height", "size_bytes", "source_modified_time", "created_at")
+        },
+    )
+    session.exec(stmt)
+    session.commit()
+    return len(rows)
+
+
+def cleanup_orphan_renditions(session: Session) -> int:
+    """
+    Xóa rendition của ảnh đã bị xóa khỏi DB + file không còn row nào trỏ tới. Có commit.
+    File mới hơn ORPHAN_GRACE_SECONDS được giữ lại: có thể process khác vừa render xong, chưa ghi DB
+    """
+    orphan_ids = list(session.exec(
+        select(ImageRendition.id)
+        .join(Image, Image.id == ImageRendition.image_id, isouter=True)
+        .where(Image.id == None)  # noqa: E711
+    ).all())
+    if orphan_ids:
+        session.exec(delete(ImageRendition).where(ImageRendition.id.in_(orphan_ids)))
+        session.commit()
+
+    if os.path.isdir(RENDITION_DIR):
+        in_use = set(session.exec(select(ImageRendition.path)).all())
+        grace_cutoff = time.time() - ORPHAN_GRACE_SECONDS
+        for name in os.listdir(RENDITION_DIR):
+            path = os.path.join(RENDITION_DIR, name)
+            if path in in_use or not name.endswith(".jpg"):
+                continue
+            try:
+                if os.path.getmtime(path) < grace_cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+    return len(orphan_ids)
+
+
+def render_pending(session: Session, limit: int = RENDER_BATCH) -> Dict:
+    """
+    Render 1 lô ảnh còn thiếu rendition bằng process pool.
+    Bình thường chỉ ảnh từ mốc renditions_since; có cờ backfill -> cả thư viện, hết ảnh thì xóa cờ.
+    Process khác đang render -> bỏ qua lượt này (không tải + render trùng cùng 1 ảnh)
+    """
+    # Advisory lock theo session Postgres -> giữ trên 1 connection riêng, Session commit không làm rơi lock
+    with session.get_bind().connect() as lock_conn:
+        locked = lock_conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": RENDITION_LOCK_KEY}).scalar()
+        lock_conn.commit()
+        if not locked:
+            return {"rendered": 0, "failed": 0, "skipped": True}
+        try:
+            return _render_batch(session, limit)
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": RENDITION_LOCK_KEY})
+            lock_conn.commit()
+
+
+def _render_batch(session: Session, limit: int) -> Dict:
+    backfill = session.get(MaintenanceCheckpoint, BACKFILL_CHECKPOINT)
+    since = None if backfill else get_renditions_since(session)
+    todo = find_images_to_render(session, limit, since)
+    if backfill and len(todo) < limit:
+        # Lô cuối của backfill -> các lượt sau quay về render theo mốc
+        session.delete(backfill)
+        session.commit()
+        logger.info("🎨 Backfill rendition: lô cuối")
+    if not todo:
+        return {"rendered": 0, "failed": 0}
+
+    modified_times = {image_id: modified_time for image_id, _, modified_time in todo}
+    results, failed = [], 0
+
+    with ProcessPoolExecutor(max_workers=RENDER_WORKERS) as pool:
+        futures = [pool.submit(render_image_worker, image_id, kind) for image_id, kind, _ in todo]
+        for future in as_completed(futures):
+            try:
+                res = future.result()
+            except Exception as e:
+                res = {"error": str(e)}
+            if not res.get("error"):
+                results.append(res)
+            else:
+                failed += 1
+                if res.get("image_id"):
+                    _failed.add((res["image_id"], modified_times.get(res["image_id"])))
+                logger.warning(f"⚠️ Rendition lỗi {res.get('image_id', '')}: {res['error']}")
+
+    save_renditions(session, results, modified_times)
+    logger.info(f"🎨 Render xong {len(results)} ảnh, {failed} lỗi")
+    return {"rendered": len(results), "failed": failed}
+
+
+def get_rendition_for_image(session: Session, image_id: str):
+    """
+    Rendition đúng loại (theo folder) và render từ bản gốc hiện tại (source_modified_time = Image.modified_time),
+    còn file trên đĩa. Ảnh gốc vừa sửa mà chưa render lại -> None (proxy stream ảnh gốc)
+    """
+    rendition = session.exec(text(f"""
+        SELECT r.path, r.content_hash
+        FROM image_renditions r
+        JOIN images i ON i.id = r.image_id
+        JOIN folders f ON f.id = i.folder_id
+        WHERE r.image_id = :image_id
+          AND r.kind = {_KIND_SQL}
+          AND r.source_modified_time IS NOT DISTINCT FROM i.modified_time
+    """), params={"image_id": image_id}).first()
+    if rendition and os.path.exists(rendition.path):
+        return rendition
+    return None
@@ -0,0 +1,163 @@
+# app/retention_service.py
+"""
+Retention / downsampling cho log thô analytics_post_metric (1 row / bài / lần quét)
+- Cũ hơn POST_METRIC_DAILY_AFTER_DAYS ngày  -> chỉ giữ snapshot cuối cùng của mỗi bài trong ngày
+- Cũ hơn POST_METRIC_WEEKLY_AFTER_DAYS ngày -> chỉ giữ snapshot cuối cùng của mỗi bài trong tuần (thứ 2 -> CN)
+  (chỉ số là lũy kế -> snapshot cuối kỳ giữ nguyên giá trị cuối kỳ)
+- Chạy như task định kỳ, mỗi lô xóa tối đa POST_METRIC_COMPACT_BATCH row rồi commit (không giữ lock lâu),
+  mỗi lượt tối đa POST_METRIC_COMPACT_MAX_BATCHES lô; tiến độ lưu ở maintenance_checkpoints -> lượt sau chạy tiếp
+- Bước theo ngày lần đầu bắt đầu từ mốc theo tuần (phần cũ hơn là việc của bước theo tuần)
+- Xóa xong -> VACUUM (ANALYZE) trên connection autocommit, chỉ các partition tháng vừa bị xóa row
+Stats không đọc bảng này: số liệu cũ vẫn có đủ ở analytics_post_daily / page_daily_stats
+"""
+import os
+import logging
+from datetime import date, datetime, time, timedelta
+from typing import Iterable, Optional
+
+from sqlmodel import Session, text
+
+from app.models import MaintenanceCheckpoint
+from app.ingest_service import LOCAL_DAY_OFFSET, local_today
+from app.partition_service import is_partitioned, month_start, partition_name
+
+logger = logging.getLogger(__name__)
+
+# 0 = tắt bước tương ứng
+POST_METRIC_DAILY_AFTER_DAYS = int(os.getenv("POST_METRIC_DAILY_AFTER_DAYS", "14"))
+POST_METRIC_WEEKLY_AFTER_DAYS = int(os.getenv("POST_METRIC_WEEKLY_AFTER_DAYS", "90"))
+POST_METRIC_COMPACT_BATCH = int(os.getenv("POST_METRIC_COMPACT_BATCH", "5000"))
+POST_METRIC_COMPACT_MAX_BATCHES = int(os.getenv("POST_METRIC_COMPACT_MAX_BATCHES", "200"))
+
+# Xóa các snapshot không phải bản cuối cùng của bài trong [:from_day, :to_day)
+# Kèm khoảng updated_at tương ứng (ngày local - offset) -> chỉ đụng partition tháng chứa cửa sổ
+_COMPACT_SQL = text("""
+    DELETE FROM analytics_post_metric
+    WHERE (id, updated_at) IN (
+        SELECT id, updated_at FROM (
+            SELECT id, updated_at,
+                   ROW_NUMBER() OVER (PARTITION BY post_id ORDER BY updated_at DESC, id DESC) AS rn
+            FROM analytics_post_metric
+            WHERE local_day >= :from_day AND local_day < :to_day
+              AND updated_at >= :from_ts AND updated_at < :to_ts
+        ) ranked
+        WHERE rn > 1
+        LIMIT :batch_size
+    )
+    AND updated_at >= :from_ts AND updated_at < :to_ts
+""")
+
+
+def _get_checkpoint(session: Session, name: str) -> Optional[date]:
+    checkpoint = session.get(MaintenanceCheckpoint, name)
+    return checkpoint.done_through if checkpoint else None
+
+
+def _set_checkpoint(session: Session, name: str, done_through: date):
+    checkpoint = session.get(MaintenanceCheckpoint, name) or MaintenanceCheckpoint(name=name)
+    checkpoint.done_through = done_through
+    checkpoint.updated_at = datetime.utcnow()
+    session.add(checkpoint)
+    session.commit()
+
+
+def _first_raw_day(session: Session) -> Optional[date]:
+    return session.exec(text("SELECT MIN(local_day) FROM analytics_post_metric")).scalar()
+
+
+POST_METRIC_TABLE = "analytics_post_metric"
+
+
+class _Budget:
+    def __init__(self, max_batches: int):
+        self.remaining = max_batches
+        self.deleted = 0
+        # Tháng (theo updated_at) có row bị xóa -> chỉ VACUUM các partition này
+        self.touched_months = set()
+
+
+def _compact_window(session: Session, from_day: date, to_day: date, budget: _Budget) -> bool:
+    """Gộp 1 cửa sổ [from_day, to_day) theo lô. True = xong cửa sổ, False = hết lượt (chạy tiếp lần sau)"""
+    from_ts = datetime.combine(from_day, time.min) - LOCAL_DAY_OFFSET
+    to_ts = datetime.combine(to_day, time.min) - LOCAL_DAY_OFFSET
+    while budget.remaining > 0:
+        result = session.exec(_COMPACT_SQL, params={
+            "from_day": from_day, "to_day": to_day, "batch_size": POST_METRIC_COMPACT_BATCH,
+            "from_ts": from_ts, "to_ts": to_ts,
+        })
+        session.commit()
+        budget.remaining -= 1
+        budget.deleted += result.rowcount
+        if result.rowcount:
+            # Cửa sổ tối đa 7 ngày -> nằm trong tối đa 2 tháng
+            last_ts = to_ts - timedelta(microseconds=1)
+            budget.touched_months.update({month_start(from_ts.date()), month_start(last_ts.date())})
+        if result.rowcount < POST_METRIC_COMPACT_BATCH:
+            return True
+    return False
+
+
+def _compact(session: Session, name: str, cutoff: date, step_days: int, budget: _Budget,
+             align_week: bool = False, start_from: Optional[date] = None):
+    """
+    Đi từ checkpoint tới cutoff theo từng cửa sổ step_days ngày, lưu checkpoint sau mỗi cửa sổ xong.
+    Chưa có checkpoint -> bắt đầu từ ngày dữ liệu đầu tiên, nhưng không sớm hơn start_from
+    """
+    done_through = _get_checkpoint(session, name)
+    if done_through:
+        window_start = done_through + timedelta(days=1)
+    else:
+        window_start = _first_raw_day(session)
+        if window_start is None:
+            return
+        if start_from and window_start < start_from:
+            window_start = start_from
+        if align_week:
+            window_start -= timedelta(days=window_start.weekday())
+
+    while window_start + timedelta(days=step_days) <= cutoff and budget.remaining > 0:
+        window_end = window_start + timedelta(days=step_days)
+        if not _compact_window(session, window_start, window_end, budget):
+            return
+        _set_checkpoint(session, name, window_end - timedelta(days=1))
+        window_start = window_end
+
+
+def vacuum_post_metrics(session: Session, months: Optional[Iterable[date]] = None):
+    """
+    VACUUM không chạy được trong transaction -> connection riêng ở chế độ autocommit.
+    Bảng partition: chỉ VACUUM partition của các tháng chỉ định (tháng chưa có partition -> DEFAULT)
+    """
+    with session.get_bind().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        targets = [POST_METRIC_TABLE]
+        if months and is_partitioned(conn, POST_METRIC_TABLE):
+            targets = []
+            for month in sorted(months):
+                name = partition_name(POST_METRIC_TABLE, month)
+                exists = conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}).scalar()
+                target = name if exists else f"{POST_METRIC_TABLE}_default"
+                if target not in targets:
+                    targets.append(target)
+        for target in targets:
+            conn.execute(text(f"VACUUM (ANALYZE) {target}"))
+
+
+def compact_post_metrics(session: Session) -> int:
+    """Task định kỳ: downsample log thô theo ngày rồi theo tuần, trong giới hạn số lô mỗi lượt. Có commit"""
+    budget = _Budget(POST_METRIC_COMPACT_MAX_BATCHES)
+    today = local_today()
+
+    # Theo tuần trước: cửa sổ tuần đã gộp xong thì bước theo ngày không còn gì để xóa
+    weekly_cutoff = None
+    if POST_METRIC_WEEKLY_AFTER_DAYS > 0:
+        weekly_cutoff = today - timedelta(days=POST_METRIC_WEEKLY_AFTER_DAYS)
+        _compact(session, "post_metric_weekly", weekly_cutoff, step_days=7, budget=budget, align_week=True)
+    if POST_METRIC_DAILY_AFTER_DAYS > 0:
+        # Trước mốc theo tuần là phần của bước theo tuần -> bước theo ngày không đi lại từng ngày ở đó
+        _compact(session, "post_metric_daily", today - timedelta(days=POST_METRIC_DAILY_AFTER_DAYS),
+                 step_days=1, budget=budget, start_from=weekly_cutoff)
+
+    if budget.deleted:
+        logger.info(f"🗜️ Downsample analytics_post_metric: xóa {budget.deleted} snapshot thô")
+        vacuum_post_metrics(session, budget.touched_months)
+    return budget.deleted
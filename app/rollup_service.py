@@ -0,0 +1,258 @@
+# app/rollup_service.py
+"""
+Rollup page_daily_stats: 1 row / (page_id, ngày)
+- Nguồn: analytics_page_health (reach, clicks, engagement, followers) + analytics_post_daily (impressions)
+- Ingest chỉ đánh dấu các (page, ngày) bị ảnh hưởng vào session.info, ngay trước khi commit
+  các key đó được tính lại 1 lần bằng 1 câu INSERT ... SELECT ... ON CONFLICT (cùng transaction)
+  -> buffer / bundle ghi nhiều lô trong 1 transaction vẫn chỉ refresh rollup 1 lần
+- followers_asof: followers "tính tới ngày đó" (carry-forward từ page health gần nhất <= ngày),
+  rollup có đủ mọi ngày từ lần health đầu tiên tới hôm nay -> followers đầu / cuối kỳ chỉ là 1 phép join
+  (ingest health thì carry-forward lại từ ngày đổi sớm nhất, task định kỳ kéo dài chuỗi tới hôm nay)
+- rebuild_rollups.py dựng lại toàn bộ (hoặc 1 khoảng ngày)
+"""
+import logging
+from datetime import date, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session as OrmSession
+from sqlmodel import Session, text
+
+from app.stats_cache import bump_data_version, invalidate_all
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_CHUNK_SIZE = 5000
+# Namespace advisory lock (dạng 2 số int) cho rollup theo page
+ROLLUP_LOCK_NAMESPACE = 727003
+# Chuỗi followers_asof kéo trước 1 ngày -> qua nửa đêm đã có sẵn row "hôm nay" trước khi task định kỳ chạy
+CARRY_FORWARD_LEAD_DAYS = 1
+
+# Tính lại các (page, ngày) từ bảng nguồn. k = danh sách key cần tính
+_REFRESH_SQL = """
+    INSERT INTO page_daily_stats (page_id, day, reach, impressions, clicks, engagement, followers_total, updated_at)
+    SELECT
+        k.page_id,
+        k.day,
+        COALESCE(h.total_reach, 0),
+        COALESCE(pd.impressions, 0),
+        COALESCE(h.link_clicks, 0),
+        COALESCE(h.total_interaction, 0),
+        h.followers_total,
+        now() AT TIME ZONE 'UTC'
+    FROM ({keys_sql}) AS k(page_id, day)
+    LEFT JOIN analytics_page_health h
+        ON h.page_id = k.page_id AND h.record_date = CAST(k.day AS TIMESTAMP)
+    LEFT JOIN LATERAL (
+        SELECT SUM(impressions) AS impressions
+        FROM analytics_post_daily
+        WHERE page_id = k.page_id AND local_day = k.day
+    ) pd ON true
+    WHERE h.page_id IS NOT NULL OR pd.impressions IS NOT NULL
+    ON CONFLICT (page_id, day) DO UPDATE SET
+        reach = excluded.reach,
+        impressions = excluded.impressions,
+        clicks = excluded.clicks,
+        engagement = excluded.engagement,
+        followers_total = excluded.followers_total,
+        updated_at = excluded.updated_at
+"""
+
+# Carry-forward followers cho mỗi (page_id, from_day) trong s: mọi ngày from_day -> :until.
+# Gaps-and-islands: grp tăng mỗi khi gặp ngày có health -> FIRST_VALUE trong nhóm là giá trị đang hiệu lực;
+# nhóm 0 (trước health đầu tiên trong khoảng) lấy health gần nhất trước from_day.
+# Ngày chưa có row rollup -> tạo row rỗng (metric 0, followers_total NULL)
+_CARRY_FORWARD_SQL = """
+    WITH starts AS ({starts_sql}),
+    seeded AS (
+        SELECT s.page_id, s.from_day, (
+            SELECT h.followers_total FROM analytics_page_health h
+            WHERE h.page_id = s.page_id AND h.record_date < CAST(s.from_day AS TIMESTAMP)
+            ORDER BY h.record_date DESC
+            LIMIT 1
+        ) AS seed
+        FROM starts s
+    ),
+    series AS (
+        SELECT s.page_id, s.seed, CAST(g AS DATE) AS day
+        FROM seeded s
+        CROSS JOIN generate_series(CAST(s.from_day AS TIMESTAMP), CAST(:until AS TIMESTAMP), INTERVAL '1 day') AS g
+    ),
+    grouped AS (
+        SELECT sr.page_id, sr.day, sr.seed, h.followers_total,
+               COUNT(h.followers_total) OVER (PARTITION BY sr.page_id ORDER BY sr.day) AS grp
+        FROM series sr
+        LEFT JOIN analytics_page_health h
+            ON h.page_id = sr.page_id AND h.record_date = CAST(sr.day AS TIMESTAMP)
+    ),
+    filled AS (
+        SELECT page_id, day,
+               CASE WHEN grp = 0 THEN seed
+                    ELSE FIRST_VALUE(followers_total) OVER (PARTITION BY page_id, grp ORDER BY day)
+               END AS followers_asof
+        FROM grouped
+    )
+    INSERT INTO page_daily_stats (page_id, day, reach, impressions, clicks, engagement, followers_total, followers_asof, updated_at)
+    SELECT page_id, day, 0, 0, 0, 0, NULL, followers_asof, now() AT TIME ZONE 'UTC'
+    FROM filled
+    WHERE followers_asof IS NOT NULL
+    ON CONFLICT (page_id, day) DO UPDATE SET
+        followers_asof = excluded.followers_asof
+    WHERE page_daily_stats.followers_asof IS DISTINCT FROM excluded.followers_asof
+"""
+
+
+def lock_rollup_pages(session: Session, page_ids: Iterable[str]) -> None:
+    """
+    Khóa advisory theo page (tới hết transaction) trước khi tính lại rollup / carry-forward.
+    2 transaction cùng đụng 1 page (health + snapshot bài) sẽ nối đuôi nhau: câu INSERT ... SELECT của bên sau
+    chạy sau khi bên trước commit nên thấy đủ dữ liệu của cả hai (READ COMMITTED), không ghi đè mất.
+    Khóa theo thứ tự page_id để không deadlock.
+    """
+    page_ids = sorted(set(page_ids))
+    if not page_ids:
+        return
+    session.exec(text("""
+        SELECT pg_advisory_xact_lock(:namespace, hashtext(s.page_id))
+        FROM (SELECT page_id FROM unnest(CAST(:page_ids AS VARCHAR[])) AS u(page_id) ORDER BY page_id) s
+    """), params={"namespace": ROLLUP_LOCK_NAMESPACE, "page_ids": page_ids})
+
+
+def carry_forward_query(starts_sql: str):
+    """Câu SQL carry-forward followers; starts_sql trả về (page_id, from_day), tham số :until"""
+    return text(_CARRY_FORWARD_SQL.format(starts_sql=starts_sql))
+
+
+def carry_forward_until(days: Iterable[date]) -> date:
+    from app.ingest_service import local_today  # Import lười để tránh vòng lặp
+
+    return max([local_today() + timedelta(days=CARRY_FORWARD_LEAD_DAYS), *days])
+
+
+def carry_forward_followers(session: Session, starts: Dict[str, date], until: Optional[date] = None) -> int:
+    """Tính lại followers_asof cho từng page từ ngày chỉ định tới until (mặc định ngày mai). Không commit"""
+    if not starts:
+        return 0
+    until = until or carry_forward_until(starts.values())
+    page_ids = list(starts)
+    total = 0
+    for i in range(0, len(page_ids), ROLLUP_CHUNK_SIZE):
+        chunk = page_ids[i:i + ROLLUP_CHUNK_SIZE]
+        result = session.exec(
+            carry_forward_query("SELECT * FROM unnest(CAST(:page_ids AS VARCHAR[]), CAST(:from_days AS DATE[])) AS s(page_id, from_day)"),
+            params={"page_ids": chunk, "from_days": [starts[pid] for pid in chunk], "until": until},
+        )
+        total += result.rowcount
+    return total
+
+
+def extend_followers_asof(session: Session) -> int:
+    """Task định kỳ: kéo chuỗi followers_asof của mọi page tới hôm nay (+ CARRY_FORWARD_LEAD_DAYS). Có commit"""
+    page_ids = session.exec(text(
+        "SELECT DISTINCT page_id FROM page_daily_stats WHERE followers_asof IS NOT NULL"
+    )).scalars().all()
+    lock_rollup_pages(session, page_ids)
+    result = session.exec(carry_forward_query("""
+        SELECT page_id, MAX(day) AS from_day FROM page_daily_stats
+        WHERE followers_asof IS NOT NULL
+        GROUP BY page_id
+    """), params={"until": carry_forward_until([])})
+    session.commit()
+    return result.rowcount
+
+
+def mark_rollup_dirty(session: Session, keys: Iterable[Tuple[str, date]]) -> None:
+    """Đánh dấu (page_id, ngày) cần tính lại; thực hiện tự động ngay trước khi session commit"""
+    session.info.setdefault("rollup_dirty", set()).update(keys)
+
+
+def mark_stats_cache_dirty(session: Session, keys: Iterable[Tuple[str, Optional[date]]]) -> None:
+    """(page_id, ngày | None = mọi ngày) đổi dữ liệu ngoài rollup (vd metadata bài) -> bump cache /stats sau commit"""
+    session.info.setdefault("stats_cache_dirty", set()).update(keys)
+
+
+def refresh_page_daily_stats(session: Session, keys: Iterable[Tuple[str, date]]) -> int:
+    """Tính lại rollup cho các (page_id, ngày) chỉ định (không commit)"""
+    keys = sorted(set(keys))
+    if not keys:
+        return 0
+    lock_rollup_pages(session, (page_id for page_id, _ in keys))
+    for i in range(0, len(keys), ROLLUP_CHUNK_SIZE):
+        chunk = keys[i:i + ROLLUP_CHUNK_SIZE]
+        session.exec(
+            text(_REFRESH_SQL.format(
+                keys_sql="SELECT * FROM unnest(CAST(:page_ids AS VARCHAR[]), CAST(:days AS DATE[]))"
+            )),
+            params={"page_ids": [k[0] for k in chunk], "days": [k[1] for k in chunk]},
+        )
+
+    # Health ngày d đổi -> followers_asof từ d tới ngày health kế tiếp đổi theo
+    starts: Dict[str, date] = {}
+    for page_id, day in keys:
+        starts[page_id] = min(day, starts.get(page_id, day))
+    carry_forward_followers(session, starts, until=carry_forward_until(day for _, day in keys))
+    return len(keys)
+
+
+@event.listens_for(OrmSession, "before_commit")
+def _flush_dirty_rollups(session):
+    dirty = session.info.pop("rollup_dirty", None)
+    if dirty:
+        refresh_page_daily_stats(session, dirty)
+        session.info["rollup_committing"] = dirty
+
+
+@event.listens_for(OrmSession, "after_commit")
+def _bump_stats_cache(session):
+    # Commit xong mới bump version -> cache /stats không giữ kết quả cũ của các (page, ngày) này
+    committed = session.info.pop("rollup_committing", None) or set()
+    committed |= session.info.pop("stats_cache_dirty", None) or set()
+    if committed:
+        bump_data_version(committed)
+
+
+@event.listens_for(OrmSession, "after_rollback")
+def _discard_dirty_rollups(session):
+    session.info.pop("rollup_dirty", None)
+    session.info.pop("rollup_committing", None)
+    session.info.pop("stats_cache_dirty", None)
+
+
+def rebuild_query():
+    """Câu SQL tính lại rollup cho mọi (page, ngày) có dữ liệu nguồn trong [:start, :end]"""
+    return text(_REFRESH_SQL.format(keys_sql="""
+        SELECT page_id, CAST(record_date AS DATE) FROM analytics_page_health
+        WHERE record_date BETWEEN CAST(:start AS TIMESTAMP) AND CAST(:end AS TIMESTAMP)
+        UNION
+        SELECT page_id, local_day FROM analytics_post_daily
+        WHERE local_day BETWEEN :start AND :end
+    """))
+
+
+def carry_forward_starts_sql() -> str:
+    """(page_id, from_day) cho dựng lại toàn bộ: mọi page có health, bắt đầu từ max(:start, health đầu tiên)"""
+    return """
+        SELECT page_id, GREATEST(CAST(MIN(record_date) AS DATE), CAST(:start AS DATE)) AS from_day
+        FROM analytics_page_health
+        GROUP BY page_id
+    """
+
+
+def rebuild_page_daily_stats(session: Session, start: Optional[date] = None, end: Optional[date] = None) -> int:
+    """
+    Dựng lại rollup từ đầu cho khoảng ngày [start, end] (None = toàn bộ). Có commit.
+    Ngày không còn dữ liệu nguồn bị xóa khỏi rollup.
+    """
+    params = {"start": start or date.min, "end": end or date.max}
+    lock_rollup_pages(session, session.exec(text("SELECT page_id FROM pages")).scalars().all())
+    session.exec(text("DELETE FROM page_daily_stats WHERE day BETWEEN :start AND :end"), params=params)
+    result = session.exec(rebuild_query(), params=params)
+    # Row carry-forward trong khoảng cũng bị xóa -> dựng lại từ max(start, ngày health đầu tiên)
+    until = carry_forward_until([])
+    if end:
+        until = min(end, until)
+    session.exec(carry_forward_query(carry_forward_starts_sql()), params={"start": params["start"], "until": until})
+    session.commit()
+    invalidate_all()
+    logger.info(f"📊 Rebuild page_daily_stats: {result.rowcount} row")
+    return result.rowcount
@@ -0,0 +1,195 @@
+# app/stats_cache.py
+"""
+Cache kết quả /api/stats (JSON đã serialize sẵn -> trả lại bằng bytes, không query / không dựng model)
+- Key = tên endpoint + tham số đã chuẩn hóa + phạm vi page của user
+- Mỗi entry gắn "tag" dữ liệu nó phụ thuộc: tập page (None = mọi page) + ngày cuối của khoảng
+- Ingest commit xong -> bump_data_version((page_id, ngày)...) ; entry có page trong phạm vi và
+  ngày <= ngày cuối của nó sẽ bị coi là cũ (followers đầu kỳ phụ thuộc cả ngày trước khoảng)
+- Đọc current_data_version() TRƯỚC khi query rồi truyền vào cache_response: ingest commit trong lúc
+  query đang chạy -> entry bị coi là cũ ngay, không lưu kết quả trước commit như thể mới
+- Giới hạn số entry (LRU) + TTL (cache theo process: ingest ở process khác chỉ thấy sau TTL)
+- Đổi config page / trạng thái -> invalidate_all()
+"""
+import os
+import json
+import time
+import threading
+from collections import OrderedDict, deque
+from datetime import date
+from typing import Any, Dict, FrozenSet, Iterable, NamedTuple, Optional, Tuple
+
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+
+STATS_CACHE_ENABLED = os.getenv("STATS_CACHE_ENABLED", "1") == "1"
+STATS_CACHE_MAX_ENTRIES = int(os.getenv("STATS_CACHE_MAX_ENTRIES", "2000"))
+STATS_CACHE_TTL_SECONDS = int(os.getenv("STATS_CACHE_TTL_SECONDS", "300"))
+# Số lần bump giữ lại để đối chiếu; entry cũ hơn lần bump cũ nhất còn giữ -> coi như cũ
+VERSION_LOG_SIZE = 10000
+
+
+class CacheEntry(NamedTuple):
+    body: bytes
+    created_at: float
+    version: int
+    page_ids: Optional[FrozenSet[str]]
+    end_day: Optional[date]
+
+
+class StatsCache:
+    def __init__(self, max_entries: int = STATS_CACHE_MAX_ENTRIES, ttl: int = STATS_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[Tuple, CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = 0
+        # (version, {page_id: ngày nhỏ nhất bị đổi}) cho từng lần bump
+        self._bumps: deque = deque(maxlen=VERSION_LOG_SIZE)
+        self.metrics = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0, "bumps": 0, "invalidate_all": 0}
+
+    def _is_stale(self, entry: CacheEntry) -> bool:
+        if time.monotonic() - entry.created_at > self.ttl:
+            return True
+        if entry.version == self._version:
+            return False
+        if self._bumps and entry.version < self._bumps[0][0] - 1:
+            return True  # Log bump đã bị cắt -> không kiểm được, coi như cũ
+        for version, changed in reversed(self._bumps):
+            if version <= entry.version:
+                break
+            for page_id, min_day in changed.items():
+                if page_id == "*":
+                    return True
+                if entry.page_ids is not None and page_id not in entry.page_ids:
+                    continue
+                if entry.end_day is None or min_day is None or min_day <= entry.end_day:
+                    return True
+        return False
+
+    def get(self, key: Tuple) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.metrics["misses"] += 1
+                return None
+            if self._is_stale(entry):
+                del self._entries[key]
+                self.metrics["stale"] += 1
+                self.metrics["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.metrics["hits"] += 1
+            return entry.body
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def put(self, key: Tuple, body: bytes, page_ids: Optional[Iterable[str]] = None, end_day: Optional[date] = None,
+            version: Optional[int] = None):
+        """version = data version đọc trước khi query (None = version hiện tại)"""
+        with self._lock:
+            entry = CacheEntry(
+                body=body,
+                created_at=time.monotonic(),
+                version=self._version if version is None else version,
+                page_ids=frozenset(page_ids) if page_ids is not None else None,
+                end_day=end_day,
+            )
+            # Dữ liệu liên quan đã đổi trong lúc query -> kết quả có thể là trước commit, không lưu
+            if self._is_stale(entry):
+                self.metrics["stale"] += 1
+                return
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.metrics["evictions"] += 1
+
+    def bump(self, keys: Iterable[Tuple[str, Optional[date]]]):
+        changed: Dict[str, Optional[date]] = {}
+        for page_id, day in keys:
+            current = changed.get(page_id, day)
+            changed[page_id] = None if day is None or current is None else min(current, day)
+        if not changed:
+            return
+        with self._lock:
+            self._version += 1
+            self._bumps.append((self._version, changed))
+            self.metrics["bumps"] += 1
+
+    def invalidate_all(self):
+        with self._lock:
+            self._entries.clear()
+            self._version += 1
+            self._bumps.append((self._version, {"*": None}))
+            self.metrics["invalidate_all"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.metrics["hits"] + self.metrics["misses"]
+            return {
+                **self.metrics,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hit_rate": round(self.metrics["hits"] / lookups, 4) if lookups else 0.0,
+                "data_version": self._version,
+            }
+
+
+stats_cache = StatsCache()
+
+
+def make_cache_key(endpoint: str, scope: Optional[Iterable[str]], **params) -> Tuple:
+    """Key chuẩn hóa: thứ tự tham số không quan trọng, scope None = mọi page"""
+    scope_key = tuple(sorted(scope)) if scope is not None else None
+    return (endpoint, scope_key, tuple(sorted((k, str(v)) for k, v in params.items())))
+
+
+def current_data_version() -> int:
+    """Đọc trước khi query, truyền vào cache_response(version=...)"""
+    return stats_cache.version
+
+
+def get_cached_response(key: Tuple) -> Optional[Response]:
+    if not STATS_CACHE_ENABLED:
+        return None
+    body = stats_cache.get(key)
+    if body is None:
+        return None
+    return Response(content=body, media_type="application/json", headers={"X-Stats-Cache": "HIT"})
+
+
+def cache_response(key: Tuple, payload: Any, page_ids: Optional[Iterable[str]] = None,
+                   end_day: Optional[date] = None, version: Optional[int] = None) -> Response:
+    """Serialize 1 lần, lưu bytes vào cache, trả Response. version = current_data_version() đọc trước khi query"""
+    body = json.dumps(jsonable_encoder(payload), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if STATS_CACHE_ENABLED:
+        stats_cache.put(key, body, page_ids=page_ids, end_day=end_day, version=version)
+    return Response(content=body, media_type="application/json", headers={"X-Stats-Cache": "MISS"})
+
+
+def cached_value(key: Tuple, compute, page_ids: Optional[Iterable[str]] = None, end_day: Optional[date] = None):
+    """Giá trị nhỏ (vd: total) cache cùng cơ chế version/TTL. compute() chỉ chạy khi miss"""
+    if STATS_CACHE_ENABLED:
+        body = stats_cache.get(key)
+        if body is not None:
+            return json.loads(body)
+    version = stats_cache.version
+    value = compute()
+    if STATS_CACHE_ENABLED:
+        stats_cache.put(
+            key, json.dumps(jsonable_encoder(value)).encode("utf-8"),
+            page_ids=page_ids, end_day=end_day, version=version,
+        )
+    return value
+
+
+def bump_data_version(keys: Iterable[Tuple[str, Optional[date]]]):
+    """Gọi sau khi ingest commit: (page_id, ngày) vừa đổi dữ liệu (ngày None = mọi ngày của page)"""
+    stats_cache.bump(keys)
+
+
+def invalidate_all():
+    stats_cache.invalidate_all()
@@ -0,0 +1,330 @@
+# app/sync_jobs.py
+"""
+Hàng đợi Sync bền vững (Durable job queue)
+- Job lưu trong bảng sync_jobs -> restart server không mất job
+- Worker lấy job bằng SELECT ... FOR UPDATE SKIP LOCKED (nhiều worker không giẫm chân nhau)
+- Checkpoint theo folder (SyncJob.position) -> job bị ngắt sẽ chạy tiếp từ folder đang dở
+- Unique index uq_sync_jobs_active_full -> không bao giờ có 2 job FULL chạy chồng nhau
+- Thread heartbeat riêng trong lúc chạy job (folder lớn quét lâu hơn STALE_AFTER vẫn không bị coi là chết);
+  mỗi lần ghi checkpoint kiểm (worker_id, attempts) -> job đã bị requeue cho worker khác thì dừng, không ghi đè
+"""
+import os
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Optional, Tuple, List
+
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select, update
+
+from app.database import engine
+from app.models import SyncJob, Folder
+from app.sync_service import sync_folder_structure, sync_images_in_folder
+from app.rendition_service import render_pending, cleanup_orphan_renditions, rendition_backfill_requested, RENDER_BATCH
+
+logger = logging.getLogger(__name__)
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Job RUNNING mà không có heartbeat quá mốc này -> coi như worker đã chết, trả về PENDING
+STALE_AFTER = timedelta(minutes=int(os.getenv("SYNC_JOB_STALE_MINUTES", "15")))
+POLL_INTERVAL_SECONDS = float(os.getenv("SYNC_JOB_POLL_SECONDS", "5"))
+HEARTBEAT_SECONDS = float(os.getenv("SYNC_JOB_HEARTBEAT_SECONDS", "60"))
+
+ACTIVE_STATUSES = ("PENDING", "RUNNING")
+
+# Render sẵn rendition POST/STORY sau sync (tắt bằng RENDITIONS_ENABLED=0)
+RENDITIONS_ENABLED = os.getenv("RENDITIONS_ENABLED", "1") == "1"
+
+
+def job_to_dict(job: SyncJob) -> dict:
+    """Serialize job cho API status (Dashboard poll 1 row này)"""
+    progress = 0.0
+    if job.total_folders:
+        progress = round(job.position / job.total_folders * 100, 1)
+    elif job.status == "DONE":
+        progress = 100.0
+
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "progress": progress,
+        "position": job.position,
+        "total_folders": job.total_folders,
+        "done_folders": job.done_folders,
+        "failed_folders": job.failed_folders,
+        "attempts": job.attempts,
+        "error": job.error,
+        "worker_id": job.worker_id,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "heartbeat_at": job.heartbeat_at.isoformat() if job.heartbeat_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def get_active_full_job(session: Session) -> Optional[SyncJob]:
+    return session.exec(
+        select(SyncJob)
+        .where(SyncJob.kind == "FULL")
+        .where(SyncJob.status.in_(ACTIVE_STATUSES))
+        .order_by(SyncJob.id)
+    ).first()
+
+
+def enqueue_full_sync(session: Session) -> Tuple[SyncJob, bool]:
+    """
+    Tạo job FULL mới. Nếu đã có job FULL đang chờ/chạy -> trả về job đó (created=False).
+    Trả về (job, created)
+    """
+    existing = get_active_full_job(session)
+    if existing:
+        return existing, False
+
+    job = SyncJob(kind="FULL")
+    session.add(job)
+    try:
+        session.commit()
+    except IntegrityError:
+        # Request khác vừa tạo job FULL cùng lúc -> unique index chặn lại
+        session.rollback()
+        return get_active_full_job(session), False
+
+    session.refresh(job)
+    return job, True
+
+
+def enqueue_folder_sync(session: Session, folder_ids: List[str]) -> SyncJob:
+    """Tạo job sync một danh sách folder cụ thể (không sync lại structure)"""
+    job = SyncJob(kind="FOLDER", folder_ids=list(folder_ids), total_folders=len(folder_ids))
+    session.add(job)
+    session.commit()
+    session.refresh(job)
+    return job
+
+
+def requeue_stale_jobs(session: Session) -> int:
+    """Job RUNNING mất heartbeat (server restart / crash) -> PENDING để worker nhận lại"""
+    cutoff = datetime.utcnow() - STALE_AFTER
+    result = session.exec(
+        update(SyncJob)
+        .where(SyncJob.status == "RUNNING")
+        .where((SyncJob.heartbeat_at == None) | (SyncJob.heartbeat_at < cutoff))  # noqa: E711
+        .values(status="PENDING", worker_id=None)
+    )
+    session.commit()
+    if result.rowcount:
+        logger.info(f"♻️ Trả {result.rowcount} job bị treo về PENDING")
+    return result.rowcount
+
+
+def claim_next_job(session: Session) -> Optional[SyncJob]:
+    """Lấy job PENDING cũ nhất, khóa row bằng FOR UPDATE SKIP LOCKED rồi đánh dấu RUNNING"""
+    job = session.exec(
+        select(SyncJob)
+        .where(SyncJob.status == "PENDING")
+        .order_by(SyncJob.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    ).first()
+
+    if not job:
+        session.rollback()
+        return None
+
+    now = datetime.utcnow()
+    job.status = "RUNNING"
+    job.worker_id = WORKER_ID
+    job.started_at = job.started_at or now
+    job.heartbeat_at = now
+    job.attempts += 1
+    session.add(job)
+    session.commit()
+    session.refresh(job)
+    return job
+
+
+class JobOwnershipLost(Exception):
+    """Job đã bị requeue và worker khác nhận lại -> worker hiện tại phải dừng"""
+
+
+def _owned_by_me(job_id: int, attempts: int):
+    # Requeue đặt worker_id = NULL, claim lại tăng attempts -> cặp (worker_id, attempts) xác định lượt chạy
+    return (SyncJob.id == job_id) & (SyncJob.worker_id == WORKER_ID) & (SyncJob.attempts == attempts)
+
+
+def _save_progress(session: Session, job: SyncJob, attempts: int):
+    """
+    Ghi checkpoint + heartbeat nếu job vẫn thuộc lượt chạy này (attempts lúc claim),
+    ngược lại rollback và raise JobOwnershipLost
+    """
+    now = datetime.utcnow()
+    job.heartbeat_at = now
+    session.add(job)
+    session.flush()
+    # Flush đã khóa row -> kiểm quyền sở hữu trong cùng transaction, không ai chen vào giữa
+    owned = session.exec(
+        update(SyncJob).where(_owned_by_me(job.id, attempts)).values(heartbeat_at=now)
+    ).rowcount
+    if not owned:
+        session.rollback()
+        raise JobOwnershipLost(f"Job #{job.id} đã được worker khác nhận lại")
+    session.commit()
+
+
+class _JobHeartbeat:
+    """Thread cập nhật heartbeat_at mỗi HEARTBEAT_SECONDS (session riêng) trong lúc job chạy"""
+
+    def __init__(self, job: SyncJob):
+        self.job_id = job.id
+        self.attempts = job.attempts
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name=f"sync-job-{job.id}-heartbeat", daemon=True)
+
+    def _loop(self):
+        while not self._stop.wait(HEARTBEAT_SECONDS):
+            try:
+                with Session(engine) as session:
+                    owned = session.exec(
+                        update(SyncJob)
+                        .where(_owned_by_me(self.job_id, self.attempts))
+                        .values(heartbeat_at=datetime.utcnow())
+                    ).rowcount
+                    session.commit()
+                if not owned:
+                    self.lost = True
+                    return
+            except Exception as e:
+                logger.warning(f"⚠️ Heartbeat job #{self.job_id} lỗi: {e}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_job(session: Session, job: SyncJob) -> SyncJob:
+    """Chạy job từ checkpoint hiện tại. Mỗi folder xong -> commit checkpoint"""
+    logger.info(f"🚀 Job #{job.id} ({job.kind}) chạy từ vị trí {job.position}")
+    with _JobHeartbeat(job) as heartbeat:
+        return _run_job_steps(session, job, heartbeat)
+
+
+def _run_job_steps(session: Session, job: SyncJob, heartbeat: _JobHeartbeat) -> SyncJob:
+    from app.sync_scheduler import record_folder_sync  # Import lười để tránh vòng lặp
+
+    try:
+        # Bước 1 (chỉ FULL): sync cấu trúc, chụp danh sách folder làm kế hoạch cho job
+        if job.kind == "FULL" and not job.folder_ids:
+            res = sync_folder_structure(session)
+            if not res.get("success"):
+                raise RuntimeError(res.get("error") or res.get("message") or "Sync structure failed")
+
+            job.folder_ids = list(session.exec(select(Folder.id).order_by(Folder.id)).all())
+            job.total_folders = len(job.folder_ids)
+            job.position = 0
+            _save_progress(session, job, heartbeat.attempts)
+
+        # Bước 2: quét từng folder, bắt đầu từ checkpoint
+        folder_ids = list(job.folder_ids or [])
+        for idx in range(job.position, len(folder_ids)):
+            folder_id = folder_ids[idx]
+            if heartbeat.lost:
+                raise JobOwnershipLost(f"Job #{job.id} đã được worker khác nhận lại")
+
+            # Folder có thể đã bị xóa giữa chừng (sync structure chạy lại)
+            if session.get(Folder, folder_id):
+                res = sync_images_in_folder(session, folder_id)
+                if res.get("success"):
+                    job.done_folders += 1
+                else:
+                    job.failed_folders += 1
+                    job.error = f"{folder_id}: {res.get('error')}"
+                # Cập nhật nhịp quét của folder cho scheduler (commit cùng checkpoint)
+                record_folder_sync(session, folder_id, res)
+
+            job.position = idx + 1
+            _save_progress(session, job, heartbeat.attempts)
+
+        job.status = "DONE"
+        job.finished_at = datetime.utcnow()
+        _save_progress(session, job, heartbeat.attempts)
+        logger.info(f"🏁 Job #{job.id} xong: {job.done_folders} ok, {job.failed_folders} lỗi")
+
+    except JobOwnershipLost as e:
+        session.rollback()
+        logger.warning(f"⚠️ {e}, dừng lượt chạy này")
+
+    except Exception as e:
+        session.rollback()
+        logger.error(f"❌ Job #{job.id} lỗi: {e}")
+        job.status = "FAILED"
+        job.error = str(e)
+        job.finished_at = datetime.utcnow()
+        try:
+            _save_progress(session, job, heartbeat.attempts)
+        except JobOwnershipLost as lost:
+            logger.warning(f"⚠️ {lost}, không ghi trạng thái FAILED")
+
+    return job
+
+
+def run_pending_jobs(session: Session) -> int:
+    """Chạy lần lượt tất cả job PENDING (dùng cho run_sync.py / worker loop)"""
+    count = 0
+    while True:
+        job = claim_next_job(session)
+        if not job:
+            return count
+        run_job(session, job)
+        count += 1
+
+
+# --- WORKER CHẠY NGẦM TRONG PROCESS ---
+
+_stop_event = threading.Event()
+_worker_thread: Optional[threading.Thread] = None
+
+
+def _worker_loop():
+    logger.info(f"👷 Sync worker {WORKER_ID} bắt đầu")
+    # Có việc render tồn (lúc khởi động / sau mỗi job sync) -> render từng lô khi hàng đợi rảnh
+    render_backlog = RENDITIONS_ENABLED
+    while not _stop_event.is_set():
+        try:
+            with Session(engine) as session:
+                requeue_stale_jobs(session)
+                if run_pending_jobs(session):
+                    render_backlog = RENDITIONS_ENABLED
+                elif RENDITIONS_ENABLED and not render_backlog:
+                    # Dashboard vừa yêu cầu backfill toàn bộ thư viện
+                    render_backlog = rendition_backfill_requested(session)
+                if render_backlog:
+                    res = render_pending(session)
+                    # Lô chưa đầy -> đã render hết ảnh mới; process khác đang render -> để nó lo
+                    render_backlog = res["rendered"] + res["failed"] >= RENDER_BATCH
+                    if not render_backlog and not res.get("skipped"):
+                        cleanup_orphan_renditions(session)
+        except Exception as e:
+            logger.error(f"❌ Sync worker lỗi: {e}")
+        _stop_event.wait(POLL_INTERVAL_SECONDS)
+    logger.info(f"👷 Sync worker {WORKER_ID} dừng")
+
+
+def start_sync_worker():
+    global _worker_thread
+    if _worker_thread and _worker_thread.is_alive():
+        return
+    _stop_event.clear()
+    _worker_thread = threading.Thread(target=_worker_loop, name="sync-worker", daemon=True)
+    _worker_thread.start()
+
+
+def stop_sync_worker():
+    _stop_event.set()
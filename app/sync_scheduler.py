@@ -0,0 +1,218 @@
+# app/sync_scheduler.py
+"""
+Scheduler Sync chạy ngầm trong process
+- Folder được Page đủ điều kiện (có cả _POST và _STORY) dùng -> HOT -> quét dày
+- Folder không Page nào dùng -> COLD -> quét thưa
+- Nhịp quét tự co giãn: lần quét có thay đổi -> rút ngắn, không đổi -> giãn ra
+- Folder đến hạn được gom thành job FOLDER trong hàng đợi sync_jobs
+"""
+import os
+import json
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from sqlmodel import Session, select, text
+
+from app.database import engine
+from app.models import Folder, FolderSyncState, PageConfig
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_ENABLED = os.getenv("SYNC_SCHEDULER_ENABLED", "1") == "1"
+TICK_SECONDS = float(os.getenv("SYNC_SCHEDULER_TICK_SECONDS", "60"))
+MAX_FOLDERS_PER_JOB = int(os.getenv("SYNC_SCHEDULER_BATCH", "50"))
+
+# (min, max) nhịp quét theo phút
+HOT_INTERVAL = (15, 6 * 60)
+COLD_INTERVAL = (6 * 60, 7 * 24 * 60)
+
+# Khóa advisory: nhiều worker uvicorn chỉ 1 con được lập lịch mỗi tick
+SCHEDULER_LOCK_KEY = 727001
+
+# Việc bảo trì định kỳ khác (retention...) chạy chung thread scheduler: (tên, chu kỳ giây, hàm(session))
+PERIODIC_TASKS: List[Tuple[str, float, Callable[[Session], object]]] = []
+_last_run: Dict[str, float] = {}
+
+
+def register_periodic_task(name: str, interval_seconds: float, fn: Callable[[Session], object]):
+    PERIODIC_TASKS.append((name, interval_seconds, fn))
+
+
+def next_interval(current: int, is_hot: bool, change_count: int) -> int:
+    """Có thay đổi -> chia đôi nhịp, không đổi -> giãn 1.5 lần, kẹp trong khoảng theo loại folder"""
+    low, high = HOT_INTERVAL if is_hot else COLD_INTERVAL
+    if change_count > 0:
+        current = current // 2
+    else:
+        current = int(current * 1.5)
+    return max(low, min(high, current))
+
+
+def get_hot_folder_ids(session: Session) -> Set[str]:
+    """Folder thuộc các Page đủ điều kiện (cấu hình có cả folder _POST và _STORY)"""
+    configs = session.exec(select(PageConfig.folder_ids).where(PageConfig.folder_ids != None)).all()  # noqa: E711
+    folder_names = {f.id: (f.name or "").upper() for f in session.exec(select(Folder)).all()}
+
+    hot: Set[str] = set()
+    for raw in configs:
+        try:
+            f_ids = json.loads(raw) if isinstance(raw, str) else (raw or [])
+        except Exception:
+            continue
+
+        names = [folder_names.get(fid, "") for fid in f_ids]
+        has_post = any(n.endswith("_POST") for n in names)
+        has_story = any(n.endswith("_STORY") for n in names)
+        if has_post and has_story:
+            hot.update(fid for fid in f_ids if fid in folder_names)
+    return hot
+
+
+def record_folder_sync(session: Session, folder_id: str, result: Dict):
+    """Gọi sau mỗi lần quét folder (từ worker) để cập nhật nhịp quét. Không commit."""
+    state = session.get(FolderSyncState, folder_id)
+    if not state:
+        state = FolderSyncState(folder_id=folder_id, interval_minutes=COLD_INTERVAL[0])
+
+    now = datetime.utcnow()
+    if result.get("success"):
+        # Chỉ ảnh mới / xóa / đổi tên / sửa nội dung; làm mới thumbnail không tính là thay đổi
+        change_count = (
+            result.get("new_db_records", 0)
+            + result.get("changed_db_records", 0)
+            + result.get("deleted_db_records", 0)
+        )
+        state.interval_minutes = next_interval(state.interval_minutes, state.is_hot, change_count)
+        state.last_change_count = change_count
+        state.last_synced_at = now
+    # Lỗi -> giữ nhịp cũ, thử lại ở lượt kế tiếp
+    state.next_sync_at = now + timedelta(minutes=state.interval_minutes)
+    session.add(state)
+
+
+def schedule_due_folders(session: Session, now: Optional[datetime] = None) -> Optional[int]:
+    """
+    Cập nhật HOT/COLD theo nhu cầu thực tế rồi gom folder đến hạn thành 1 job FOLDER.
+    Trả về job_id nếu có job được tạo.
+    """
+    from app.sync_jobs import enqueue_folder_sync, get_active_full_job  # Import lười để tránh vòng lặp
+
+    now = now or datetime.utcnow()
+
+    # Đang có Sync All -> nó quét hết rồi, không cần lập lịch thêm
+    if get_active_full_job(session):
+        return None
+
+    hot_ids = get_hot_folder_ids(session)
+    folder_ids = set(session.exec(select(Folder.id)).all())
+    states = {s.folder_id: s for s in session.exec(select(FolderSyncState)).all()}
+
+    for folder_id in folder_ids:
+        is_hot = folder_id in hot_ids
+        state = states.get(folder_id)
+        if not state:
+            low, high = HOT_INTERVAL if is_hot else COLD_INTERVAL
+            # Folder mới: HOT quét ngay, COLD để dành tới nhịp đầu tiên
+            state = FolderSyncState(
+                folder_id=folder_id,
+                is_hot=is_hot,
+                interval_minutes=low if is_hot else high,
+                next_sync_at=now if is_hot else now + timedelta(minutes=low),
+            )
+            states[folder_id] = state
+            session.add(state)
+        elif state.is_hot != is_hot:
+            # Đổi loại (Page vừa gán/bỏ folder) -> kẹp lại nhịp, folder vừa thành HOT thì quét sớm
+            state.is_hot = is_hot
+            state.interval_minutes = next_interval(state.interval_minutes, is_hot, 0)
+            if is_hot:
+                state.next_sync_at = now
+            session.add(state)
+
+    due = [
+        s for s in states.values()
+        if s.folder_id in folder_ids and (s.next_sync_at is None or s.next_sync_at <= now)
+    ]
+    # HOT trước, sau đó folder trễ hạn lâu nhất trước
+    due.sort(key=lambda s: (not s.is_hot, s.next_sync_at or datetime.min))
+    due = due[:MAX_FOLDERS_PER_JOB]
+
+    # Đẩy mốc kế tiếp ngay để tick sau không xếp trùng folder đang chờ trong hàng đợi
+    for s in due:
+        s.next_sync_at = now + timedelta(minutes=s.interval_minutes)
+        session.add(s)
+    session.commit()
+
+    if not due:
+        return None
+
+    job = enqueue_folder_sync(session, [s.folder_id for s in due])
+    hot_count = sum(1 for s in due if s.is_hot)
+    logger.info(f"🗓️ Lập lịch job #{job.id}: {len(due)} folder ({hot_count} HOT)")
+    return job.id
+
+
+def run_periodic_tasks(session: Session):
+    """Chạy các task đến hạn. Task lỗi không ảnh hưởng task khác"""
+    now = time.monotonic()
+    for name, interval, fn in PERIODIC_TASKS:
+        last = _last_run.get(name)
+        if last is not None and now - last < interval:
+            continue
+        _last_run[name] = now
+        try:
+            fn(session)
+        except Exception as e:
+            session.rollback()
+            logger.error(f"❌ Task định kỳ {name} lỗi: {e}")
+
+
+def run_scheduler_tick(session: Session):
+    """1 lượt scheduler. Dùng advisory lock để chỉ 1 process lập lịch tại một thời điểm"""
+    locked = session.exec(
+        text("SELECT pg_try_advisory_lock(:key)"), params={"key": SCHEDULER_LOCK_KEY}
+    ).scalar()
+    if not locked:
+        return
+    try:
+        schedule_due_folders(session)
+        run_periodic_tasks(session)
+    finally:
+        session.exec(text("SELECT pg_advisory_unlock(:key)"), params={"key": SCHEDULER_LOCK_KEY})
+        session.commit()
+
+
+# --- THREAD SCHEDULER ---
+
+_stop_event = threading.Event()
+_scheduler_thread: Optional[threading.Thread] = None
+
+
+def _scheduler_loop():
+    logger.info("🗓️ Sync scheduler bắt đầu")
+    while not _stop_event.wait(TICK_SECONDS):
+        try:
+            # Giữ nguyên 1 connection cho cả tick để advisory lock (theo session Postgres) nhả đúng chỗ
+            with engine.connect() as conn, Session(bind=conn) as session:
+                run_scheduler_tick(session)
+        except Exception as e:
+            logger.error(f"❌ Scheduler lỗi: {e}")
+    logger.info("🗓️ Sync scheduler dừng")
+
+
+def start_scheduler():
+    global _scheduler_thread
+    if not SCHEDULER_ENABLED:
+        return
+    if _scheduler_thread and _scheduler_thread.is_alive():
+        return
+    _stop_event.clear()
+    _scheduler_thread = threading.Thread(target=_scheduler_loop, name="sync-scheduler", daemon=True)
+    _scheduler_thread.start()
+
+
+def stop_scheduler():
+    _stop_event.set()
@@ -1,12 +1,14 @@
 # app/sync_service.py
 
+import hashlib
 import logging
 from typing import Dict, List, Optional
-from datetime import datetime
-from sqlmodel import Session, select
+from datetime import datetime, timezone
+from sqlmodel import Session, select, delete, text
 
 from app.models import Folder, Image
 from app.drive_service import get_drive_service
+from app.image_probe import fill_missing_dimensions
 
 logging.basicConfig(
     level=logging.INFO,
@@ -113,12 +115,118 @@ def sync_folder_structure(session: Session, root_folder_name: str = "TRAFFIC CON
         return {"success": False, "error": str(e)}
 
 
+def image_fingerprint(f: Dict) -> str:
+    """
+    Dấu vân tay metadata 1 ảnh trên Drive: đổi tên / mime / nội dung -> đổi fingerprint.
+    Không gồm thumbnailLink: link do Drive cấp lại liên tục, không phải thay đổi của ảnh
+    """
+    raw = "|".join([
+        f.get("name") or "",
+        f.get("mimeType") or "",
+        f.get("modifiedTime") or "",
+    ])
+    return hashlib.md5(raw.encode("utf-8")).hexdigest()
+
+
+def _as_utc_naive(value: Optional[datetime]) -> Optional[datetime]:
+    # DB lưu TIMESTAMP không timezone (UTC), Drive trả ISO có 'Z'
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def drive_image_dimensions(f: Dict):
+    """(width, height, size_bytes) từ metadata Drive - None nếu Drive không trả"""
+    meta = f.get("imageMediaMetadata") or {}
+    size = f.get("size")
+    return meta.get("width"), meta.get("height"), int(size) if size else None
+
+
+def bulk_update_images(session: Session, files: List[Dict], chunk_size: int = 500) -> int:
+    """
+    Cập nhật metadata các ảnh đã thay đổi: 1 câu UPDATE ... FROM (VALUES ...) cho mỗi chunk
+    thay vì UPDATE từng row qua ORM. Không commit.
+    """
+    updated = 0
+    for i in range(0, len(files), chunk_size):
+        chunk = files[i:i + chunk_size]
+        params = {}
+        values_sql = []
+        for n, f in enumerate(chunk):
+            width, height, size_bytes = drive_image_dimensions(f)
+            values_sql.append(
+                f"(:id{n}, :name{n}, :mime{n}, :thumb{n}, "
+                f"CAST(:mtime{n} AS TIMESTAMP), CAST(:ctime{n} AS TIMESTAMP), :fp{n}, "
+                f"CAST(:w{n} AS INTEGER), CAST(:h{n} AS INTEGER), CAST(:size{n} AS INTEGER))"
+            )
+            params.update({
+                f"id{n}": f["id"],
+                f"name{n}": f["name"],
+                f"mime{n}": f.get("mimeType"),
+                f"thumb{n}": f.get("thumbnailLink"),
+                f"mtime{n}": parse_drive_datetime(f.get("modifiedTime")),
+                f"ctime{n}": parse_drive_datetime(f.get("createdTime")),
+                f"fp{n}": image_fingerprint(f),
+                f"w{n}": width,
+                f"h{n}": height,
+                f"size{n}": size_bytes,
+            })
+
+        session.exec(text(f"""
+            UPDATE images AS i SET
+                name = v.name,
+                mime_type = v.mime_type,
+                thumbnail_link = v.thumbnail_link,
+                modified_time = v.modified_time,
+                created_time = COALESCE(i.created_time, v.created_time),
+                fingerprint = v.fingerprint,
+                -- Ảnh bị sửa (modified_time đổi) -> kích thước cũ không còn đúng, lấy từ Drive (NULL -> đọc header lại)
+                -- Chỉ đổi tên / metadata -> giữ kích thước đã đọc nếu Drive không trả
+                width = CASE WHEN i.modified_time IS DISTINCT FROM v.modified_time
+                             THEN v.width ELSE COALESCE(v.width, i.width) END,
+                height = CASE WHEN i.modified_time IS DISTINCT FROM v.modified_time
+                              THEN v.height ELSE COALESCE(v.height, i.height) END,
+                size_bytes = COALESCE(v.size_bytes, i.size_bytes)
+            FROM (VALUES {", ".join(values_sql)})
+                AS v(id, name, mime_type, thumbnail_link, modified_time, created_time, fingerprint,
+                     width, height, size_bytes)
+            WHERE i.id = v.id
+        """), params=params)
+        updated += len(chunk)
+    return updated
+
+
+def bulk_refresh_thumbnails(session: Session, files: List[Dict], chunk_size: int = 1000) -> int:
+    """Chỉ ghi lại thumbnail_link (Drive cấp link mới) cho các ảnh không đổi gì khác. Không commit."""
+    for i in range(0, len(files), chunk_size):
+        chunk = files[i:i + chunk_size]
+        params = {}
+        for n, f in enumerate(chunk):
+            params.update({f"id{n}": f["id"], f"thumb{n}": f.get("thumbnailLink")})
+        values_sql = ", ".join(f"(:id{n}, :thumb{n})" for n in range(len(chunk)))
+        session.exec(text(f"""
+            UPDATE images AS i SET thumbnail_link = v.thumbnail_link
+            FROM (VALUES {values_sql}) AS v(id, thumbnail_link)
+            WHERE i.id = v.id
+        """), params=params)
+    return len(files)
+
+
+def bulk_delete_images(session: Session, image_ids: List[str], chunk_size: int = 1000) -> int:
+    """Xóa metadata theo chunk (tránh giới hạn tham số SQL). Không commit."""
+    for i in range(0, len(image_ids), chunk_size):
+        session.exec(delete(Image).where(Image.id.in_(image_ids[i:i + chunk_size])))
+    return len(image_ids)
+
+
 def sync_images_in_folder(session: Session, folder_id: str) -> Dict:
     """
     → CHỈ LÀM VIỆC VỚI METADATA
     → KHÔNG TẠO FILE LOCAL
     → KHÔNG TẢI FILE
     → KHÔNG XOÁ FILE
+    → Ảnh cũ: so fingerprint, chỉ UPDATE (bulk) các ảnh thực sự thay đổi
+    → thumbnailLink đổi (Drive cấp lại) -> chỉ ghi lại link, không tính là thay đổi
     """
     try:
         logger.info(f"🖼️ Sync images folder: {folder_id}")
@@ -134,7 +242,10 @@ def sync_images_in_folder(session: Session, folder_id: str) -> Dict:
         while True:
             res = service.files().list(
                 q=query,
-                fields="nextPageToken, files(id,name,mimeType,thumbnailLink,createdTime)",
+                fields=(
+                    "nextPageToken, files(id,name,mimeType,thumbnailLink,createdTime,modifiedTime,"
+                    "size,imageMediaMetadata(width,height))"
+                ),
                 pageSize=1000,
                 pageToken=page_token,
             ).execute()
@@ -146,58 +257,72 @@ def sync_images_in_folder(session: Session, folder_id: str) -> Dict:
                 break
 
         drive_ids = {f["id"] for f in all_files}
-        drive_map = {f["id"]: f for f in all_files}
-
-        db_imgs = session.exec(select(Image).where(Image.folder_id == folder_id)).all()
-        db_ids = {img.id for img in db_imgs}
-        db_map = {img.id: img for img in db_imgs}
 
-        new_db, updated_db, deleted_db = 0, 0, 0
+        # Chỉ lấy vài cột cần so -> không load cả object ORM
+        db_rows = {
+            row.id: row for row in session.exec(
+                select(Image.id, Image.fingerprint, Image.name, Image.modified_time, Image.thumbnail_link)
+                .where(Image.folder_id == folder_id)
+            ).all()
+        }
 
-        # Insert / Update metadata
+        new_files = [f for f in all_files if f["id"] not in db_rows]
+        changed_files, thumbnail_files = [], []
         for f in all_files:
-            db_img = db_map.get(f["id"])
-
-            if not db_img:
-                db_img = Image(
-                    id=f["id"],
-                    name=f["name"],
-                    folder_id=folder_id,
-                    mime_type=f.get("mimeType"),
-                    thumbnail_link=f.get("thumbnailLink"),
-                    created_time=parse_drive_datetime(f.get("createdTime")),
-                )
-                session.add(db_img)
-                new_db += 1
-            else:
-                changed = False
-
-                if db_img.name != f["name"]:
-                    db_img.name = f["name"]
-                    changed = True
-
-                if db_img.mime_type != f.get("mimeType"):
-                    db_img.mime_type = f.get("mimeType")
-                    changed = True
-
-                if db_img.thumbnail_link != f.get("thumbnailLink"):
-                    db_img.thumbnail_link = f.get("thumbnailLink")
-                    changed = True
-
-                if not db_img.created_time and f.get("createdTime"):
-                    db_img.created_time = parse_drive_datetime(f.get("createdTime"))
-                    changed = True
-
-                if changed:
-                    session.add(db_img)
-                    updated_db += 1
+            row = db_rows.get(f["id"])
+            if row is None:
+                continue
+            if row.fingerprint != image_fingerprint(f):
+                changed_files.append(f)
+            elif row.thumbnail_link != f.get("thumbnailLink"):
+                thumbnail_files.append(f)
+        # Chỉ đổi tên / sửa nội dung mới tính là thay đổi (nhịp quét HOT/COLD);
+        # fingerprint dạng cũ / chỉ đổi mime vẫn được cập nhật nhưng không tính.
+        # Row tạo trước migration 028 (modified_time NULL) -> chỉ điền bù, không tính là sửa nội dung
+        content_changed = sum(
+            1 for f in changed_files
+            if db_rows[f["id"]].name != f["name"]
+            or (
+                db_rows[f["id"]].modified_time is not None
+                and _as_utc_naive(db_rows[f["id"]].modified_time)
+                != _as_utc_naive(parse_drive_datetime(f.get("modifiedTime")))
+            )
+        )
+        deleted_ids = list(set(db_rows) - drive_ids)
+
+        # Insert metadata mới
+        for f in new_files:
+            width, height, size_bytes = drive_image_dimensions(f)
+            session.add(Image(
+                id=f["id"],
+                name=f["name"],
+                folder_id=folder_id,
+                mime_type=f.get("mimeType"),
+                thumbnail_link=f.get("thumbnailLink"),
+                created_time=parse_drive_datetime(f.get("createdTime")),
+                modified_time=parse_drive_datetime(f.get("modifiedTime")),
+                fingerprint=image_fingerprint(f),
+                width=width,
+                height=height,
+                size_bytes=size_bytes,
+            ))
+
+        # Update metadata đã đổi (đổi tên, sửa ảnh...) + làm mới thumbnail hết hạn
+        updated_db = bulk_update_images(session, changed_files)
+        thumbnail_refreshed = bulk_refresh_thumbnails(session, thumbnail_files)
 
         # Delete metadata không còn trên Drive
-        for img_id in db_ids - drive_ids:
-            session.delete(db_map[img_id])
-            deleted_db += 1
+        deleted_db = bulk_delete_images(session, deleted_ids)
 
         session.commit()
+        new_db = len(new_files)
+
+        # Ảnh Drive không trả kích thước -> đọc header (Range request) song song
+        try:
+            fill_missing_dimensions(session, folder_id)
+        except Exception as e:
+            session.rollback()
+            logger.warning(f"⚠️ Không đọc được kích thước ảnh folder {folder_id}: {e}")
         logger.info(f"✅ Folder {folder_id}: {new_db} mới, {updated_db} cập nhật, {deleted_db} xóa")
         return {
             "success": True,
@@ -205,6 +330,8 @@ def sync_images_in_folder(session: Session, folder_id: str) -> Dict:
             "total_images": len(all_files),
             "new_db_records": new_db,
             "updated_db_records": updated_db,
+            "changed_db_records": content_changed,
+            "thumbnail_refreshed": thumbnail_refreshed,
             "deleted_db_records": deleted_db,
         }
 
@@ -6,6 +6,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles  # Thêm import StaticFiles
 from sqlmodel import SQLModel
 from app.database import engine
+from app.migrations import run_migrations
 from fastapi import Depends
 
 
@@ -18,8 +19,16 @@ from app.api_links import router as links_router
 from app.api_pages import router as pages_router
 from app.api_overview import router as overview_router
 from app.api_stats import router as stats_router
+from app.api_export import router as export_router
 from app.api_auth import router as auth_router, verify_stats_access
 from app.auth import verify_api_key
+from app.sync_jobs import start_sync_worker, stop_sync_worker
+from app.sync_scheduler import start_scheduler, stop_scheduler, register_periodic_task
+from app.ingest_service import purge_raw_post_metrics, purge_idempotency_keys
+from app.ingest_buffer import start_ingest_buffer, stop_ingest_buffer
+from app.rollup_service import extend_followers_asof
+from app.retention_service import compact_post_metrics
+from app.partition_service import ensure_partitions, maintain_partitions
 
 # Import auth models to create tables
 from app.models_auth import User, UserPageAccess
@@ -42,7 +51,31 @@ app.mount("/static", StaticFiles(directory="static_images"), name="static")
 def on_startup():
     print("🔄 Checking DB Schema...")
     SQLModel.metadata.create_all(engine)
+    # Cột / index mới cho các bảng đã tồn tại (create_all không ALTER)
+    run_migrations(engine)
+    # Partition tháng này + các tháng tới cho analytics_post_metric / analytics_page_health
+    with engine.begin() as conn:
+        ensure_partitions(conn)
     print("✅ Database Ready!")
+    # Buffer ghi dữ liệu Extension (INGEST_BUFFER_ENABLED=1): replay spool còn sót trước khi nhận request
+    start_ingest_buffer()
+    # Worker xử lý hàng đợi sync (job dở dang trước khi restart sẽ được chạy tiếp)
+    start_sync_worker()
+    # Scheduler tự xếp lịch sync folder theo nhu cầu (tắt bằng SYNC_SCHEDULER_ENABLED=0)
+    # + các việc bảo trì định kỳ
+    register_periodic_task("post_metric_raw_retention", 3600, purge_raw_post_metrics)
+    register_periodic_task("ingest_idempotency_key_ttl", 3600, purge_idempotency_keys)
+    register_periodic_task("page_daily_stats_followers_asof", 3600, extend_followers_asof)
+    register_periodic_task("post_metric_downsampling", 3600, compact_post_metrics)
+    register_periodic_task("analytics_monthly_partitions", 86400, maintain_partitions)
+    start_scheduler()
+
+@app.on_event("shutdown")
+def on_shutdown():
+    stop_scheduler()
+    stop_sync_worker()
+    # Flush nốt phần còn trong spool
+    stop_ingest_buffer()
 
 app.add_middleware(
     CORSMiddleware,
@@ -75,6 +108,7 @@ app.include_router(overview_router, prefix="/api/overview", tags=["Overview"], d
 
 # Stats - Dual auth (already correct)
 app.include_router(stats_router, prefix="/api/stats", tags=["Stats"], dependencies=[Depends(verify_stats_access)])
+app.include_router(export_router, prefix="/api/export", tags=["Export"], dependencies=[Depends(verify_stats_access)])
 
 # Auth router - PUBLIC (no API key required, used by Dashboard login)
 app.include_router(auth_router, prefix="/api", tags=["Auth"])
@@ -0,0 +1,19 @@
+# rebuild_rollups.py
+# Dựng lại bảng page_daily_stats từ analytics_page_health + analytics_post_daily
+# Cách dùng: python rebuild_rollups.py [YYYY-MM-DD_bắt_đầu] [YYYY-MM-DD_kết_thúc]
+import sys
+from datetime import date
+
+from sqlmodel import Session
+from app.database import engine
+from app.rollup_service import rebuild_page_daily_stats
+
+def main():
+    start = date.fromisoformat(sys.argv[1]) if len(sys.argv) > 1 else None
+    end = date.fromisoformat(sys.argv[2]) if len(sys.argv) > 2 else None
+    with Session(engine) as session:
+        count = rebuild_page_daily_stats(session, start, end)
+    print(f"✅ Đã dựng lại {count} row page_daily_stats ({start or 'đầu'} -> {end or 'cuối'})")
+
+if __name__ == "__main__":
+    main()
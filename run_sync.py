@@ -1,13 +1,17 @@
 # run_sync.py
 from sqlmodel import Session
 from app.database import engine
-from app.sync_service import sync_all_folders
+from app.sync_jobs import enqueue_full_sync, run_pending_jobs
 
 def main():
     # Tạo session kết nối DB
     with Session(engine) as session:
-        # Gọi hàm sync toàn bộ (đã bao gồm logic lặp, nghỉ, và in log)
-        sync_all_folders(session)
+        # Đưa Sync All vào hàng đợi (nếu server đang chạy job FULL thì dùng lại job đó)
+        job, created = enqueue_full_sync(session)
+        if not created:
+            print(f"⚠️ Job #{job.id} đang {job.status}, chạy tiếp job này nếu còn PENDING")
+        # Xử lý hàng đợi ngay tại process này (có checkpoint, Ctrl+C rồi chạy lại sẽ tiếp tục)
+        run_pending_jobs(session)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()